@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# measures the time of importing pyasmtools in a fresh interpreter (the submodules are loaded on first use, see pyasmtools/__init__.py)
+
+import os
+import sys
+import subprocess
+import statistics
+import time
+
+RUNS = 20
+
+CASES = [
+    ("python startup", "pass"),
+    ("import pyasmtools", "import pyasmtools"),
+    ("import + prettydis", "import pyasmtools; pyasmtools.prettydis"),
+    ("import + TraceMe", "import pyasmtools; pyasmtools.TraceMe"),
+    ("import + first trace", "import pyasmtools\n@pyasmtools.TraceMe\ndef f(): return 1\nf()"),
+]
+
+def measure(code):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.abspath(__file__)) + os.pathsep + env.get("PYTHONPATH", "")
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        subprocess.run([ sys.executable, "-c", code ], env=env, check=True, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def main():
+    base = None
+    for title, code in CASES:
+        median = measure(code)
+        if base is None:
+            base = median
+        print(f"{title:24} median: {median * 1000:7.1f} ms  (+{(median - base) * 1000:6.1f} ms over startup)")
+
+if __name__ == "__main__":
+    main()
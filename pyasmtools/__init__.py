@@ -1,2 +1,63 @@
-from .prettydiasm import  *
-from .prettytrace import  *
+"""pyasmtools: bytecode disassembler and execution tracer. The submodules are imported on first use of one of their names,
+so that importing the package is cheap (see bench_import.py)."""
+
+import sys
+import importlib
+
+# public name -> submodule that defines it
+_SUBMODULE_OF_NAME = {
+    "prettydis" : "prettydiasm", "prettydis_source" : "prettydiasm", "prettydis_file" : "prettydiasm",
+
+    "TraceParam" : "prettytrace", "TraceRecord" : "prettytrace", "EVENT_KINDS" : "prettytrace", "OPCODE_EVENT_KINDS" : "prettytrace",
+    "format_value" : "prettytrace", "TraceConsumer" : "prettytrace", "TextTraceConsumer" : "prettytrace", "JsonTraceConsumer" : "prettytrace",
+    "EventCollector" : "prettytrace", "ObjectTracker" : "prettytrace", "is_traced_file" : "prettytrace", "set_process_trace_out" : "prettytrace",
+    "set_idle_tracer" : "prettytrace", "TraceMe" : "prettytrace", "TraceClass" : "prettytrace", "disable_stack_access" : "prettytrace",
+    "trace_by_name" : "prettytrace", "untrace_by_name" : "prettytrace", "enable_tracing" : "prettytrace", "is_tracing_enabled" : "prettytrace",
+
+    "ChromeTraceConsumer" : "chrometrace",
+
+    "RotatingFileSink" : "sinks", "read_segments" : "sinks", "list_segments" : "sinks",
+
+    "ChildTraceConfig" : "procpool", "init_child_tracing" : "procpool", "enable_child_tracing" : "procpool", "pool_initializer" : "procpool",
+    "TracedCall" : "procpool", "list_child_traces" : "procpool", "merge_child_traces" : "procpool",
+
+    "LineCoverage" : "linecoverage",
+
+    "MemoryProfiler" : "memprofile",
+
+    "InstructionCounter" : "instrcount", "count_instructions" : "instrcount", "assert_max_instructions" : "instrcount",
+
+    "LoopFoldingConsumer" : "loopfold",
+
+    "TypeProfiler" : "typeprofile",
+
+    "CallGraph" : "callgraph",
+
+    "TraceAttachment" : "attach", "attach_trace" : "attach", "detach_all" : "attach",
+
+    "ArgCapture" : "capture", "CapturedCall" : "capture", "read_captures" : "capture", "replay" : "capture",
+
+    "ColumnarTraceConsumer" : "columnar", "ColumnarTrace" : "columnar", "read_columnar" : "columnar",
+
+    "TracerStats" : "tracerstats",
+
+    "SocketTraceConsumer" : "socketsink", "SocketSink" : "socketsink",
+}
+
+__all__ = list(_SUBMODULE_OF_NAME)
+
+if sys.version_info < (3, 7):
+    # no module __getattr__ (PEP 562) before python 3.7
+    for _module_name in sorted(set(_SUBMODULE_OF_NAME.values())):
+        globals().update( importlib.import_module("." + _module_name, __name__).__dict__ )
+else:
+    def __getattr__(name):
+        module_name = _SUBMODULE_OF_NAME.get(name, None)
+        if module_name is None:
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+        value = getattr(importlib.import_module("." + module_name, __name__), name)
+        globals()[ name ] = value
+        return value
+
+    def __dir__():
+        return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,404 @@
+"""command line tool:
+
+    python -m pyasmtools trace script.py [script arguments]     - trace the whole script
+    python -m pyasmtools trace --func pkg.mod:Class.method --func __main__:main --sample 0.01 --out trace.gz script.py
+    python -m pyasmtools dis pkg.mod                               - disassemble a module (or a source file), without importing it
+    python -m pyasmtools replay --errors capture_file              - trace a call, that was recorded by ArgCapture
+    python -m pyasmtools diff trace_a.gz trace_b.gz                - show the first difference between two traces
+    python -m pyasmtools merge trace_dir                           - print the traces written by the child processes of a process pool, one after the other
+
+The modules of the package are imported on demand, so that startup of the tool stays fast.
+"""
+
+import sys
+import os
+import argparse
+
+
+def _open_out(file_name):
+    if file_name is None or file_name == "-":
+        return sys.stderr, False
+    if file_name.endswith(".gz"):
+        import gzip
+        return gzip.open(file_name, "wt", encoding="utf-8"), True
+    if file_name.endswith(".zst"):
+        import io
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(file_name, "wb")), encoding="utf-8"), True
+    return open(file_name, "w", encoding="utf-8"), True
+
+
+def _load_script(script_path):
+    import types
+
+    with open(script_path, "rb") as file:
+        source = file.read()
+    code = compile(source, script_path, "exec")
+
+    module = types.ModuleType("__main__")
+    module.__file__ = script_path
+    module.__builtins__ = __builtins__
+    module.__spec__ = None
+    return module, code
+
+
+# wraps the functions named by --func, once they are defined. Functions of imported modules are wrapped by an import hook, after
+# the module has been loaded; functions of the script are wrapped by a trace function of the module frame, after each line of the module.
+class _TargetWrapper:
+    def __init__(self, specs, sample_rate, trace_param):
+        self.pending = list(specs)
+        self.sample_rate = sample_rate
+        self.trace_param = trace_param
+        self.script_code = None
+        self.script_frame = None
+
+    def _make_wrapper(self, func):
+        import random
+        import functools
+        from . import prettytrace
+
+        traced_func = prettytrace._make_trace_wrapper(func, self.trace_param)
+        sample_rate = self.sample_rate
+
+        def wrapper_fun(*args, **kwargs):
+            if sample_rate is not None and random.random() >= sample_rate:
+                return func(*args, **kwargs)
+            try:
+                return traced_func(*args, **kwargs)
+            finally:
+                # the end of the trace removed the trace function, that waits for the remaining definitions in the script.
+                self._resume_watch()
+
+        functools.update_wrapper(wrapper_fun, func)
+        return wrapper_fun
+
+    def _wrap(self, owner, name, val):
+        import inspect
+
+        if isinstance(val, (staticmethod, classmethod)):
+            new_val = type(val)( self._make_wrapper(val.__func__) )
+        elif inspect.isfunction(val) or inspect.ismethod(val):
+            new_val = self._make_wrapper(val)
+        else:
+            print(f"pyasmtools: {name} is not a function or method, not traced", file=sys.stderr)
+            return
+        setattr(owner, name, new_val)
+
+    def _resolve(self, spec, module):
+        attrs = spec.split(":", 1)[1].split(".")
+        owner = module
+        for attr in attrs[:-1]:
+            owner = getattr(owner, attr, None)
+            if owner is None:
+                return None
+        name = attrs[-1]
+        if isinstance(owner, type) and name in owner.__dict__:
+            return owner, name, owner.__dict__[ name ]
+        if not hasattr(owner, name):
+            return None
+        return owner, name, getattr(owner, name)
+
+    def wrap_defined(self, module_name, module):
+        """wrap the pending targets of module_name, that are already defined"""
+        for spec in list(self.pending):
+            if spec.split(":", 1)[0] != module_name:
+                continue
+            resolved = self._resolve(spec, module)
+            if resolved is not None:
+                self.pending.remove(spec)
+                self._wrap(*resolved)
+
+    def on_module_loaded(self, module):
+        self.wrap_defined(module.__name__, module)
+
+    # trace function that waits for the script module to run, then watches the lines of the module frame.
+    def _watch_tracer(self, frame, why, arg):
+        if frame.f_code is not self.script_code:
+            return None
+        self.script_frame = frame
+        return self._module_line_tracer
+
+    def _module_line_tracer(self, frame, why, arg):
+        module = sys.modules["__main__"]
+        self.wrap_defined("__main__", module)
+        if not any(spec.startswith("__main__:") for spec in self.pending):
+            frame.f_trace = None
+            sys.settrace(None)
+            return None
+        return self._module_line_tracer
+
+    def start_watch(self, script_code):
+        if any(spec.startswith("__main__:") for spec in self.pending):
+            self.script_code = script_code
+            sys.settrace(self._watch_tracer)
+
+    def _resume_watch(self):
+        from . import prettytrace
+
+        if self.script_frame is not None and getattr(prettytrace.local_data_, "trace_ctx", None) is None and any(spec.startswith("__main__:") for spec in self.pending):
+            sys.settrace(self._watch_tracer)
+            self.script_frame.f_trace = self._module_line_tracer
+
+    def stop_watch(self):
+        if self.script_code is not None and sys.gettrace() == self._watch_tracer:
+            sys.settrace(None)
+        self.script_frame = None
+
+
+# meta path finder, calls on_loaded after one of the watched modules has been executed.
+class _ImportHook:
+    def __init__(self, module_names, on_loaded):
+        self.module_names = set(module_names)
+        self.on_loaded = on_loaded
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname not in self.module_names:
+            return None
+        import importlib.util
+
+        # find the real spec with the other finders, then hook into its loader.
+        self.module_names.discard(fullname)
+        try:
+            spec = importlib.util.find_spec(fullname)
+        finally:
+            self.module_names.add(fullname)
+        if spec is None or spec.loader is None or not hasattr(spec.loader, "exec_module"):
+            return spec
+
+        loader = spec.loader
+        on_loaded = self.on_loaded
+        exec_module = loader.exec_module
+
+        def hooked_exec_module(module):
+            exec_module(module)
+            on_loaded(module)
+
+        loader.exec_module = hooked_exec_module
+        return spec
+
+
+# returns the output stream, the trace parameters and the consumer that must be closed at the end (chrome, columnar; None for the other formats)
+def _make_trace_param(args):
+    from . import prettytrace
+
+    consumers = None
+    close_consumer = None
+    if args.format == "columnar":
+        # binary file, written by the consumer itself
+        from . import columnar
+        close_consumer = columnar.ColumnarTraceConsumer(args.out, show_obj=args.show_obj)
+        consumers = [ close_consumer ]
+        args.out = None
+
+    tracer_stats = None
+    if args.tracer_stats:
+        from . import tracerstats
+        tracer_stats = tracerstats.TracerStats()
+
+    out, close_out = _open_out(args.out)
+    if args.format == "json":
+        consumers = [ prettytrace.JsonTraceConsumer(out, show_obj=args.show_obj) ]
+    elif args.format == "chrome":
+        from . import chrometrace
+        close_consumer = chrometrace.ChromeTraceConsumer(out, show_obj=args.show_obj)
+        consumers = [ close_consumer ]
+
+    trace_param = prettytrace.TraceParam(trace_indent=args.indent, trace_loc=True, show_obj=args.show_obj, ignore_stdlib=not args.no_ignore_stdlib, out=out, consumers=consumers, fold_comprehensions=args.fold_comprehensions, fold_loops=args.fold_loops, tracer_stats=tracer_stats)
+    return out, close_out, trace_param, close_consumer
+
+
+def _cmd_trace(args):
+    from . import prettytrace
+
+    # the trace is asked for explicitly, PYASMTOOLS_TRACE=0 doesn't apply.
+    prettytrace.enable_tracing(True)
+
+    out, close_out, trace_param, close_consumer = _make_trace_param(args)
+
+    script_path = os.path.abspath(args.script)
+    module, code = _load_script(script_path)
+
+    main_module = sys.modules["__main__"]
+    sys.modules["__main__"] = module
+    sys.argv = [ args.script ] + args.script_args
+    sys.path[0] = os.path.dirname(script_path)
+
+    hook = None
+    wrapper = None
+    if args.func:
+        wrapper = _TargetWrapper(args.func, args.sample, trace_param)
+        module_names = set(spec.split(":", 1)[0] for spec in args.func)
+        module_names.discard("__main__")
+        for module_name in list(module_names):
+            if module_name in sys.modules:
+                wrapper.on_module_loaded(sys.modules[ module_name ])
+                module_names.discard(module_name)
+        if module_names:
+            hook = _ImportHook(module_names, wrapper.on_module_loaded)
+            sys.meta_path.insert(0, hook)
+
+    exit_code = 0
+    try:
+        if wrapper is not None:
+            wrapper.start_watch(code)
+            try:
+                exec(code, module.__dict__)
+            finally:
+                wrapper.stop_watch()
+        else:
+            prettytrace._init_trace(trace_param)
+            try:
+                exec(code, module.__dict__)
+            finally:
+                prettytrace._check_eof_trace()
+    except SystemExit as ex:
+        exit_code = ex.code
+    finally:
+        if hook is not None:
+            sys.meta_path.remove(hook)
+        sys.modules["__main__"] = main_module
+        if wrapper is not None and wrapper.pending:
+            print(f"pyasmtools: functions not found: {', '.join(wrapper.pending)}", file=sys.stderr)
+        if close_consumer is not None:
+            close_consumer.close()
+        if close_out:
+            out.close()
+    return exit_code
+
+
+def _cmd_replay(args):
+    from . import capture
+    from . import prettytrace
+
+    prettytrace.enable_tracing(True)
+
+    calls = [ call for call in capture.read_captures(args.capture_file) if (args.func is None or call.func == args.func) and (not args.errors or call.error is not None) ]
+    if args.list:
+        for call in calls:
+            error = "" if call.error is None else f" error: {call.error}"
+            print(f"{call.index} pid: {call.pid} time: {call.time:.3f} {call.func} ({len(call.args_pickle)} bytes){error}")
+        return 0
+
+    if args.index is not None:
+        calls = [ call for call in calls if call.index == args.index ]
+    if not calls:
+        print(f"pyasmtools: no matching call in {args.capture_file}", file=sys.stderr)
+        return 1
+    # the last matching call is replayed, unless --index is given
+    call = calls[-1]
+
+    out, close_out, trace_param, close_consumer = _make_trace_param(args)
+    try:
+        capture._replay_call(call, trace_param)
+    except Exception as ex:
+        # the exception is expected, if the captured call raised it as well.
+        print(f"pyasmtools: replay of {call.index} {call.func} raised {ex!r} (captured: {call.error})", file=sys.stderr)
+    finally:
+        if close_consumer is not None:
+            close_consumer.close()
+        if close_out:
+            out.close()
+    return 0
+
+
+def _cmd_diff(args):
+    from . import tracediff
+
+    result = tracediff.diff_traces(args.trace_a, args.trace_b, window=args.window, context=args.context, ignore_addresses=not args.keep_addresses)
+    result.show_report(sys.stdout)
+    return 0 if result.is_same() else 1
+
+
+def _cmd_dis(args):
+    import importlib.util
+    from . import prettydiasm
+
+    file_path = args.target
+    if not os.path.isfile(file_path):
+        spec = importlib.util.find_spec(args.target)
+        if spec is None or spec.origin is None or not spec.origin.endswith(".py"):
+            print(f"pyasmtools: can't find source of {args.target}", file=sys.stderr)
+            return 1
+        file_path = spec.origin
+
+    prettydiasm.prettydis_file(file_path, show_opcode_as_links=args.links, functions=args.func)
+    return 0
+
+
+def _cmd_merge(args):
+    from . import procpool
+
+    procpool.merge_child_traces(args.trace_dir, sys.stdout, args.prefix)
+    return 0
+
+
+def _add_trace_options(parser):
+    parser.add_argument("--out", default=None, metavar="FILE", help="write the trace to this file (compressed if the name ends with .gz or .zst). Default: standard error")
+    parser.add_argument("--format", choices=[ "text", "json", "chrome", "columnar" ], default="text", help="format of the trace (columnar: .npz file, or arrow stream if pyarrow is installed; requires --out)")
+    parser.add_argument("--show-obj", type=int, default=1, choices=[ 0, 1, 2 ], help="how to show values of objects (same as show_obj parameter of TraceMe)")
+    parser.add_argument("--indent", action="store_true", help="indent lines by nesting level of the call")
+    parser.add_argument("--fold-comprehensions", action="store_true", help="don't trace comprehensions and generator expressions separately, they are part of the line that contains them")
+    parser.add_argument("--fold-loops", type=int, default=0, metavar="K", help="show the first and the last K iterations of each loop, summarise the others (text format only)")
+    parser.add_argument("--tracer-stats", action="store_true", help="measure the tracer itself: report calls, time and bytes written per part of the tracer, when the trace ends")
+    parser.add_argument("--no-ignore-stdlib", action="store_true", help="trace functions of the standard library and of installed packages too")
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m pyasmtools", description="trace or disassemble python code")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    trace = commands.add_parser("trace", help="run a script and trace it")
+    trace.add_argument("--func", action="append", metavar="MODULE:NAME", help="trace calls of this function/method only (module:Class.method, __main__ for the script). Can be repeated")
+    trace.add_argument("--sample", type=float, default=None, metavar="RATE", help="trace this fraction of the calls of the functions given by --func (0.0 - 1.0)")
+    _add_trace_options(trace)
+    trace.add_argument("script", help="python script to run")
+    trace.add_argument("script_args", nargs=argparse.REMAINDER, help="arguments of the script")
+    trace.set_defaults(handler=_cmd_trace)
+
+    replay = commands.add_parser("replay", help="trace a call that was captured with the capture parameter of TraceMe/TraceClass (see capture.py)")
+    replay.add_argument("--list", action="store_true", help="list the captured calls, don't replay")
+    replay.add_argument("--index", type=int, default=None, help="replay the call with this index (see --list). Default: the last matching call")
+    replay.add_argument("--func", default=None, metavar="MODULE:NAME", help="only calls of this function")
+    replay.add_argument("--errors", action="store_true", help="only calls that raised an exception")
+    _add_trace_options(replay)
+    replay.add_argument("capture_file", help="file written by ArgCapture")
+    replay.set_defaults(handler=_cmd_replay)
+
+    dis_cmd = commands.add_parser("dis", help="disassemble a module or source file, without running it")
+    dis_cmd.add_argument("--func", action="append", metavar="NAME", help="show only the function with this (qualified) name. Can be repeated")
+    dis_cmd.add_argument("--links", action="store_true", help="show opcode names as links to the documentation")
+    dis_cmd.add_argument("target", help="module name or path of a python source file")
+    dis_cmd.set_defaults(handler=_cmd_dis)
+
+    diff = commands.add_parser("diff", help="compare two traces, show the first point where they differ (exit code 1 if they differ)")
+    diff.add_argument("--window", type=int, default=1000, help="number of events searched to get in sync again, after a difference in control flow")
+    diff.add_argument("--context", type=int, default=10, help="number of events shown before the first difference")
+    diff.add_argument("--keep-addresses", action="store_true", help="values that differ in object addresses (0x...) are different")
+    diff.add_argument("trace_a", help="first trace file (text or json, .gz/.zst compressed), or prefix of a rotated trace")
+    diff.add_argument("trace_b", help="second trace file")
+    diff.set_defaults(handler=_cmd_diff)
+
+    merge = commands.add_parser("merge", help="print the traces of the child processes of a process pool (see procpool.py), one process after the other")
+    merge.add_argument("--prefix", default="trace", help="prefix of the trace files")
+    merge.add_argument("trace_dir", help="directory with the trace files")
+    merge.set_defaults(handler=_cmd_merge)
+
+    args = parser.parse_args(argv)
+    if args.command == "trace" and any(":" not in spec for spec in args.func or []):
+        parser.error("--func must have the form module:name (use __main__:name for functions of the script)")
+    if args.command in ("trace", "replay") and args.format == "columnar" and args.out in (None, "-"):
+        parser.error("--format columnar requires --out FILE")
+    if args.command == "trace" and args.sample is not None and not 0.0 <= args.sample <= 1.0:
+        parser.error("--sample must be between 0.0 and 1.0")
+    if args.command == "trace" and args.sample is not None and not args.func:
+        parser.error("--sample applies to the calls of the functions given by --func, it requires --func")
+    return args
+
+
+def main(argv=None):
+    args = _parse_args(sys.argv[1:] if argv is None else argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""attach tracing to functions of a running program, and detach it again. Only the calls of the attached code objects are traced
+(including the functions called from there), all other code runs untraced; nothing is left behind once all attachments are detached."""
+
+import sys
+import time
+import inspect
+import threading
+import dataclasses
+from . import prettytrace
+
+__all__ = [ "TraceAttachment", "attach_trace", "detach_all" ]
+
+_LOCK = threading.Lock()
+# code object -> TraceAttachment
+_TARGETS = {}
+
+
+# returns the code objects of a target: name of the form package.module:Class.method, function, method, class (all of its methods) or code object
+def _get_codes(target):
+    if isinstance(target, str):
+        _, _, target = prettytrace._resolve_name(target)
+
+    if inspect.iscode(target):
+        return [ target ]
+    if isinstance(target, (staticmethod, classmethod)):
+        target = target.__func__
+    if inspect.isclass(target):
+        codes = []
+        for val in target.__dict__.values():
+            if isinstance(val, (staticmethod, classmethod, property)) or inspect.isfunction(val):
+                codes.extend( _get_codes(val.fget if isinstance(val, property) else val) )
+        return codes
+    if isinstance(target, prettytrace.TraceMe):
+        target = target.func
+    if inspect.ismethod(target):
+        target = target.__func__
+    target = inspect.unwrap(target)
+    if not inspect.isfunction(target):
+        raise TypeError(f"can't attach to {target!r}, not a function, method, class or code object")
+    return [ target.__code__ ]
+
+
+# counts the events of an attachment, mutes the trace once the limit is reached.
+class _EventLimit(prettytrace.TraceConsumer):
+    wants_values = False
+
+    def __init__(self, attachment, event_kinds):
+        self.attachment = attachment
+        self.event_kinds = event_kinds
+
+    def on_event(self, rec : prettytrace.TraceRecord):
+        attachment = self.attachment
+        attachment.num_events += 1
+        if attachment.max_events is not None and attachment.num_events >= attachment.max_events:
+            getattr(prettytrace.local_data_, "trace_ctx").mute()
+            attachment.detach()
+
+
+class TraceAttachment:
+    """returned by attach_trace; call detach() to stop tracing the attached functions (can be used as context manager)"""
+
+    def __init__(self, codes, trace_param, duration, max_events):
+        self.codes = codes
+        self.trace_param = trace_param
+        self.max_events = max_events
+        self.num_events = 0
+        self.num_calls = 0
+        self.active = False
+        self.timer = None
+        self.end_time = None
+        if duration is not None:
+            self.end_time = time.monotonic() + duration
+            self.timer = threading.Timer(duration, self.detach)
+            self.timer.daemon = True
+
+    # start the trace of a call of an attached function, returns the local trace function of the frame.
+    def _start(self, frame, arg):
+        self.num_calls += 1
+        prettytrace._init_trace(self.trace_param)
+        ctx = getattr(prettytrace.local_data_, "trace_ctx")
+        local_tracer = ctx.get_tracer()(frame, 'call', arg)
+
+        def target_tracer(frame, why, arg):
+            nonlocal local_tracer
+            if local_tracer is not None:
+                local_tracer = local_tracer(frame, why, arg)
+            if why == 'return':
+                # the trace of this call ends, the idle tracer is put back in place.
+                prettytrace._check_eof_trace()
+                return None
+            return target_tracer
+
+        return target_tracer
+
+    def detach(self):
+        """stop tracing the attached functions; calls that are traced right now are traced until they return"""
+        with _LOCK:
+            if not self.active:
+                return
+            self.active = False
+            for code in self.codes:
+                if _TARGETS.get(code, None) is self:
+                    del _TARGETS[ code ]
+            if not _TARGETS:
+                _uninstall_watcher()
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.detach()
+        return False
+
+
+# global trace function while attachments exist: does nothing, unless an attached code object is called.
+def _watch_tracer(frame, why, arg):
+    ctx = getattr(prettytrace.local_data_, "trace_ctx", None)
+    if ctx is not None:
+        # this thread is traced already (TraceMe or an attached function), the watcher took the place of its trace function.
+        sys.settrace(ctx.get_tracer())
+        return ctx.get_tracer()(frame, why, arg)
+    if not _TARGETS:
+        # everything is detached; other threads remove the watcher this way.
+        sys.settrace(None)
+        return None
+    if why != 'call':
+        return None
+
+    attachment = _TARGETS.get(frame.f_code, None)
+    if attachment is None:
+        return None
+    if attachment.end_time is not None and time.monotonic() >= attachment.end_time:
+        attachment.detach()
+        return None
+    return attachment._start(frame, arg)
+
+
+def _install_watcher():
+    prettytrace.set_idle_tracer(_watch_tracer)
+    threading.settrace(_watch_tracer)
+    if hasattr(threading, "settrace_all_threads"):
+        # python 3.12+: the threads that are running already get the watcher too.
+        threading.settrace_all_threads(_watch_tracer)
+    elif getattr(prettytrace.local_data_, "trace_ctx", None) is None:
+        sys.settrace(_watch_tracer)
+
+def _uninstall_watcher():
+    prettytrace.set_idle_tracer(None)
+    threading.settrace(None)
+    if sys.gettrace() is _watch_tracer:
+        sys.settrace(None)
+
+
+def attach_trace(*targets, duration : float = None, max_events : int = None, **trace_args):
+    """trace the calls of the targets from now on, until detach() is called on the returned TraceAttachment.
+
+    targets    - names of the form package.module:Class.method, functions, methods, classes (all methods) or code objects.
+                 Unlike trace_by_name, nothing is replaced: calls through references that were taken earlier are traced as well.
+    duration   - detach after this number of seconds
+    max_events - detach after this number of trace events (the current trace stops sending events right away)
+    the other keyword arguments are the fields of TraceParam, as for TraceMe (except capture: attached calls are always traced).
+
+    The watcher is installed in the calling thread and in threads started later; with python 3.12+ in all running threads.
+    It replaces the trace function of the thread (debuggers and coverage tools don't see the code while something is attached).
+    """
+    trace_param = prettytrace._trace_param_from_args(trace_args)
+    if trace_param.capture is not None:
+        raise ValueError("attach_trace doesn't support capture mode, use trace_by_name")
+
+    # set up the opcode tables now, this can't be done from within the watcher.
+    prettytrace._ensure_init()
+
+    codes = []
+    for target in targets:
+        codes.extend( _get_codes(target) )
+    if not codes:
+        raise ValueError("nothing to attach to")
+
+    # the consumers are made here, shared by all threads: the event limit counts the events of the consumers that write the trace.
+    consumers = prettytrace._make_output_consumers(trace_param)
+    if any(consumer.event_kinds is None for consumer in consumers):
+        event_kinds = None
+    else:
+        event_kinds = frozenset().union(*[ consumer.event_kinds for consumer in consumers ])
+
+    trace_param = dataclasses.replace(trace_param, consumers=consumers)
+    attachment = TraceAttachment(codes, trace_param, duration, max_events)
+    consumers.append( _EventLimit(attachment, event_kinds) )
+
+    with _LOCK:
+        if not _TARGETS:
+            _install_watcher()
+        for code in codes:
+            _TARGETS[ code ] = attachment
+        attachment.active = True
+    if attachment.timer is not None:
+        attachment.timer.start()
+    return attachment
+
+
+def detach_all():
+    """detach all attachments"""
+    with _LOCK:
+        attachments = set(_TARGETS.values())
+    for attachment in attachments:
+        attachment.detach()
@@ -0,0 +1,216 @@
+"""call graph mode: counts the calls and the time of each caller -> callee edge of the traced code. The result can be written
+as a pstats file (python -m pstats, snakeviz, gprof2dot) or as a graphviz dot file."""
+
+import sys
+import time
+import marshal
+import threading
+
+from .prettytrace import TraceConsumer, TraceRecord
+
+__all__ = [ "CallGraph" ]
+
+
+# calls and time of a function, or of a caller -> callee edge.
+class _CallStats:
+    __slots__ = ("calls", "prim_calls", "own_ns", "total_ns", "active")
+
+    def __init__(self):
+        self.calls = 0
+        # calls that are not recursive (the function/edge is not active already)
+        self.prim_calls = 0
+        self.own_ns = 0
+        self.total_ns = 0
+        # number of active calls in all threads
+        self.active = 0
+
+    def add(self, elapsed_ns, own_ns, recursive):
+        self.calls += 1
+        self.own_ns += own_ns
+        if not recursive:
+            self.prim_calls += 1
+            self.total_ns += elapsed_ns
+
+    # entry of a function in pstats.Stats.stats
+    def pstats_entry(self):
+        return (self.prim_calls, self.calls, self.own_ns / 1e9, self.total_ns / 1e9)
+
+    # entry of a caller in the callers of a function: calls and primitive calls are the other way round
+    def pstats_caller_entry(self):
+        return (self.calls, self.prim_calls, self.own_ns / 1e9, self.total_ns / 1e9)
+
+
+def _add_entries(entry, other):
+    return tuple( a + b for a, b in zip(entry, other) )
+
+
+# an active call in the stack of a thread
+class _Activation:
+    __slots__ = ("code", "caller", "start_ns", "child_ns", "func_recursive", "edge_recursive")
+
+    def __init__(self, code, caller, start_ns, func_recursive, edge_recursive):
+        self.code = code
+        self.caller = caller
+        self.start_ns = start_ns
+        self.child_ns = 0
+        self.func_recursive = func_recursive
+        self.edge_recursive = edge_recursive
+
+
+def _func_key(code):
+    return (code.co_filename, code.co_firstlineno, getattr(code, "co_qualname", code.co_name))
+
+
+class CallGraph(TraceConsumer):
+    """records the call graph of the traced code, instead of printing the trace; pass it in the consumers parameter
+    of TraceMe/TraceClass (consumers=[ CallGraph() ]).
+
+    For each function: number of calls, own time and cumulative time; for each caller -> callee edge: the same, for the calls
+    from that caller. Recursive calls count for the own time, the cumulative time is that of the outermost call (like cProfile).
+    Each resume of a generator or coroutine counts as a call. Times are taken when the trace events arrive, so they include
+    the overhead of the tracer (line events are traced as well, opcodes are not).
+
+    top         - number of functions shown in the report
+    out         - the report is written here, when the outermost traced function returns (None - no report, call show_report)
+    pstats_file - write the pstats file here, when the outermost traced function returns
+    dot_file    - write the graphviz dot file here, when the outermost traced function returns
+    """
+
+    wants_values = False
+    event_kinds = frozenset(( "call", "return", "resume", "yield" ))
+
+    def __init__(self, *, top : int = 20, out = sys.stderr, pstats_file : str = None, dot_file : str = None):
+        self.top = top
+        self.out = out
+        self.pstats_file = pstats_file
+        self.dot_file = dot_file
+        # code object -> _CallStats
+        self.funcs = {}
+        # (caller code object, callee code object) -> _CallStats; the caller is None for the outermost traced call.
+        self.edges = {}
+        self.local = threading.local()
+
+    def _get_stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = []
+            self.local.stack = stack
+        return stack
+
+    def on_event(self, rec : TraceRecord):
+        now = time.perf_counter_ns()
+        stack = self._get_stack()
+        kind = rec.kind
+
+        if kind == "call" or kind == "resume":
+            code = rec.code
+            caller = stack[-1].code if stack else None
+
+            func = self.funcs.get(code, None)
+            if func is None:
+                func = _CallStats()
+                self.funcs[ code ] = func
+            edge = self.edges.get((caller, code), None)
+            if edge is None:
+                edge = _CallStats()
+                self.edges[ (caller, code) ] = edge
+
+            stack.append( _Activation(code, caller, now, func.active != 0, edge.active != 0) )
+            func.active += 1
+            edge.active += 1
+            return
+
+        # return or yield
+        if not stack:
+            return
+        act = stack.pop()
+        elapsed = now - act.start_ns
+        own = elapsed - act.child_ns
+
+        func = self.funcs[ act.code ]
+        func.active -= 1
+        func.add(elapsed, own, act.func_recursive)
+        edge = self.edges[ (act.caller, act.code) ]
+        edge.active -= 1
+        edge.add(elapsed, own, act.edge_recursive)
+
+        if stack:
+            stack[-1].child_ns += elapsed
+
+    def on_end(self):
+        self.local.stack = None
+        if self.pstats_file is not None:
+            self.dump_stats(self.pstats_file)
+        if self.dot_file is not None:
+            self.write_dot(self.dot_file)
+        if self.out is not None:
+            self.show_report(self.out)
+
+    def get_ranking(self):
+        """returns (code object, _CallStats) of all functions, ordered by cumulative time"""
+        return sorted(self.funcs.items(), key=lambda entry: entry[1].total_ns, reverse=True)
+
+    def get_stats(self):
+        """returns the call graph in the format of pstats.Stats.stats:
+        (file, line, function) -> (primitive calls, calls, own time, cumulative time, callers),
+        callers is (file, line, function) -> (calls, primitive calls, own time, cumulative time) of the calls from that caller.
+        Code objects with the same (file, line, function) are added up (for example a function that is defined again)."""
+        stats = {}
+        for code, func in self.funcs.items():
+            key = _func_key(code)
+            entry = stats.get(key, None)
+            stats[ key ] = func.pstats_entry() + ({},) if entry is None else _add_entries(entry[ : 4 ], func.pstats_entry()) + (entry[4],)
+        for (caller, code), edge in self.edges.items():
+            if caller is not None:
+                callers = stats[ _func_key(code) ][4]
+                caller_key = _func_key(caller)
+                entry = callers.get(caller_key, None)
+                callers[ caller_key ] = edge.pstats_caller_entry() if entry is None else _add_entries(entry, edge.pstats_caller_entry())
+        return stats
+
+    def dump_stats(self, file_name : str):
+        """write the call graph as a pstats file: load it with pstats.Stats(file_name), python -m pstats, snakeviz or gprof2dot -f pstats"""
+        with open(file_name, "wb") as file:
+            marshal.dump(self.get_stats(), file)
+
+    def write_dot(self, file_name : str, min_fraction : float = 0.0):
+        """write the call graph as graphviz dot file; functions with less than min_fraction of the cumulative time of the
+        slowest function are left out"""
+        ranking = self.get_ranking()
+        max_ns = ranking[0][1].total_ns if ranking else 0
+        shown = set( code for code, func in ranking if max_ns == 0 or func.total_ns >= min_fraction * max_ns )
+        node_ids = {}
+
+        with open(file_name, "w", encoding="utf-8") as file:
+            print("digraph callgraph {", file=file)
+            print("    node [shape=box];", file=file)
+            for code, func in ranking:
+                if code not in shown:
+                    continue
+                node_id = f"n{len(node_ids)}"
+                node_ids[ code ] = node_id
+                file_path, lineno, name = _func_key(code)
+                label = f"{name}\\n{file_path}:{lineno}\\n{func.calls} calls\\ntotal: {func.total_ns / 1e6:.3f} ms own: {func.own_ns / 1e6:.3f} ms"
+                print(f"    {node_id} [label=\"{_dot_escape(label)}\"];", file=file)
+            for (caller, code), edge in self.edges.items():
+                if caller in node_ids and code in node_ids:
+                    label = f"{edge.calls}x {edge.total_ns / 1e6:.3f} ms"
+                    print(f"    {node_ids[caller]} -> {node_ids[code]} [label=\"{label}\"];", file=file)
+            print("}", file=file)
+
+    def show_report(self, out = sys.stderr):
+        ranking = self.get_ranking()
+        print(f"# call graph: top {min(self.top, len(ranking))} of {len(ranking)} functions by cumulative time", file=out)
+        for code, func in ranking[ : self.top ]:
+            file_path, lineno, name = _func_key(code)
+            calls = str(func.calls) if func.calls == func.prim_calls else f"{func.calls}/{func.prim_calls}"
+            print(f"{name} ({file_path}:{lineno}) # calls: {calls} total: {func.total_ns / 1e6:.3f} ms own: {func.own_ns / 1e6:.3f} ms", file=out)
+            callers = sorted(( (caller, edge) for (caller, callee), edge in self.edges.items() if callee is code and caller is not None ),
+                             key=lambda entry: entry[1].total_ns, reverse=True)
+            for caller, edge in callers:
+                print(f"    <- {_func_key(caller)[2]} # calls: {edge.calls} total: {edge.total_ns / 1e6:.3f} ms", file=out)
+
+
+def _dot_escape(label):
+    # the \n line breaks of the label are kept.
+    return label.replace("\"", "\\\"")
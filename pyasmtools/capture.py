@@ -0,0 +1,262 @@
+"""capture mode: instead of tracing, the arguments of the calls of decorated functions are pickled to a file (sampled, size limited).
+A captured call can be replayed later, under the full trace (replay, or: python -m pyasmtools replay capture_file)"""
+
+import os
+import sys
+import ast
+import time
+import random
+import pickle
+import struct
+import inspect
+import threading
+import dataclasses
+import typing
+
+__all__ = [ "ArgCapture", "CapturedCall", "read_captures", "replay" ]
+
+# each record in the capture file: 4 byte length (big endian), followed by the pickled record dictionary
+_LEN = struct.Struct(">I")
+
+
+@dataclasses.dataclass
+class CapturedCall:
+    # position of the record in the capture file
+    index: int
+    # name of the called function, of the form package.module:Class.method
+    func: str
+    # source file of the module of the function (needed to load functions of __main__)
+    module_file: typing.Optional[str]
+    time: float
+    pid: int
+    # repr of the exception raised by the call, None if it returned normally
+    error: typing.Optional[str]
+    # pickled tuple (args, kwargs)
+    args_pickle: bytes
+
+    def load_args(self):
+        """returns tuple (args, kwargs) of the call; the classes of the arguments must be importable"""
+        return pickle.loads(self.args_pickle)
+
+
+class ArgCapture:
+    """pass as capture parameter of TraceMe/TraceClass: the decorated calls are not traced, a sample of them is written to file_name,
+    with the pickled arguments.
+
+    sample_rate - fraction of the calls that are captured (0.0 - 1.0)
+    max_size    - calls with pickled arguments larger than this number of bytes are not captured
+    max_records - stop capturing after this number of records (None - no limit)
+
+    The arguments are pickled before the call (the function may change them), the record is written after the call, so that it
+    says if the call raised an exception. Calls whose arguments can't be pickled are counted in num_failed. Records are appended
+    to the file, each process opens it on its first capture.
+    """
+
+    def __init__(self, file_name : str, *, sample_rate : float = 1.0, max_size : int = 64 * 1024, max_records : int = None):
+        self.file_name = file_name
+        self.sample_rate = sample_rate
+        self.max_size = max_size
+        self.max_records = max_records
+        self.num_records = 0
+        self.num_too_large = 0
+        self.num_failed = 0
+        self.lock = threading.Lock()
+        self.file = None
+        self.pid = None
+        # function -> (name, module file)
+        self.func_names = {}
+
+    def _get_name(self, func):
+        entry = self.func_names.get(func, None)
+        if entry is None:
+            module = sys.modules.get(func.__module__, None)
+            entry = (f"{func.__module__}:{func.__qualname__}", getattr(module, "__file__", None))
+            self.func_names[ func ] = entry
+        return entry
+
+    def _write(self, record):
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if self.pid != os.getpid():
+                # first capture in this process (a forked child must not share the file object of the parent)
+                self.file = open(self.file_name, "ab")
+                self.pid = os.getpid()
+            self.file.write(_LEN.pack(len(data)))
+            self.file.write(data)
+            self.file.flush()
+
+    def call(self, func, args, kwargs):
+        """call func(*args, **kwargs); captures the call, if it is sampled"""
+        if (self.sample_rate < 1.0 and random.random() >= self.sample_rate) or (self.max_records is not None and self.num_records >= self.max_records):
+            return func(*args, **kwargs)
+
+        try:
+            args_pickle = pickle.dumps((args, kwargs), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            with self.lock:
+                self.num_failed += 1
+            return func(*args, **kwargs)
+        if len(args_pickle) > self.max_size:
+            with self.lock:
+                self.num_too_large += 1
+            return func(*args, **kwargs)
+
+        # checked again: other threads may have taken the last records in the meantime.
+        with self.lock:
+            full = self.max_records is not None and self.num_records >= self.max_records
+            if not full:
+                self.num_records += 1
+        if full:
+            return func(*args, **kwargs)
+
+        name, module_file = self._get_name(func)
+        record = { "func" : name, "module_file" : module_file, "time" : time.time(), "pid" : os.getpid(), "error" : None, "args" : args_pickle }
+        try:
+            return func(*args, **kwargs)
+        except BaseException as ex:
+            record[ "error" ] = repr(ex)
+            raise
+        finally:
+            self._write(record)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None and self.pid == os.getpid():
+                self.file.close()
+            self.file = None
+            self.pid = None
+
+
+def read_captures(file_name : str):
+    """yields the CapturedCall records of a capture file (an incomplete record at the end of the file is skipped)"""
+    with open(file_name, "rb") as file:
+        index = 0
+        while True:
+            header = file.read(_LEN.size)
+            if len(header) < _LEN.size:
+                return
+            data = file.read(_LEN.unpack(header)[0])
+            try:
+                record = pickle.loads(data)
+            except (EOFError, pickle.UnpicklingError):
+                return
+            yield CapturedCall(index, record[ "func" ], record[ "module_file" ], record[ "time" ], record[ "pid" ], record[ "error" ], record[ "args" ])
+            index += 1
+
+
+# top level statements of a script, that may run again for a replay: definitions, imports, assignments (and if/try blocks made of these)
+_DEFINITION_NODES = (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Assign, ast.AnnAssign, ast.Pass)
+
+def _is_main_guard(node):
+    # if __name__ == "__main__":
+    test = node.test
+    if not isinstance(test, ast.Compare) or len(test.ops) != 1 or not isinstance(test.ops[0], ast.Eq):
+        return False
+    operands = [ test.left, test.comparators[0] ]
+    return any(isinstance(op, ast.Name) and op.id == "__name__" for op in operands) and any(isinstance(op, ast.Constant) and op.value == "__main__" for op in operands)
+
+# returns the first top level statement of a script, that is not a definition (the main code of the script), None if all of it is guarded
+def _find_unguarded_statement(statements):
+    for node in statements:
+        if isinstance(node, _DEFINITION_NODES):
+            continue
+        if isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant):
+            # docstring
+            continue
+        if isinstance(node, ast.If):
+            if _is_main_guard(node):
+                continue
+            found = _find_unguarded_statement(node.body) or _find_unguarded_statement(node.orelse)
+        elif isinstance(node, ast.Try):
+            found = _find_unguarded_statement(node.body) or _find_unguarded_statement(node.orelse) or _find_unguarded_statement(node.finalbody)
+            for handler in node.handlers:
+                found = found or _find_unguarded_statement(handler.body)
+        else:
+            found = node
+        if found is not None:
+            return found
+    return None
+
+
+# the statements without the if __name__ == "__main__": statements (at the levels that are looked at by _find_unguarded_statement)
+def _strip_main_guards(statements):
+    ret = []
+    for node in statements:
+        if isinstance(node, ast.If):
+            if _is_main_guard(node):
+                # the else branch didn't run either, in the captured run.
+                continue
+            node.body = _strip_main_guards(node.body) or [ ast.copy_location(ast.Pass(), node) ]
+            node.orelse = _strip_main_guards(node.orelse)
+        elif isinstance(node, ast.Try):
+            node.body = _strip_main_guards(node.body) or [ ast.copy_location(ast.Pass(), node) ]
+            node.orelse = _strip_main_guards(node.orelse)
+            node.finalbody = _strip_main_guards(node.finalbody)
+            for handler in node.handlers:
+                handler.body = _strip_main_guards(handler.body) or [ ast.copy_location(ast.Pass(), handler) ]
+        ret.append(node)
+    return ret
+
+# load the script of a function that was captured in __main__. The whole script is executed again as __main__, without its
+# if __name__ == "__main__": blocks. Scripts with other top level code are refused.
+def _load_main_module(module_file):
+    import types
+
+    with open(module_file, "rb") as file:
+        source = file.read()
+    tree = ast.parse(source, module_file)
+    unguarded = _find_unguarded_statement(tree.body)
+    if unguarded is not None:
+        raise ValueError(f"can't replay a function of {module_file}: the script has top level code at line {unguarded.lineno}, that would run again. "
+                         "Move it into an if __name__ == \"__main__\": block, or move the function into a module")
+    # the name stays __main__, so that the classes of the script are shown as in the captured run.
+    tree.body = _strip_main_guards(tree.body)
+    code = compile(tree, module_file, "exec")
+    module = types.ModuleType("__main__")
+    module.__file__ = module_file
+    module.__builtins__ = __builtins__
+    # pickled arguments of classes defined in the script refer to __main__ (the module stays in place for the replay)
+    sys.modules[ "__main__" ] = module
+    sys.path.insert(0, os.path.dirname(os.path.abspath(module_file)))
+    exec(code, module.__dict__)
+    return module
+
+
+def _resolve_captured(call : CapturedCall):
+    from . import prettytrace
+
+    module_name, attr_path = call.func.split(":", 1)
+    if "<locals>" in attr_path:
+        raise ValueError(f"can't replay {call.func}: nested functions can't be looked up")
+
+    if module_name == "__main__":
+        if call.module_file is None:
+            raise ValueError(f"can't replay {call.func}: source file of __main__ is not known")
+        owner = _load_main_module(call.module_file)
+        for attr in attr_path.split("."):
+            owner = inspect.getattr_static(owner, attr) if inspect.isclass(owner) else getattr(owner, attr)
+        val = owner
+    else:
+        _, _, val = prettytrace._resolve_name(call.func)
+
+    if isinstance(val, (staticmethod, classmethod)):
+        val = val.__func__
+    # the function is decorated with TraceMe/TraceClass; the replay calls the undecorated function, so that it isn't captured again.
+    return inspect.unwrap(val)
+
+
+def replay(call : CapturedCall, **trace_args):
+    """calls the function of a captured call with the captured arguments, and traces it; returns the return value of the call.
+    The keyword arguments are the fields of TraceParam, as for TraceMe. The function is looked up by name, its module must be importable.
+    Functions of the main script: the script is executed again, without its if __name__ == "__main__": blocks. This is refused
+    (ValueError) if the script has other top level code than definitions, imports and assignments; the assignments do run again."""
+    from . import prettytrace
+
+    return _replay_call(call, prettytrace._trace_param_from_args(trace_args))
+
+def _replay_call(call, trace_param):
+    from . import prettytrace
+
+    func = _resolve_captured(call)
+    args, kwargs = call.load_args()
+    return prettytrace._make_trace_wrapper(func, trace_param)(*args, **kwargs)
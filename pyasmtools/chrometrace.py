@@ -0,0 +1,91 @@
+"""trace consumer that writes call timelines in the Chrome Trace Event Format (can be opened in chrome://tracing or https://ui.perfetto.dev)"""
+
+import os
+import json
+import time
+import threading
+from .prettytrace import TraceConsumer, TraceRecord, format_value
+
+__all__ = [ "ChromeTraceConsumer" ]
+
+_STORE_KINDS = frozenset(( "store", "store_attr", "store_subscr", "store_global" ))
+
+class ChromeTraceConsumer(TraceConsumer):
+    """writes a begin/end slice for each traced call, per thread. The events are written while tracing, one json object per line.
+
+    out            - file name or text stream, the file is opened and closed by the consumer, if a name is given.
+    instant_events - names of variables/attributes, a store to these is written as an instant event (with the stored value). True for all stores.
+    show_obj       - how to format values of instant events (same as for TraceMe)
+    """
+
+    def __init__(self, out, *, instant_events = None, show_obj : int = 1):
+        if isinstance(out, str):
+            self.out = open(out, "w", encoding="utf-8")
+            self.close_out = True
+        else:
+            self.out = out
+            self.close_out = False
+        self.show_obj = show_obj
+        self.instant_events = instant_events
+        self.wants_values = instant_events is not None
+        # a generator gets a slice for each time it runs (from resume to yield).
+        if instant_events is None:
+            self.event_kinds = frozenset(( "call", "return", "resume", "yield" ))
+        else:
+            self.event_kinds = frozenset(( "call", "return", "resume", "yield" )) | _STORE_KINDS
+        self.pid = os.getpid()
+        self.start_time = time.perf_counter_ns()
+        self.lock = threading.Lock()
+        self.separator = ""
+
+        # the json array format doesn't require the closing ], so that a trace is usable even if the process didn't finish.
+        self.out.write("[\n")
+
+    def _timestamp(self):
+        return (time.perf_counter_ns() - self.start_time) / 1000.0
+
+    def _write(self, entry):
+        line = json.dumps(entry)
+        with self.lock:
+            if self.out is None:
+                # closed
+                return
+            self.out.write(self.separator)
+            self.out.write(line)
+            self.separator = ",\n"
+
+    def on_event(self, rec : TraceRecord):
+        kind = rec.kind
+        if kind == "call" or kind == "resume":
+            code = rec.code
+            self._write({ "name" : getattr(code, "co_qualname", code.co_name), "cat" : "call", "ph" : "B", "ts" : self._timestamp(),
+                          "pid" : self.pid, "tid" : threading.get_ident(), "args" : { "file" : rec.bname, "line" : code.co_firstlineno, "nesting" : rec.nesting } })
+        elif kind == "return" or kind == "yield":
+            code = rec.code
+            self._write({ "name" : getattr(code, "co_qualname", code.co_name), "cat" : "call", "ph" : "E", "ts" : self._timestamp(),
+                          "pid" : self.pid, "tid" : threading.get_ident() })
+        elif self.instant_events is True or rec.name in self.instant_events:
+            if rec.kind == "store_subscr":
+                name = f"{rec.title}[{repr(rec.key)}]"
+            else:
+                name = rec.name
+            self._write({ "name" : f"{kind} {name}", "cat" : "store", "ph" : "i", "s" : "t", "ts" : self._timestamp(),
+                          "pid" : self.pid, "tid" : threading.get_ident(),
+                          "args" : { "value" : format_value(rec.value, self.show_obj), "location" : rec.location() } })
+
+    def on_end(self):
+        with self.lock:
+            if self.out is not None:
+                self.out.flush()
+
+    def close(self):
+        """write the end of the json array, and close the file (if it was opened by the consumer)"""
+        with self.lock:
+            if self.out is None:
+                return
+            self.out.write("\n]\n")
+            if self.close_out:
+                self.out.close()
+            else:
+                self.out.flush()
+            self.out = None
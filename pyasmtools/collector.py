@@ -0,0 +1,305 @@
+"""collector process for traces sent by SocketTraceConsumer/SocketSink (see socketsink.py): receives the trace records of several
+processes over a unix domain socket, formats them and writes each trace, compressed and rotated, to <out_dir>/<prefix>.<pid>
+(the naming of procpool.py, so that python -m pyasmtools merge <out_dir> prints them)
+
+    python -m pyasmtools.collector --socket /tmp/pyasmtools-collector.sock --out-dir traces
+    python -m pyasmtools.collector --out-dir traces --import fallback.1234     - convert a fallback file of SocketTraceConsumer
+"""
+
+import os
+import sys
+import signal
+import linecache
+import argparse
+import threading
+import socketserver
+import dataclasses
+import typing
+
+from .prettytrace import TextTraceConsumer, TraceRecord
+from .sinks import RotatingFileSink
+from .socketsink import KINDS, REC_HELLO, REC_CODE, REC_EVENT, REC_TEXT, REC_END, BATCH_HEADER, HELLO_HEADER, CODE_HEADER, CODE_LINES, EVENT_HEADER, STR_LEN, NONE_LEN, DEFAULT_SOCKET_PATH
+
+__all__ = [ "Collector" ]
+
+
+# stands in for the code object of the traced process
+@dataclasses.dataclass
+class _RemoteCode:
+    co_filename: str
+    co_name: str
+    co_qualname: str
+    co_firstlineno: int
+    # first line of the function body
+    body_line: int
+
+
+# text trace consumer for events, whose values have been formatted by the traced process. The detail field of the event is passed in title.
+class _RemoteTextConsumer(TextTraceConsumer):
+    def on_call(self, rec):
+        # the lines of the function header (def, decorators)
+        for line_num in range(rec.code.co_firstlineno, rec.code.body_line):
+            line = linecache.getline(rec.filename, line_num)
+            print(f"{self.get_line_prefix(rec, 0)} {line}", end="", file=self.out)
+
+    def on_event(self, rec : TraceRecord):
+        kind = rec.kind
+        if kind == "line":
+            self.on_line(rec)
+        elif kind == "call":
+            self.on_call(rec)
+        elif kind == "arg":
+            if rec.value is not None:
+                print(f"{self.get_line_prefix(rec, 1)} # {rec.name}={rec.value}", file=self.out)
+        elif kind == "return" or kind == "yield":
+            print(f"{self.get_line_prefix(rec, 1)} {kind}={rec.value}", file=self.out)
+        elif kind == "resume":
+            print(f"{self.get_line_prefix(rec, 1)} # resume {rec.code.co_qualname}", file=self.out)
+        else:
+            self.on_opcode_event(rec)
+
+    def on_opcode_event(self, rec):
+        kind = rec.kind
+        prefix = self.get_line_prefix(rec, 1)
+        sval = rec.value
+
+        if kind in ("load", "store"):
+            print(f"{prefix} # {kind} {rec.name} {sval}", file=self.out)
+        elif kind in ("load_global", "store_global"):
+            print(f"{prefix} # {kind} {rec.name} {sval} (type: {rec.title})", file=self.out)
+        elif kind == "load_subscr":
+            print(f"{prefix} # load {rec.title} {sval}", file=self.out)
+        elif kind == "store_subscr":
+            print(f"{prefix} # store {rec.title}={sval}", file=self.out)
+        elif kind == "load_attr":
+            print(f"{prefix} # load_attr {rec.title}.{rec.name} {sval}", file=self.out)
+        elif kind == "store_attr":
+            print(f"{prefix} # store_attr {rec.title}.{rec.name}={sval}", file=self.out)
+
+
+class _ProtocolError(Exception):
+    pass
+
+def _read_str(data, pos):
+    length = STR_LEN.unpack_from(data, pos)[0]
+    pos += STR_LEN.size
+    if length == NONE_LEN:
+        return None, pos
+    if pos + length > len(data):
+        raise _ProtocolError("string exceeds the batch")
+    return data[ pos : pos + length ].decode("utf-8", errors="replace"), pos + length
+
+
+# trace file of a process, shared by all connections of the process
+class _ProcessTrace:
+    def __init__(self, sink):
+        self.sink = sink
+        self.lock = threading.Lock()
+        self.num_connections = 0
+
+
+# state of one connection (or fallback file): the code table and the formatter
+class _Session:
+    def __init__(self, collector):
+        self.collector = collector
+        self.trace = None
+        self.pid = None
+        self.codes = {}
+        self.formatter = None
+
+    def on_batch(self, data):
+        pos = 0
+        if self.trace is None:
+            if not data or data[0] != REC_HELLO:
+                raise _ProtocolError("connection doesn't start with a hello record")
+            self.pid = HELLO_HEADER.unpack_from(data, 0)[1]
+            name, pos = _read_str(data, HELLO_HEADER.size)
+            self.trace = self.collector.open_trace(self.pid, name)
+            self.formatter = _RemoteTextConsumer(self.trace.sink, show_obj=0)
+
+        with self.trace.lock:
+            while pos < len(data):
+                pos = self._on_record(data, pos)
+
+    def _on_record(self, data, pos):
+        rec_type = data[pos]
+        if rec_type == REC_EVENT:
+            _, kind, code_id, lineno, nesting = EVENT_HEADER.unpack_from(data, pos)
+            name, pos = _read_str(data, pos + EVENT_HEADER.size)
+            value, pos = _read_str(data, pos)
+            detail, pos = _read_str(data, pos)
+            code = self.codes.get(code_id, None)
+            if code is None:
+                raise _ProtocolError(f"event refers to unknown code {code_id}")
+            self.formatter.on_event(TraceRecord(KINDS[ kind ], code.co_filename, os.path.basename(code.co_filename), lineno, nesting, code, -1, name=name, value=value, title=detail))
+        elif rec_type == REC_TEXT:
+            text, pos = _read_str(data, pos + 1)
+            self.trace.sink.write(text)
+        elif rec_type == REC_CODE:
+            code_id = CODE_HEADER.unpack_from(data, pos)[1]
+            file_name, pos = _read_str(data, pos + CODE_HEADER.size)
+            qualname, pos = _read_str(data, pos)
+            firstlineno, body_line = CODE_LINES.unpack_from(data, pos)
+            pos += CODE_LINES.size
+            self.codes[ code_id ] = _RemoteCode(file_name, qualname.rsplit(".", 1)[-1], qualname, firstlineno, body_line)
+        elif rec_type == REC_END:
+            self.formatter.on_end()
+            pos += 1
+        elif rec_type == REC_HELLO:
+            # start of a fallback file that was appended to by a later run of the same process id.
+            self.codes.clear()
+            _, pos = _read_str(data, pos + HELLO_HEADER.size)
+        else:
+            raise _ProtocolError(f"unknown record type {rec_type}")
+        return pos
+
+    def close(self):
+        if self.trace is not None:
+            self.collector.close_trace(self.pid, self.trace)
+            self.trace = None
+
+
+# reads the batches from a file object; returns False if the stream ended in the middle of a batch
+def _read_batches(file, session):
+    while True:
+        header = file.read(BATCH_HEADER.size)
+        if len(header) < BATCH_HEADER.size:
+            return len(header) == 0
+        length = BATCH_HEADER.unpack(header)[0]
+        data = file.read(length)
+        if len(data) < length:
+            return False
+        session.on_batch(data)
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    # connections of processes that don't end don't keep the collector from exiting
+    daemon_threads = True
+
+
+class Collector:
+    """receives traces on a unix domain socket and writes them to <out_dir>/<prefix>.<pid>, with RotatingFileSink.
+    A trace file is closed when the last connection of its process is closed.
+
+    socket_path  - path of the unix domain socket (a stale socket file is removed)
+    out_dir      - directory of the trace files
+    prefix       - prefix of the trace file names
+    compression, max_bytes, max_segments - passed to RotatingFileSink
+    verbose      - report connections on standard error
+    """
+
+    def __init__(self, out_dir : str, *, socket_path : str = DEFAULT_SOCKET_PATH, prefix : str = "trace", compression : typing.Optional[str] = "gzip",
+                 max_bytes : int = 64 * 1024 * 1024, max_segments : typing.Optional[int] = 16, verbose : bool = False):
+        self.out_dir = out_dir
+        self.socket_path = socket_path
+        self.prefix = prefix
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_segments = max_segments
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        # pid -> _ProcessTrace
+        self.traces = {}
+        self.server = None
+
+    def open_trace(self, pid, name):
+        with self.lock:
+            trace = self.traces.get(pid, None)
+            if trace is None:
+                sink = RotatingFileSink(os.path.join(self.out_dir, f"{self.prefix}.{pid}"), compression=self.compression, max_bytes=self.max_bytes, max_segments=self.max_segments)
+                trace = _ProcessTrace(sink)
+                self.traces[ pid ] = trace
+            trace.num_connections += 1
+        if self.verbose:
+            print(f"collector: pid {pid} connected: {name}", file=sys.stderr)
+        return trace
+
+    def close_trace(self, pid, trace):
+        with self.lock:
+            trace.num_connections -= 1
+            if trace.num_connections == 0:
+                trace.sink.close()
+                if self.traces.get(pid, None) is trace:
+                    del self.traces[ pid ]
+                    if self.verbose:
+                        print(f"collector: pid {pid} done", file=sys.stderr)
+            else:
+                trace.sink.flush()
+
+    def import_file(self, file_name : str):
+        """write the trace of a fallback file of SocketTraceConsumer"""
+        session = _Session(self)
+        try:
+            with open(file_name, "rb") as file:
+                if not _read_batches(file, session):
+                    print(f"collector: {file_name} ends with an incomplete batch", file=sys.stderr)
+        finally:
+            session.close()
+
+    def serve_forever(self):
+        collector = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                session = _Session(collector)
+                try:
+                    _read_batches(self.rfile, session)
+                except (_ProtocolError, OSError, ValueError) as ex:
+                    # ValueError: the trace file was closed, the collector is shutting down.
+                    print(f"collector: connection closed: {ex}", file=sys.stderr)
+                finally:
+                    session.close()
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = _Server(self.socket_path, Handler)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(self.socket_path)
+            self.close()
+
+    def shutdown(self):
+        # serve_forever runs in the main thread; shutdown waits for it to stop, so it is called from another thread.
+        if self.server is not None:
+            threading.Thread(target=self.server.shutdown).start()
+
+    def close(self):
+        with self.lock:
+            for trace in self.traces.values():
+                trace.sink.close()
+            self.traces.clear()
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m pyasmtools.collector", description="collect traces sent by SocketTraceConsumer/SocketSink, write them compressed to a directory")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help=f"path of the unix domain socket. Default: {DEFAULT_SOCKET_PATH}")
+    parser.add_argument("--out-dir", required=True, help="directory of the trace files (<prefix>.<pid>.<segment>.gz)")
+    parser.add_argument("--prefix", default="trace", help="prefix of the trace files")
+    parser.add_argument("--compression", choices=[ "gzip", "zstd", "none" ], default="gzip", help="compression of the trace files")
+    parser.add_argument("--max-bytes", type=int, default=64 * 1024 * 1024, help="start a new segment after this number of (uncompressed) bytes")
+    parser.add_argument("--max-segments", type=int, default=16, help="number of segments kept per process (0: keep all)")
+    parser.add_argument("--import", dest="import_files", action="append", metavar="FILE", help="convert this fallback file of SocketTraceConsumer and exit. Can be repeated")
+    parser.add_argument("--verbose", action="store_true", help="report connections")
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = _parse_args(argv)
+    collector = Collector(args.out_dir, socket_path=args.socket, prefix=args.prefix, compression=None if args.compression == "none" else args.compression,
+                          max_bytes=args.max_bytes, max_segments=args.max_segments if args.max_segments != 0 else None, verbose=args.verbose)
+    if args.import_files:
+        for file_name in args.import_files:
+            collector.import_file(file_name)
+        return 0
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: collector.shutdown())
+    try:
+        collector.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
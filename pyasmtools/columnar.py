@@ -0,0 +1,273 @@
+"""columnar trace export: the events are written as columns (event kind, code id, line, nesting, timestamp, thread id, name and value index),
+in chunks while tracing, to a numpy .npz file or to an arrow stream. Analysis of the trace is then done with vectorized operations
+(numpy, pandas, polars, duckdb), instead of parsing text lines.
+
+    consumer = ColumnarTraceConsumer("trace.npz")
+    ... trace with consumers=[ consumer ] ...
+    consumer.close()
+
+    trace = read_columnar("trace.npz")      # requires numpy
+    hot_lines = numpy.unique(trace.events["line"][ trace.events["kind"] == trace.kinds.index("line") ], return_counts=True)
+"""
+
+import sys
+import time
+import array
+import zipfile
+import threading
+import dataclasses
+import typing
+
+from .prettytrace import TraceConsumer, TraceRecord, EVENT_KINDS, format_value
+
+try:
+    import pyarrow
+    _ARROW_ENABLED = True
+except ImportError:
+    _ARROW_ENABLED = False
+
+__all__ = [ "ColumnarTraceConsumer", "ColumnarTrace", "read_columnar" ]
+
+# index of the kind column -> event kind
+KINDS = tuple(sorted(EVENT_KINDS))
+_KIND_INDEX = { kind : pos for pos, kind in enumerate(KINDS) }
+
+# columns of the event table: name, array typecode, numpy type character
+_COLUMNS = (
+    ( "kind", "B", "u" ),       # index into KINDS
+    ( "code", "I", "u" ),       # index into the code table (file, function name, first line)
+    ( "line", "i", "i" ),
+    ( "nesting", "i", "i" ),
+    ( "time", "q", "i" ),       # time.perf_counter_ns() when the event arrived
+    ( "thread", "Q", "u" ),     # threading.get_ident()
+    ( "name", "i", "i" ),       # index into the string table, -1 if the event has no name
+    ( "value", "i", "i" ),      # index into the string table, -1 if the event has no value
+)
+
+# the string table is written in chunks; the map from strings to their index is cleared when it gets this large (values are then stored again)
+_MAX_STRING_INDEX = 100000
+
+_BYTE_ORDER = "<" if sys.byteorder == "little" else ">"
+
+
+# returns a .npy file with a one dimensional array, for the data of an array.array
+def _npy_bytes(arr, type_char):
+    descr = f"{_BYTE_ORDER if arr.itemsize > 1 else '|'}{type_char}{arr.itemsize}"
+    header = f"{{'descr': '{descr}', 'fortran_order': False, 'shape': ({len(arr)},), }}"
+    # magic, version 1.0, header length; the header is padded to a multiple of 64 bytes, ending with a newline.
+    header += " " * (63 - (10 + len(header)) % 64) + "\n"
+    return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1") + arr.tobytes()
+
+# strings are stored like in arrow: the utf-8 data of all strings, and the length in bytes of each string
+def _encode_strings(strings):
+    data = bytearray()
+    lengths = array.array("I")
+    for text in strings:
+        encoded = text.encode("utf-8", errors="replace")
+        data += encoded
+        lengths.append(len(encoded))
+    return array.array("B", data), lengths
+
+
+class _NpzWriter:
+    def __init__(self, file_name):
+        self.zip_file = zipfile.ZipFile(file_name, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def _write_array(self, name, arr, type_char):
+        with self.zip_file.open(f"{name}.npy", "w", force_zip64=True) as entry:
+            entry.write(_npy_bytes(arr, type_char))
+
+    def _write_strings(self, name, strings):
+        data, lengths = _encode_strings(strings)
+        self._write_array(f"{name}_data", data, "u")
+        self._write_array(f"{name}_lengths", lengths, "u")
+
+    def write_chunk(self, chunk_num, columns, strings):
+        for (name, _, type_char), column in zip(_COLUMNS, columns):
+            self._write_array(f"{name}_{chunk_num:05d}", column, type_char)
+        self._write_strings(f"strings_{chunk_num:05d}", strings)
+
+    def close(self, codes):
+        self._write_strings("kinds", KINDS)
+        self._write_strings("code_file", [ code[0] for code in codes ])
+        self._write_strings("code_name", [ code[1] for code in codes ])
+        self._write_array("code_line", array.array("i", [ code[2] for code in codes ]), "i")
+        self.zip_file.close()
+
+
+_ARROW_TYPES = { "B" : "uint8", "I" : "uint32", "i" : "int32", "q" : "int64", "Q" : "uint64" }
+
+# arrow streams: <file> has the events, <file>.strings the string table, <file>.codes the code table (written by close)
+class _ArrowWriter:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.schema = pyarrow.schema([ (name, getattr(pyarrow, _ARROW_TYPES[ typecode ])()) for name, typecode, _ in _COLUMNS ],
+                                     metadata={ "kinds" : ",".join(KINDS) })
+        self.events = pyarrow.ipc.new_stream(pyarrow.OSFile(file_name, "wb"), self.schema)
+        self.strings_schema = pyarrow.schema([ ("string", pyarrow.string()) ])
+        self.strings = pyarrow.ipc.new_stream(pyarrow.OSFile(file_name + ".strings", "wb"), self.strings_schema)
+
+    def write_chunk(self, chunk_num, columns, strings):
+        arrays = [ pyarrow.Array.from_buffers(field.type, len(column), [ None, pyarrow.py_buffer(column) ]) for field, column in zip(self.schema, columns) ]
+        self.events.write_batch(pyarrow.record_batch(arrays, schema=self.schema))
+        if strings:
+            self.strings.write_batch(pyarrow.record_batch([ pyarrow.array(strings, type=pyarrow.string()) ], schema=self.strings_schema))
+
+    def close(self, codes):
+        self.events.close()
+        self.strings.close()
+        table = pyarrow.table({ "file" : [ code[0] for code in codes ], "name" : [ code[1] for code in codes ], "line" : [ code[2] for code in codes ] })
+        with pyarrow.ipc.new_stream(pyarrow.OSFile(self.file_name + ".codes", "wb"), table.schema) as writer:
+            writer.write_table(table)
+
+
+class ColumnarTraceConsumer(TraceConsumer):
+    """writes the trace events as columns, a chunk of chunk_size events at a time; call close() when done (the file is not complete before).
+
+    file_name  - name of the output file
+    fmt        - "npz" (doesn't need numpy for writing) or "arrow" (needs pyarrow); None: arrow if pyarrow is installed, else npz
+    chunk_size - number of events per chunk
+    values     - False: don't format the values (the value column is -1, faster)
+    show_obj   - how to format values (same as for TraceMe)
+
+    Names and values are stored in a string table, the name and value columns are indexes into it; the code column is an index into
+    the code table (file, function name, first line). Only the current chunk is held in memory.
+    """
+
+    def __init__(self, file_name : str, *, fmt : str = None, chunk_size : int = 65536, values : bool = True, show_obj : int = 1):
+        if fmt is None:
+            fmt = "arrow" if _ARROW_ENABLED else "npz"
+        if fmt == "arrow":
+            if not _ARROW_ENABLED:
+                raise ImportError("pyarrow module required for the arrow format")
+            self.writer = _ArrowWriter(file_name)
+        elif fmt == "npz":
+            self.writer = _NpzWriter(file_name)
+        else:
+            raise ValueError(f"unknown format {fmt}, expected npz or arrow")
+        self.fmt = fmt
+        self.chunk_size = chunk_size
+        self.wants_values = values
+        self.show_obj = show_obj
+        self.lock = threading.Lock()
+        self.num_events = 0
+        self.num_chunks = 0
+        # code object -> index in the code table; entries of the code table: (file, function name, first line)
+        self.code_index = {}
+        self.codes = []
+        # string -> index in the string table
+        self.string_index = {}
+        self.num_strings = 0
+        self._new_chunk()
+
+    def _new_chunk(self):
+        self.columns = [ array.array(typecode) for _, typecode, _ in _COLUMNS ]
+        # strings added to the string table by this chunk
+        self.chunk_strings = []
+
+    def _get_string(self, text):
+        pos = self.string_index.get(text, None)
+        if pos is None:
+            if len(self.string_index) >= _MAX_STRING_INDEX:
+                self.string_index.clear()
+            pos = self.num_strings
+            self.num_strings += 1
+            self.string_index[ text ] = pos
+            self.chunk_strings.append(text)
+        return pos
+
+    def _get_code(self, code):
+        pos = self.code_index.get(code, None)
+        if pos is None:
+            pos = len(self.codes)
+            self.code_index[ code ] = pos
+            self.codes.append( (code.co_filename, getattr(code, "co_qualname", code.co_name), code.co_firstlineno) )
+        return pos
+
+    def on_event(self, rec : TraceRecord):
+        now = time.perf_counter_ns()
+        kind = rec.kind
+        if self.wants_values and kind != "line" and kind != "call":
+            value = format_value(rec.value, self.show_obj)
+        else:
+            value = None
+
+        with self.lock:
+            kind_col, code_col, line_col, nesting_col, time_col, thread_col, name_col, value_col = self.columns
+            kind_col.append(_KIND_INDEX[ kind ])
+            code_col.append(self._get_code(rec.code))
+            line_col.append(rec.lineno)
+            nesting_col.append(rec.nesting)
+            time_col.append(now)
+            thread_col.append(threading.get_ident())
+            name_col.append(-1 if rec.name is None else self._get_string(rec.name))
+            value_col.append(-1 if value is None else self._get_string(value))
+            self.num_events += 1
+            if len(kind_col) >= self.chunk_size:
+                self._write_chunk()
+
+    def _write_chunk(self):
+        if len(self.columns[0]) == 0 and not self.chunk_strings:
+            return
+        self.writer.write_chunk(self.num_chunks, self.columns, self.chunk_strings)
+        self.num_chunks += 1
+        self._new_chunk()
+
+    def on_end(self):
+        with self.lock:
+            self._write_chunk()
+
+    def close(self):
+        """write the last chunk and the tables, close the file"""
+        with self.lock:
+            if self.writer is None:
+                return
+            self._write_chunk()
+            self.writer.close(self.codes)
+            self.writer = None
+
+
+@dataclasses.dataclass
+class ColumnarTrace:
+    """trace read by read_columnar: events is a numpy structured array with the columns, the other fields are the tables"""
+    events: typing.Any
+    kinds: typing.List[str]
+    strings: typing.List[str]
+    # entries: (file, function name, first line)
+    codes: typing.List[typing.Tuple[str, str, int]]
+
+    def kind_index(self, kind):
+        return self.kinds.index(kind)
+
+
+def _decode_strings(data, lengths):
+    data = data.tobytes()
+    strings = []
+    pos = 0
+    for length in lengths.tolist():
+        strings.append(data[ pos : pos + length ].decode("utf-8"))
+        pos += length
+    return strings
+
+def read_columnar(file_name : str):
+    """read a .npz file written by ColumnarTraceConsumer, returns a ColumnarTrace (requires numpy)"""
+    import numpy
+
+    with numpy.load(file_name) as npz:
+        num_chunks = len([ name for name in npz.files if name.startswith("kind_") ])
+        dtype = numpy.dtype([ (name, npz[ f"{name}_00000" ].dtype if num_chunks else numpy.int64) for name, _, _ in _COLUMNS ])
+        events = numpy.empty(sum(len(npz[ f"kind_{chunk:05d}" ]) for chunk in range(num_chunks)), dtype=dtype)
+        strings = []
+        pos = 0
+        for chunk in range(num_chunks):
+            size = len(npz[ f"kind_{chunk:05d}" ])
+            for name, _, _ in _COLUMNS:
+                events[ name ][ pos : pos + size ] = npz[ f"{name}_{chunk:05d}" ]
+            strings.extend( _decode_strings(npz[ f"strings_{chunk:05d}_data" ], npz[ f"strings_{chunk:05d}_lengths" ]) )
+            pos += size
+
+        kinds = _decode_strings(npz["kinds_data"], npz["kinds_lengths"])
+        codes = list(zip(_decode_strings(npz["code_file_data"], npz["code_file_lengths"]),
+                         _decode_strings(npz["code_name_data"], npz["code_name_lengths"]),
+                         npz["code_line"].tolist()))
+    return ColumnarTrace(events, kinds, strings, codes)
@@ -0,0 +1,121 @@
+"""count executed bytecode instructions (by opcode), and check them against a budget in tests. Unlike timing, instruction counts are deterministic (for a given python version)"""
+
+import sys
+import opcode
+import contextlib
+from .prettytrace import is_traced_file
+
+__all__ = [ "InstructionCounter", "count_instructions", "assert_max_instructions" ]
+
+
+class InstructionCounter(contextlib.ContextDecorator):
+    """counts the bytecode instructions executed in the with block (or in the decorated function), including the functions called from there.
+
+    ignore_stdlib - don't count instructions of functions in the standard library
+
+    Note that the counter replaces the trace function (sys.settrace) while it is active (debuggers and coverage tools don't see that part).
+    """
+
+    def __init__(self, *, ignore_stdlib : bool = False):
+        self.ignore_stdlib = ignore_stdlib
+        self.counts = [0] * 256
+        self.code_filter = {}
+        self.prev_tracer = None
+        self.outer_frame = None
+        self.outer_frame_tracer = None
+        self.outer_frame_opcodes = False
+
+    def _is_counted(self, code):
+        counted = self.code_filter.get(code, None)
+        if counted is None:
+            counted = is_traced_file(code.co_filename, self.ignore_stdlib)
+            self.code_filter[code] = counted
+        return counted
+
+    def _make_tracers(self):
+        counts = self.counts
+
+        def opcode_tracer(frame, why, arg):
+            if why == 'opcode':
+                counts[ frame.f_code.co_code[ frame.f_lasti ] ] += 1
+            return opcode_tracer
+
+        def func_tracer(frame, why, arg):
+            if not self._is_counted(frame.f_code):
+                return None
+            # python 3.13: opcode events are only turned on for a frame that has a trace function already.
+            frame.f_trace = opcode_tracer
+            frame.f_trace_opcodes = True
+            return opcode_tracer
+
+        return func_tracer, opcode_tracer
+
+    def __enter__(self):
+        self.counts[:] = [0] * 256
+        func_tracer, opcode_tracer = self._make_tracers()
+        self.prev_tracer = sys.gettrace()
+
+        # the frame with the with statement is already running, it needs its own trace function.
+        # (skip the frame of contextlib, if used as decorator; the decorated function is counted by func_tracer)
+        frame = sys._getframe(1)
+        while frame is not None and (frame.f_code.co_filename == contextlib.__file__ or not is_traced_file(frame.f_code.co_filename, False)):
+            frame = frame.f_back
+        self.outer_frame = frame
+        if frame is not None:
+            self.outer_frame_tracer = frame.f_trace
+            self.outer_frame_opcodes = frame.f_trace_opcodes
+            frame.f_trace = opcode_tracer
+            frame.f_trace_opcodes = True
+
+        sys.settrace(func_tracer)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sys.settrace(self.prev_tracer)
+        if self.outer_frame is not None:
+            self.outer_frame.f_trace = self.outer_frame_tracer
+            self.outer_frame.f_trace_opcodes = self.outer_frame_opcodes
+            self.outer_frame = None
+        return False
+
+    @property
+    def total(self):
+        return sum(self.counts)
+
+    def by_opcode(self):
+        """returns dictionary: opcode name -> number of executed instructions"""
+        return { opcode.opname[ op ] : count for op, count in enumerate(self.counts) if count != 0 }
+
+    def top(self, num = 5):
+        return sorted(self.by_opcode().items(), key=lambda item: item[1], reverse=True)[ : num ]
+
+
+def count_instructions(func, *args, **kwargs):
+    """call func(*args, **kwargs), returns tuple (InstructionCounter, return value of func)"""
+    counter = InstructionCounter()
+    with counter:
+        ret_val = func(*args, **kwargs)
+    return counter, ret_val
+
+
+class assert_max_instructions(InstructionCounter):
+    """context manager/decorator, raises AssertionError if more than budget instructions are executed:
+
+        with pyasmtools.assert_max_instructions(1000):
+            hot_function()
+
+        @pyasmtools.assert_max_instructions(1000)
+        def test_hot_function():
+            ...
+    """
+
+    def __init__(self, budget : int, *, ignore_stdlib : bool = False):
+        super().__init__(ignore_stdlib=ignore_stdlib)
+        self.budget = budget
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super().__exit__(exc_type, exc_value, traceback)
+        if exc_type is None and self.total > self.budget:
+            top = ", ".join(f"{name}: {count}" for name, count in self.top())
+            raise AssertionError(f"executed {self.total} bytecode instructions, budget is {self.budget} (most frequent: {top})")
+        return False
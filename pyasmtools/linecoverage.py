@@ -0,0 +1,140 @@
+"""line coverage for functions traced by TraceMe/TraceClass: one bitmap per code object, the trace function of a code object is removed once all of its lines have been executed"""
+
+import os
+import sys
+import dis
+import linecache
+from .prettytrace import is_traced_file
+
+__all__ = [ "LineCoverage" ]
+
+# instructions of the function prologue (3.11+), these don't cause a line event.
+_PROLOGUE_OPS = frozenset(( "RESUME", "MAKE_CELL", "COPY_FREE_VARS", "RETURN_GENERATOR", "POP_TOP", "CACHE" ))
+
+# returns the sorted list of line numbers, that get a 'line' trace event when executed.
+def _get_code_lines(code):
+    ops_per_line = {}
+    line = None
+    for inst in dis.get_instructions(code):
+        inst_line = getattr(inst, "line_number", None) if sys.version_info >= (3, 13) else inst.starts_line
+        if inst_line is not None:
+            line = inst_line
+        if line is not None:
+            ops_per_line.setdefault(line, set()).add(inst.opname)
+    return sorted( line for line, ops in ops_per_line.items() if not ops <= _PROLOGUE_OPS )
+
+# coverage of one code object
+class _CodeCoverage:
+    __slots__ = ("code", "first_line", "bitmap", "lines", "remaining", "on_line")
+
+    def __init__(self, code):
+        self.code = code
+        self.lines = _get_code_lines(code)
+        self.first_line = min(self.lines[0], code.co_firstlineno) if self.lines else code.co_firstlineno
+        last_line = self.lines[-1] if self.lines else self.first_line
+        self.bitmap = bytearray(last_line - self.first_line + 1)
+        self.remaining = len(self.lines)
+        self.on_line = self._make_line_tracer()
+
+    def _make_line_tracer(self):
+        bitmap = self.bitmap
+        first_line = self.first_line
+        state = self
+
+        def line_tracer(frame, why, arg):
+            if why == 'line':
+                index = frame.f_lineno - first_line
+                if 0 <= index < len(bitmap) and not bitmap[index]:
+                    bitmap[index] = 1
+                    state.remaining -= 1
+                    if state.remaining <= 0:
+                        # all lines seen: no more line events for this frame, new calls of the code object are not traced.
+                        frame.f_trace = None
+                        return None
+            return line_tracer
+        return line_tracer
+
+    def is_executed(self, line):
+        index = line - self.first_line
+        return 0 <= index < len(self.bitmap) and self.bitmap[index] != 0
+
+    def num_executed(self):
+        return len(self.lines) - self.remaining
+
+
+class LineCoverage:
+    """collects line coverage; pass the object as coverage parameter of TraceMe/TraceClass. The object can be shared by several decorated functions,
+    the coverage of all calls is accumulated"""
+
+    def __init__(self):
+        # code object -> _CodeCoverage, or None if the file of the code object is not traced.
+        self.codes = {}
+        self.ignore_stdlib = True
+
+    def get_tracer(self, ignore_stdlib):
+        self.ignore_stdlib = ignore_stdlib
+        return self._func_tracer
+
+    def _func_tracer(self, frame, why, arg):
+        code = frame.f_code
+        try:
+            state = self.codes[ code ]
+        except KeyError:
+            state = None
+            if is_traced_file(code.co_filename, self.ignore_stdlib):
+                state = _CodeCoverage(code)
+            self.codes[ code ] = state
+
+        if state is None or state.remaining <= 0:
+            return None
+        return state.on_line
+
+    def on_end(self):
+        pass
+
+    def get_modules(self):
+        """returns dictionary: file name -> list of _CodeCoverage entries, ordered by line number"""
+        modules = {}
+        for state in self.codes.values():
+            if state is not None:
+                modules.setdefault(state.code.co_filename, []).append(state)
+        for states in modules.values():
+            states.sort(key=lambda state: state.first_line)
+        return modules
+
+    def get_summary(self):
+        """returns dictionary: file name -> (number of executed lines, number of lines) of the traced code objects"""
+        summary = {}
+        for file_name, states in self.get_modules().items():
+            lines = set()
+            executed = set()
+            for state in states:
+                lines.update(state.lines)
+                executed.update(line for line in state.lines if state.is_executed(line))
+            summary[ file_name ] = (len(executed), len(lines))
+        return summary
+
+    def show_report(self, out = sys.stdout, show_source : bool = True):
+        """per module report, the source of each traced function is annotated with '+' (executed) or '-' (not executed)"""
+        summary = self.get_summary()
+        for file_name, states in sorted(self.get_modules().items()):
+            num_executed, num_lines = summary[ file_name ]
+            base_name = os.path.basename(file_name)
+            percent = (100.0 * num_executed / num_lines) if num_lines else 100.0
+            print(f"File path: {file_name} lines: {num_lines} executed: {num_executed} ({percent:.1f}%)", file=out)
+
+            if not show_source:
+                continue
+
+            for state in states:
+                qualname = getattr(state.code, "co_qualname", state.code.co_name)
+                print(f"\n{base_name}:{state.code.co_firstlineno} {qualname} ({state.num_executed()} of {len(state.lines)} lines)", file=out)
+                line_set = set(state.lines)
+                for line in range(state.code.co_firstlineno, state.first_line + len(state.bitmap)):
+                    if line in line_set:
+                        mark = "+" if state.is_executed(line) else "-"
+                    else:
+                        mark = " "
+                    line_str = linecache.getline(file_name, line)
+                    print(f"{base_name}:{line} {mark}\t{line_str}", end="", file=out)
+            print("", file=out)
@@ -0,0 +1,255 @@
+"""text trace with folded loops: the first and the last iterations of a loop are shown in full, the iterations in between are summarised
+(number of iterations, range or number of distinct values of the variables stored in them)"""
+
+import io
+import sys
+import dis
+import collections
+from .prettytrace import TextTraceConsumer, TraceRecord, format_value
+
+__all__ = [ "LoopFoldingConsumer" ]
+
+_STORE_KINDS = frozenset(( "store", "store_global", "store_attr", "store_subscr" ))
+
+# number of distinct values that is counted for each variable
+_MAX_DISTINCT = 32
+
+
+# returns dictionary: line of the loop header -> set of lines in the loop. A loop is found by its backward jump, the target of the jump is the header.
+def _find_loops(code):
+    insts = list(dis.get_instructions(code))
+    offset_lines = []
+    line = code.co_firstlineno
+    for inst in insts:
+        inst_line = getattr(inst, "line_number", None) if sys.version_info >= (3, 13) else inst.starts_line
+        if inst_line is not None:
+            line = inst_line
+        offset_lines.append( (inst.offset, line) )
+
+    loops = {}
+    for inst in insts:
+        if (inst.opcode in dis.hasjrel or inst.opcode in dis.hasjabs) and isinstance(inst.argval, int) and inst.argval < inst.offset:
+            lines = set( line for offset, line in offset_lines if inst.argval <= offset <= inst.offset )
+            header = next( line for offset, line in offset_lines if offset >= inst.argval )
+            loops.setdefault(header, set()).update(lines)
+    return loops
+
+
+# values stored to one variable in the folded iterations
+class _StoreStats:
+    __slots__ = ("count", "min_val", "max_val", "distinct", "numeric")
+
+    def __init__(self):
+        self.count = 0
+        self.min_val = None
+        self.max_val = None
+        self.distinct = set()
+        self.numeric = True
+
+    def add(self, value, sval):
+        self.count += 1
+        if self.numeric and isinstance(value, (int, float)) and not isinstance(value, bool):
+            if self.min_val is None or value < self.min_val:
+                self.min_val = value
+            if self.max_val is None or value > self.max_val:
+                self.max_val = value
+        else:
+            self.numeric = False
+        if len(self.distinct) <= _MAX_DISTINCT:
+            self.distinct.add(sval)
+
+    def merge(self, other):
+        for value in (other.min_val, other.max_val):
+            if value is not None:
+                if self.min_val is None or value < self.min_val:
+                    self.min_val = value
+                if self.max_val is None or value > self.max_val:
+                    self.max_val = value
+        self.numeric = self.numeric and other.numeric
+        self.count += other.count
+        if len(self.distinct) <= _MAX_DISTINCT:
+            self.distinct.update(other.distinct)
+
+    def describe(self):
+        if len(self.distinct) > _MAX_DISTINCT:
+            distinct = f"more than {_MAX_DISTINCT} distinct"
+        else:
+            distinct = f"{len(self.distinct)} distinct"
+        if self.numeric and self.min_val is not None:
+            return f"{self.count} stores, {distinct}, min: {self.min_val} max: {self.max_val}"
+        return f"{self.count} stores, {distinct}"
+
+
+# the buffered output of one iteration, and what it stored.
+class _Iteration:
+    __slots__ = ("out", "stats", "saw_body")
+
+    def __init__(self):
+        self.out = io.StringIO()
+        self.stats = {}
+        self.saw_body = False
+
+    def add_store(self, name, value, sval):
+        stats = self.stats.get(name, None)
+        if stats is None:
+            stats = _StoreStats()
+            self.stats[ name ] = stats
+        stats.add(value, sval)
+
+
+# an active loop of a traced frame.
+class _Loop:
+    def __init__(self, rec, lines, parent_out):
+        self.nesting = rec.nesting
+        self.location = rec.location()
+        self.header = rec.lineno
+        self.lines = lines
+        self.parent_out = parent_out
+        self.out = parent_out
+        self.iteration = 1
+        # did the current iteration get past the header line? (for loops: the last arrival at the header ends the loop)
+        self.saw_body = False
+        self.current = None
+        self.recent = collections.deque()
+        self.folded = 0
+        self.folded_stats = {}
+
+
+class LoopFoldingConsumer(TextTraceConsumer):
+    """writes the text trace, like TextTraceConsumer; of each loop only the first keep and the last keep iterations are shown in full.
+    Used by TraceMe/TraceClass, if the fold_loops parameter is set (fold_loops is the value of keep).
+
+    Up to keep iterations of each active loop are held in memory, until the loop is left.
+    """
+
+    def __init__(self, out = sys.stderr, *, keep : int = 3, show_obj : int = 1, trace_indent : bool = False):
+        super().__init__(out, show_obj=show_obj, trace_indent=trace_indent)
+        self.real_out = out
+        self.keep = max(1, keep)
+        # code object -> result of _find_loops
+        self.code_loops = {}
+        # active loops of all frames, the innermost loop is the last one.
+        self.loops = []
+
+    def _get_loops(self, code):
+        loops = self.code_loops.get(code, None)
+        if loops is None:
+            loops = _find_loops(code)
+            self.code_loops[ code ] = loops
+        return loops
+
+    def _current_out(self):
+        return self.loops[-1].out if self.loops else self.real_out
+
+    def _fold_oldest(self, loop):
+        dropped = loop.recent.popleft()
+        loop.folded += 1
+        for name, stats in dropped.stats.items():
+            folded = loop.folded_stats.get(name, None)
+            if folded is None:
+                loop.folded_stats[ name ] = stats
+            else:
+                folded.merge(stats)
+
+    def _end_iteration(self, loop):
+        if loop.current is None:
+            return
+        loop.current.saw_body = loop.saw_body
+        loop.recent.append(loop.current)
+        loop.current = None
+        # one more than keep is held: the last one may turn out to be the final arrival at the header, not a real iteration.
+        if len(loop.recent) > self.keep + 1:
+            self._fold_oldest(loop)
+
+    def _next_iteration(self, loop):
+        self._end_iteration(loop)
+        loop.saw_body = False
+        loop.iteration += 1
+        if loop.iteration > self.keep:
+            loop.current = _Iteration()
+            loop.out = loop.current.out
+        else:
+            loop.out = loop.parent_out
+
+    def _leave_loop(self):
+        loop = self.loops.pop()
+        self._end_iteration(loop)
+        out = loop.parent_out
+
+        num_iterations = loop.iteration
+        if not loop.saw_body:
+            num_iterations -= 1
+        elif len(loop.recent) > self.keep:
+            self._fold_oldest(loop)
+
+        if loop.folded != 0:
+            first = self.keep + 1
+            print(f"{loop.location} # loop: {num_iterations} iterations, {loop.folded} not shown (iterations {first} to {first + loop.folded - 1})", file=out)
+            for name, stats in sorted(loop.folded_stats.items()):
+                print(f"{loop.location} #     {name}: {stats.describe()}", file=out)
+        for iteration in loop.recent:
+            out.write(iteration.out.getvalue())
+
+    def _leave_frame_loops(self, nesting):
+        while self.loops and self.loops[-1].nesting >= nesting:
+            self._leave_loop()
+
+    def _on_line(self, rec):
+        # loops of this frame that don't contain the line have been left.
+        while self.loops and self.loops[-1].nesting == rec.nesting and rec.lineno not in self.loops[-1].lines:
+            self._leave_loop()
+
+        loop = self.loops[-1] if self.loops and self.loops[-1].nesting == rec.nesting else None
+        if loop is not None and loop.header == rec.lineno:
+            self._next_iteration(loop)
+            return
+
+        # an outer loop of the frame can have the same header line as the innermost one (while loops)
+        for pos in range(len(self.loops) - 1, -1, -1):
+            outer = self.loops[pos]
+            if outer.nesting != rec.nesting:
+                break
+            if outer.header == rec.lineno:
+                while self.loops[-1] is not outer:
+                    self._leave_loop()
+                self._next_iteration(outer)
+                return
+
+        if loop is not None:
+            loop.saw_body = True
+
+        lines = self._get_loops(rec.code).get(rec.lineno, None)
+        if lines is not None:
+            self.loops.append( _Loop(rec, lines, self._current_out()) )
+
+    def _on_store(self, rec):
+        sval = None
+        for loop in self.loops:
+            if loop.current is not None:
+                if sval is None:
+                    sval = format_value(rec.value, self.show_obj)
+                if rec.kind == "store_attr":
+                    name = f".{rec.name}"
+                elif rec.kind == "store_subscr":
+                    name = f"{rec.title}[]"
+                else:
+                    name = rec.name
+                loop.current.add_store(name, rec.value, sval)
+
+    def on_event(self, rec : TraceRecord):
+        kind = rec.kind
+        if kind == "line":
+            self._on_line(rec)
+        elif kind in _STORE_KINDS and self.loops:
+            self._on_store(rec)
+
+        self.out = self._current_out()
+        super().on_event(rec)
+
+        if kind == "return" or kind == "yield":
+            self._leave_frame_loops(rec.nesting)
+
+    def on_end(self):
+        self._leave_frame_loops(0)
+        self.out = self.real_out
+        super().on_end()
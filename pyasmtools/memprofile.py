@@ -0,0 +1,162 @@
+"""memory mode: attributes the change in traced memory (tracemalloc) to the previously executed source line, and shows the lines that allocate most"""
+
+import sys
+import time
+import threading
+import tracemalloc
+import linecache
+from .prettytrace import TraceConsumer, TraceRecord
+
+__all__ = [ "MemoryProfiler" ]
+
+# allocation statistics of one source line (at one nesting level)
+class _LineAlloc:
+    __slots__ = ("filename", "bname", "lineno", "nesting", "allocated", "freed", "samples")
+
+    def __init__(self, filename, bname, lineno, nesting):
+        self.filename = filename
+        self.bname = bname
+        self.lineno = lineno
+        self.nesting = nesting
+        self.allocated = 0
+        self.freed = 0
+        self.samples = 0
+
+    def location(self):
+        return f"{self.bname}:{self.lineno}({self.nesting})"
+
+
+# sampling state of one thread
+class _ThreadState:
+    __slots__ = ("prev_key", "prev_rec", "prev_memory", "prev_time", "num_events", "call_stack")
+
+    def __init__(self, memory):
+        self.prev_key = None
+        self.prev_rec = None
+        self.prev_memory = memory
+        self.prev_time = time.perf_counter()
+        self.num_events = 0
+        self.call_stack = []
+
+
+class MemoryProfiler(TraceConsumer):
+    """pass as memory_profile parameter of TraceMe/TraceClass (or add to the consumers). Unless the consumers parameter is given as well,
+    the text trace is not written then, and opcodes are not traced: the memory and the time of the tracer stay low.
+
+    sample_every - take a sample at every n-th line event (the delta is attributed to the last sampled line)
+    min_interval - minimum time in seconds between two samples (0 - no throttling)
+    top          - number of lines shown in the report
+    out          - the report is written here once, when the first trace ends (and no other thread is traced); None - no report.
+                   Call show_report for the numbers of later traces.
+
+    tracemalloc is started if it isn't running; note that the memory of the trace records themselves is counted as well,
+    so small deltas are not meaningful.
+    The traced memory of tracemalloc is that of the whole process: allocations made by other threads (traced or not) between two
+    samples are charged to the line of the sampling thread. With several threads the numbers only show where memory grows;
+    the report says so, if traced threads were sampled at the same time.
+    """
+
+    wants_values = False
+    event_kinds = frozenset(( "call", "line", "return", "resume", "yield" ))
+
+    def __init__(self, *, sample_every : int = 1, min_interval : float = 0.0, top : int = 20, out = sys.stderr):
+        self.sample_every = max(1, sample_every)
+        self.min_interval = min_interval
+        self.top = top
+        self.out = out
+        # (code object, line, nesting) -> _LineAlloc
+        self.lines = {}
+        self.local = threading.local()
+        self.started_tracemalloc = False
+        # number of threads that are sampling now, and the maximum of it
+        self.lock = threading.Lock()
+        self.active_threads = 0
+        self.max_active_threads = 0
+        self.reported = False
+
+    def _get_thread_state(self):
+        state = getattr(self.local, "state", None)
+        if state is None:
+            with self.lock:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self.started_tracemalloc = True
+                self.active_threads += 1
+                self.max_active_threads = max(self.max_active_threads, self.active_threads)
+            state = _ThreadState(tracemalloc.get_traced_memory()[0])
+            self.local.state = state
+        return state
+
+    def on_event(self, rec : TraceRecord):
+        state = self._get_thread_state()
+        kind = rec.kind
+
+        state.num_events += 1
+        # calls and returns are always sampled, so that the line of the caller is known after the return.
+        if kind == "line" and state.prev_key is not None:
+            if state.num_events % self.sample_every != 0:
+                return
+            if self.min_interval > 0:
+                now = time.perf_counter()
+                if now - state.prev_time < self.min_interval:
+                    return
+                state.prev_time = now
+
+        current = tracemalloc.get_traced_memory()[0]
+        delta = current - state.prev_memory
+        state.prev_memory = current
+
+        if state.prev_key is not None:
+            entry = self.lines.get(state.prev_key, None)
+            if entry is None:
+                prev = state.prev_rec
+                entry = _LineAlloc(prev.filename, prev.bname, prev.lineno, prev.nesting)
+                self.lines[ state.prev_key ] = entry
+            if delta > 0:
+                entry.allocated += delta
+            else:
+                entry.freed -= delta
+            entry.samples += 1
+
+        if kind == "call" or kind == "resume":
+            state.call_stack.append( (state.prev_key, state.prev_rec) )
+        elif kind == "return" or kind == "yield":
+            # the following allocations belong to the line of the caller.
+            if state.call_stack:
+                state.prev_key, state.prev_rec = state.call_stack.pop()
+            else:
+                state.prev_key, state.prev_rec = None, None
+            return
+
+        state.prev_key = (rec.code, rec.lineno, rec.nesting)
+        state.prev_rec = rec
+
+    def on_end(self):
+        if getattr(self.local, "state", None) is None:
+            return
+        self.local.state = None
+        with self.lock:
+            self.active_threads -= 1
+            if self.active_threads != 0:
+                # the other threads are still sampling.
+                return
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+                self.started_tracemalloc = False
+            report = self.out is not None and not self.reported
+            self.reported = True
+        if report:
+            self.show_report(self.out)
+
+    def get_ranking(self):
+        """returns the _LineAlloc entries, ordered by allocated bytes"""
+        return sorted(self.lines.values(), key=lambda entry: entry.allocated, reverse=True)
+
+    def show_report(self, out = sys.stderr):
+        ranking = self.get_ranking()[ : self.top ]
+        print(f"# memory profile: top {len(ranking)} of {len(self.lines)} lines by allocated bytes", file=out)
+        if self.max_active_threads > 1:
+            print(f"# up to {self.max_active_threads} threads were traced at the same time: the allocations of each thread are also charged to the lines of the others", file=out)
+        for entry in ranking:
+            line = linecache.getline(entry.filename, entry.lineno).strip()
+            print(f"{entry.location()} # allocated: {entry.allocated} freed: {entry.freed} net: {entry.allocated - entry.freed} samples: {entry.samples}  {line}", file=out)
@@ -1,11 +1,22 @@
 """bytecode disassembler that prints source for each statement before the bytecode listing (note, doesn't work with exec/compile built-ins)"""
 
+import io
+import sys
 import dis
 import inspect
 import linecache
 import os
+import types
+import importlib.util
 
-__all__ = [ "prettydis" ]
+__all__ = [ "prettydis", "prettydis_source", "prettydis_file" ]
+
+# line number of the source line that starts at the instruction, None if the instruction doesn't start a line
+# (python 3.13: starts_line is a bool, the number is in line_number)
+def _starts_line(inst):
+    if sys.version_info >= (3, 13):
+        return inst.line_number if inst.starts_line else None
+    return inst.starts_line
 
 # formatting function copied from disasm sources (adjusted from dis module)
 def _disassemble(inst, show_opcode_as_links=False, lineno_width=3, mark_as_current=False, offset_width=4):
@@ -16,9 +27,10 @@ def _disassemble(inst, show_opcode_as_links=False, lineno_width=3, mark_as_curre
     fields = []
     # Column: Source code line number
     if lineno_width:
-        if inst.starts_line is not None:
+        starts_line = _starts_line(inst)
+        if starts_line is not None:
             lineno_fmt = "%%%dd" % lineno_width
-            fields.append(lineno_fmt % inst.starts_line)
+            fields.append(lineno_fmt % starts_line)
         else:
             fields.append(' ' * lineno_width)
     # Column: Current instruction indicator
@@ -101,11 +113,32 @@ def get_func_obj_spec(func):
 
 
 
-def prettydis(func, show_opcode_as_links=False):
-    """dissassemble function and show source. Note, doesn't work with compile/exec built-in functions"""
+def prettydis(func, show_opcode_as_links=False, adaptive=False, warmup=None, warmup_runs=100):
+    """dissassemble function and show source. Note, doesn't work with compile/exec built-in functions
+
+       adaptive    - python 3.11+: also show the specialised instructions and the inline cache entries, that the interpreter uses now
+                     (next to the generic instruction), followed by a list of the instructions that have not been specialised.
+                     This is a snapshot: an instruction that keeps deoptimizing and specializing again can be specialised right now.
+       warmup      - function without arguments, called warmup_runs times before disassembling (should call func), so that the
+                     interpreter specialises the instructions of func. The adaptive bytecode is checked after each run, instructions
+                     that change their specialised form, or fall back to the generic one, are listed as unstable."""
 
     func = get_real_func(func)
 
+    if adaptive and sys.version_info < (3, 11):
+        print("adaptive bytecode requires python 3.11 or later", file=sys.stderr)
+        adaptive = False
+
+    if adaptive:
+        changes = None
+        if warmup is not None:
+            changes = _SpecializationChanges(func)
+            for _ in range(warmup_runs):
+                warmup()
+                changes.check()
+        _prettydis_adaptive(func, show_opcode_as_links, changes)
+        return
+
     #code_obj = dis.get_code_object(func)
 
     file_path = inspect.getfile( func )
@@ -133,8 +166,183 @@ def prettydis(func, show_opcode_as_links=False):
     # don't remove the next line, please! It's a generator, and will continue after the first line...
     instr = dis.get_instructions( func )
     for inst in instr:
-        if inst.starts_line is not None:
-            line_str = linecache.getline( inspect.getfile(func), inst.starts_line)
-            print(f"\n{base_name}:{inst.starts_line} \t{line_str}")
+        starts_line = _starts_line(inst)
+        if starts_line is not None:
+            line_str = linecache.getline( inspect.getfile(func), starts_line)
+            print(f"\n{base_name}:{starts_line} \t{line_str}")
         print(_disassemble(inst,show_opcode_as_links=show_opcode_as_links))
         #print(inst)
+
+
+
+# specialised instruction families (python 3.11+): generic instruction name -> names of its specialised forms
+_SPECIALIZATIONS = getattr(dis, "_specializations", {})
+
+# the inline cache entries of an instruction of the adaptive bytecode, as a list of strings
+def _get_cache_entries(inst, following):
+    cache_info = getattr(inst, "cache_info", None)
+    if cache_info:
+        # python 3.13+
+        return [ f"{name}: {int.from_bytes(data, sys.byteorder)}" for name, _, data in cache_info ]
+    return [ cache.argrepr for cache in following if cache.argrepr ]
+
+# returns list of tuples (generic instruction, adaptive instruction, cache entries)
+def _get_adaptive_instructions(func):
+    generic = { inst.offset : inst for inst in dis.get_instructions(func) }
+    ret = []
+    for inst in dis.get_instructions(func, adaptive=True, show_caches=True):
+        if inst.opname == "CACHE":
+            if ret:
+                ret[-1][2].append(inst)
+            continue
+        ret.append( (generic.get(inst.offset, inst), inst, []) )
+    return [ (generic_inst, adaptive_inst, _get_cache_entries(adaptive_inst, caches)) for generic_inst, adaptive_inst, caches in ret ]
+
+def _is_specialized(generic_inst, adaptive_inst):
+    return adaptive_inst.opname != generic_inst.opname and not adaptive_inst.opname.endswith("_ADAPTIVE")
+
+# counts how often the instructions change, after they have been specialized: the adaptive bytecode is looked at after
+# each warmup run (the specialization stats of sys._stats_* are only there in builds with --enable-pystats)
+class _SpecializationChanges:
+    def __init__(self, func):
+        self.func = func
+        self.generic = { inst.offset : inst.opname for inst in dis.get_instructions(func) }
+        # offset -> opname at the last check, for the instructions that have been specialized
+        self.last = {}
+        # offset -> number of changes after the first specialization
+        self.changes = {}
+
+    def check(self):
+        for inst in dis.get_instructions(self.func, adaptive=True):
+            last = self.last.get(inst.offset, None)
+            if last is None:
+                generic = self.generic.get(inst.offset, inst.opname)
+                if inst.opname != generic and not inst.opname.endswith("_ADAPTIVE"):
+                    self.last[ inst.offset ] = inst.opname
+            elif last != inst.opname:
+                self.last[ inst.offset ] = inst.opname
+                self.changes[ inst.offset ] = self.changes.get(inst.offset, 0) + 1
+
+def _prettydis_adaptive(func, show_opcode_as_links, changes):
+    file_path = inspect.getfile( func )
+    base_name = os.path.basename( file_path )
+
+    print("File path:", file_path,"\n")
+    print(f"{base_name}:{func.__code__.co_firstlineno} {get_func_obj_spec(func)}")
+
+    not_specialized = []
+    unstable = []
+    num_specializable = 0
+    line = func.__code__.co_firstlineno
+    for generic_inst, adaptive_inst, caches in _get_adaptive_instructions(func):
+        if _starts_line(generic_inst) is not None:
+            line = _starts_line(generic_inst)
+            line_str = linecache.getline( file_path, line)
+            print(f"\n{base_name}:{line} \t{line_str}")
+
+        text = _disassemble(generic_inst, show_opcode_as_links=show_opcode_as_links)
+        if adaptive_inst.opname != generic_inst.opname:
+            text = f"{text.ljust(60)} -> {adaptive_inst.opname}"
+        print(text)
+        if caches:
+            print(f"{' ' * 14}cache: {', '.join(caches)}")
+
+        # instructions with a counter in the cache can be specialised.
+        if generic_inst.opname in _SPECIALIZATIONS and any(cache.startswith("counter") for cache in caches):
+            num_specializable += 1
+            if not _is_specialized(generic_inst, adaptive_inst):
+                not_specialized.append( (line, generic_inst, adaptive_inst) )
+            if changes is not None and generic_inst.offset in changes.changes:
+                unstable.append( (line, generic_inst, adaptive_inst) )
+
+    print(f"\n{num_specializable - len(not_specialized)} of {num_specializable} specializable instructions are specialized right now")
+    if changes is None:
+        print("(snapshot of the adaptive bytecode: an instruction that keeps deoptimizing can be specialized at this moment; pass warmup to check it after each run)")
+    if not_specialized:
+        print("not specialized (either failed to specialize, or not executed often enough):")
+        for line, generic_inst, adaptive_inst in not_specialized:
+            print(f"{base_name}:{line} offset: {generic_inst.offset} {generic_inst.opname}{_argrepr(generic_inst)} now: {adaptive_inst.opname}")
+    if unstable:
+        print("unstable (deoptimized or specialized differently after the first specialization, during the warmup runs):")
+        for line, generic_inst, adaptive_inst in unstable:
+            print(f"{base_name}:{line} offset: {generic_inst.offset} {generic_inst.opname}{_argrepr(generic_inst)} changes: {changes.changes[generic_inst.offset]} now: {adaptive_inst.opname}")
+
+def _argrepr(inst):
+    return f" ({inst.argrepr})" if inst.argrepr else ""
+
+
+# signature of a code object (the function object is not available, so there are no defaults and annotations)
+def get_code_obj_spec(code):
+    if code.co_name == "<module>":
+        return "<module>"
+
+    arg_desc=[]
+    pos = 0
+    for arg in code.co_varnames[ : code.co_argcount ]:
+        arg_desc.append(arg)
+        pos += 1
+    if hasattr(code, "co_posonlyargcount") and code.co_posonlyargcount > 0:
+        arg_desc.insert(code.co_posonlyargcount, "/")
+
+    kwonly = code.co_varnames[ pos : pos + code.co_kwonlyargcount ]
+    pos += code.co_kwonlyargcount
+
+    if code.co_flags & inspect.CO_VARARGS:
+        arg_desc.append("*" + code.co_varnames[ pos ])
+        pos += 1
+    elif kwonly:
+        arg_desc.append("*")
+    arg_desc.extend(kwonly)
+    if code.co_flags & inspect.CO_VARKEYWORDS:
+        arg_desc.append("**" + code.co_varnames[ pos ])
+
+    qualname = getattr(code, "co_qualname", code.co_name)
+    return f"def {qualname}({', '.join(arg_desc)}):"
+
+
+# all code objects, depth first in order of appearance
+def _walk_code_objects(code):
+    yield code
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from _walk_code_objects(const)
+
+
+def _prettydis_code(code, source_lines, base_name, show_opcode_as_links):
+    print(f"{base_name}:{code.co_firstlineno} {get_code_obj_spec(code)}")
+
+    for inst in dis.get_instructions( code ):
+        # (the RESUME instruction of a module is at line 0)
+        starts_line = _starts_line(inst)
+        if starts_line:
+            line_str = source_lines[ starts_line - 1 ] if starts_line <= len(source_lines) else "\n"
+            print(f"\n{base_name}:{starts_line} \t{line_str}")
+        print(_disassemble(inst,show_opcode_as_links=show_opcode_as_links))
+    print("")
+
+
+def prettydis_source(source, file_name="<string>", show_opcode_as_links=False, functions=None):
+    """compile the source text and disassemble all of its code objects, showing the lines of the given source (nothing is imported or executed).
+       functions - list of names (qualified names, like Class.method) of the code objects to show; None for all"""
+
+    code = compile(source, file_name, "exec", dont_inherit=True)
+    # lines as counted by the compiler: str.splitlines would also split at form feeds and other separators.
+    source_lines = [ line if line.endswith("\n") else line + "\n" for line in io.StringIO(source, newline=None).readlines() ]
+    base_name = os.path.basename( file_name )
+
+    print("File path:", file_name,"\n")
+
+    for code_obj in _walk_code_objects(code):
+        qualname = getattr(code_obj, "co_qualname", code_obj.co_name)
+        if functions is not None and qualname not in functions and code_obj.co_name not in functions:
+            continue
+        _prettydis_code(code_obj, source_lines, base_name, show_opcode_as_links)
+
+
+def prettydis_file(file_path, show_opcode_as_links=False, functions=None):
+    """disassemble a python source file without importing it (see prettydis_source)"""
+
+    with open(file_path, "rb") as file:
+        # decode as python does it: honours the coding declaration.
+        source = importlib.util.decode_source(file.read())
+    prettydis_source(source, file_name=file_path, show_opcode_as_links=show_opcode_as_links, functions=functions)
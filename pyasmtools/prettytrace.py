@@ -9,6 +9,12 @@ import ctypes
 import functools
 import dis
 import opcode
+import importlib
+import sysconfig
+import site
+import weakref
+import json
+import pprint
 
 try:
     import ctypes
@@ -30,23 +36,45 @@ except ImportError:
 
 
 _TABS_TO_SPACES = 4
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
 _LOAD_OPCODES = {}
 _STORE_OPCODES = {}
 _CTYPES_POINTER_SIZE = -1
-_CTYPES_ID_TYPE=ctypes.c_ulong
 
 
+__all__ = [ "TraceParam", "TraceRecord", "EVENT_KINDS", "OPCODE_EVENT_KINDS", "format_value",
+            "TraceConsumer", "TextTraceConsumer", "JsonTraceConsumer", "EventCollector", "ObjectTracker",
+            "is_traced_file", "set_process_trace_out", "set_idle_tracer", "TraceMe", "TraceClass", "disable_stack_access",
+            "trace_by_name", "untrace_by_name", "enable_tracing", "is_tracing_enabled" ]
+
 # weird tls in python... https://bugs.python.org/issue24020
 local_data_ = threading.local()
 
-# configuration parameters for tracing
+# configuration parameters for tracing; these are the keyword arguments of TraceMe, TraceClass, trace_by_name, attach_trace and replay.
 @dataclasses.dataclass
 class TraceParam:
-    trace_indent: bool
-    trace_loc: bool
-    show_obj: int
-    ignore_stdlib: bool
-    out: 'typing.any'
+    trace_indent: bool = False
+    trace_loc: bool = True
+    show_obj: int = 1
+    ignore_stdlib: bool = True
+    out: 'typing.any' = sys.stderr
+    track_objects: bool = False
+    consumers: typing.Optional[typing.List['TraceConsumer']] = None
+    coverage: typing.Optional['LineCoverage'] = None
+    memory_profile: typing.Optional['MemoryProfiler'] = None
+    fold_comprehensions: bool = False
+    fold_loops: int = 0
+    capture: typing.Optional['ArgCapture'] = None
+    tracer_stats: typing.Optional['TracerStats'] = None
+
+_TRACE_PARAM_FIELDS = frozenset( field.name for field in dataclasses.fields(TraceParam) )
+
+# returns the TraceParam for the keyword arguments of TraceMe/TraceClass/trace_by_name/attach_trace/replay
+def _trace_param_from_args(trace_args):
+    unknown = set(trace_args) - _TRACE_PARAM_FIELDS
+    if unknown:
+        raise TypeError(f"unknown trace arguments: {', '.join(sorted(unknown))} (see the fields of TraceParam)")
+    return TraceParam(**trace_args)
 
 # adding a handler for an opcode
 def _add_opcode( op_name, op_map, op_func):
@@ -58,6 +86,10 @@ def _add_opcode( op_name, op_map, op_func):
         print("Can't handle op code:", op_name, file=sys.stderr)
 ###
 # Stack access hacks (required for showing stores to dicts/vectors)
+#
+# The layout of the frame differs between python versions; the layout is selected once (in _check_stack_access_sanity),
+# the offsets of the fields are taken from the ctypes structures below.
+# Each tracing thread has its own _StackReader, that reads the frame header and the stack entries into preallocated ctypes buffers.
 ###
 class PyObject(ctypes.Structure):
     _fields_ = (
@@ -72,7 +104,7 @@ class PyVarObject(ctypes.Structure):
 
 # lets hope the layout didn't change too much between versions...
 #
-# from: Include/cpython/frameobject.h
+# from: Include/cpython/frameobject.h (python 3.6 - 3.9)
 #
 # struct _frame {
 #    PyObject_VAR_HEAD
@@ -101,93 +133,240 @@ class PyFrm(PyVarObject):
         ("f_trace",  ctypes.c_void_p)
       )
 
-#def _access_stack(frame, num_entries):
-#    # id(frame) - is the pointer to the frame structure.
-#    # PyFrame.from_addr(id(frame)) - get ctypes wraper that points to the same address as the original frame object.
-#    py_frame = PyFrm.from_address(id(frame))
-#
-#    assert frame.f_stacktop.value is not None
-#    assert stack_top = frame.f_stacktop.value
+# python 3.10: f_stacktop is replaced by f_stackdepth, the number of entries on the stack (set while the trace function is called)
+class PyFrm310(PyVarObject):
+    _fields_ = (
+        ("f_back", ctypes.c_void_p),
+        ("f_code", ctypes.c_void_p),
+        ("f_builtins", ctypes.c_void_p),
+        ("f_globals", ctypes.c_void_p),
+        ("f_locals", ctypes.c_void_p),
+        ("f_valuestack",  ctypes.c_void_p),
+        ("f_trace",  ctypes.c_void_p),
+        ("f_stackdepth",  ctypes.c_int)
+      )
+
+# python 3.11 and later: the frame object points to the _PyInterpreterFrame, that holds the locals and the stack.
+# from: Include/internal/pycore_frameobject.h
+class PyFrm311(PyObject):
+    _fields_ = (
+        ("f_back", ctypes.c_void_p),
+        ("f_frame", ctypes.c_void_p),
+      )
 
-def _check_frame_ctypes(prev_frame):
-    current_frame = sys._getframe()
-    hdr = PyFrm.from_address(id(current_frame))
+# from: Include/internal/pycore_frame.h (python 3.11)
+# stacktop is the index of the first free stack entry in localsplus.
+class PyInterpFrame311(ctypes.Structure):
+    _fields_ = (
+        ("f_func", ctypes.c_void_p),
+        ("f_globals", ctypes.c_void_p),
+        ("f_builtins", ctypes.c_void_p),
+        ("f_locals", ctypes.c_void_p),
+        ("f_code", ctypes.c_void_p),
+        ("frame_obj", ctypes.c_void_p),
+        ("previous", ctypes.c_void_p),
+        ("prev_instr", ctypes.c_void_p),
+        ("stacktop", ctypes.c_int),
+        ("is_entry", ctypes.c_bool),
+        ("owner", ctypes.c_char),
+        ("localsplus", ctypes.c_void_p),
+      )
 
-    assert hex(hdr.f_back) == hex(id(current_frame.f_back))
-    assert hex(id(prev_frame)) == hex(id(current_frame.f_back))
-    assert hex(hdr.f_code) == hex(id(current_frame.f_code))
+# maximum number of stack entries, that are read at once.
+_MAX_STACK_READ = 4
 
-    return hex(hdr.f_back) == hex(id(current_frame.f_back)) and hex(id(prev_frame)) == hex(id(current_frame.f_back)) and hex(hdr.f_code) == hex(id(current_frame.f_code))
+# frame layout of python 3.6 - 3.9: f_stacktop points to the first free stack entry.
+class _FrameLayoutStackTop:
+    frame_struct = PyFrm
 
+    def __init__(self, name):
+        self.name = name
 
-def _check_stack_access_sanity():
-    global _CTYPES_ENABLED
-    global _CTYPES_POINTER_SIZE
-    global _CTYPES_ID_TYPE
+    def check_frame(self, reader, frame):
+        hdr = reader.read_frame(frame)
+        return hdr.f_code == id(frame.f_code) and hdr.f_back == id(frame.f_back)
 
-    if not _check_frame_ctypes(sys._getframe()):
-        print("Can't access stack directly; limited ability to trace variables", file=sys.stderr)
-        _CTYPES_ENABLED = -1
-        return False
+    def get_stack_top(self, reader, frame):
+        return reader.read_frame(frame).f_stacktop
 
-    _CTYPES_POINTER_SIZE = ctypes.sizeof(ctypes.c_void_p)
+# frame layout of python 3.10
+class _FrameLayoutStackDepth(_FrameLayoutStackTop):
+    frame_struct = PyFrm310
 
-    # find integr size with same size as pointer sze
-    if ctypes.sizeof(ctypes.c_ulonglong) == _CTYPES_POINTER_SIZE:
-        _CTYPES_ID_TYPE = ctypes.c_ulonglong
-    elif ctypes.sizeof(ctypes.c_ulong) == _CTYPES_POINTER_SIZE:
-        _CTYPES_ID_TYPE = ctypes.c_ulong
-    elif ctypes.sizeof(ctypes.c_uint) == _CTYPES_POINTER_SIZE:
-        _CTYPES_ID_TYPE = ctypes.c_uint
-    else:
-        print("Can't find integral type for pointer size!!!", file=sys.stderr)
+    def get_stack_top(self, reader, frame):
+        hdr = reader.read_frame(frame)
+        return hdr.f_valuestack + hdr.f_stackdepth * _CTYPES_POINTER_SIZE
+
+# frame layout of python 3.11 and later: the stack is in the _PyInterpreterFrame
+class _FrameLayoutInterpFrame:
+    frame_struct = PyFrm311
+
+    def __init__(self, name, interp_struct):
+        self.name = name
+        self.interp_struct = interp_struct
+        self.localsplus_offset = interp_struct.localsplus.offset
+
+    def check_frame(self, reader, frame):
+        # f_back of the frame object is filled lazily, compare the fields of the interpreter frame instead.
+        hdr = reader.read_frame(frame)
+        if not hdr.f_frame:
+            return False
+        interp = reader.read_interp_frame(hdr.f_frame)
+        return interp.f_code == id(frame.f_code) and interp.frame_obj == id(frame)
+
+    def get_stack_top(self, reader, frame):
+        interp_addr = reader.read_frame(frame).f_frame
+        return interp_addr + self.localsplus_offset + reader.read_interp_frame(interp_addr).stacktop * _CTYPES_POINTER_SIZE
+
+
+def _select_frame_layout():
+    if sys.implementation.name != "cpython":
+        return None
+    version = sys.version_info[:2]
+    if (3, 6) <= version <= (3, 9):
+        return _FrameLayoutStackTop("cpython-3.6-3.9")
+    if version == (3, 10):
+        return _FrameLayoutStackDepth("cpython-3.10")
+    if version == (3, 11):
+        return _FrameLayoutInterpFrame("cpython-3.11", PyInterpFrame311)
+    # 3.12: the opcode events come from the instrumented bytecode, the stack pointer is not saved in the frame
+    # (stacktop is -1 in the trace function). 3.13 replaced stacktop by a stack pointer. Both are not verified yet.
+    return None
+
+# the frame layout of this interpreter, set by _check_stack_access_sanity
+_FRAME_LAYOUT = None
+
+# reads stack entries of a frame, during a trace callback (the interpreter saves the stack pointer before calling the trace function)
+# All buffers are allocated once: reading the stack costs a few memmove calls, instead of creating a ctypes object per stack entry.
+class _StackReader:
+    def __init__(self, layout):
+        self.layout = layout
+        self.frame_buf = layout.frame_struct()
+        self.frame_size = ctypes.sizeof(self.frame_buf)
+        interp_struct = getattr(layout, "interp_struct", None)
+        if interp_struct is not None:
+            self.interp_buf = interp_struct()
+            self.interp_size = ctypes.sizeof(self.interp_buf)
+        self.addrs = (ctypes.c_void_p * _MAX_STACK_READ)()
+        self.ranges = [ list(range(num_entries)) for num_entries in range(_MAX_STACK_READ+1) ]
+
+    def read_frame(self, frame):
+        ctypes.memmove(ctypes.addressof(self.frame_buf), id(frame), self.frame_size)
+        return self.frame_buf
+
+    def read_interp_frame(self, addr):
+        ctypes.memmove(ctypes.addressof(self.interp_buf), addr, self.interp_size)
+        return self.interp_buf
+
+    # returns the addresses of num_entries entries, starting with the entry at stack_top - from_stack (None for a NULL entry)
+    def read_addrs(self, frame, from_stack, num_entries):
+        top_of_stack = self.layout.get_stack_top(self, frame)
+        ctypes.memmove(self.addrs, top_of_stack - _CTYPES_POINTER_SIZE * from_stack, _CTYPES_POINTER_SIZE * num_entries)
+        addrs = self.addrs
+        return [ addrs[ index ] for index in self.ranges[ num_entries ] ]
+
+    # returns num_entries objects, starting with the entry at stack_top - from_stack (so that the last entry returned is TOS, if from_stack == num_entries)
+    # Only used after _probe_stack_access passed: turning an address into an object increments its reference count, that must be a live object.
+    def read(self, frame, from_stack, num_entries):
+        return [ None if addr is None else ctypes.cast(addr, ctypes.py_object).value for addr in self.read_addrs(frame, from_stack, num_entries) ]
+
+
+def _stack_probe_target(container, key):
+    return container[ key ]
+
+# runs the probe function under a trace function and checks if the stack entries for BINARY_SUBSCR are read correctly.
+def _probe_stack_access(layout):
+    reader = _StackReader(layout)
+    container = { "probe" : 42 }
+    key = "probe"
+    found = []
+    subscr_op = opcode.opmap.get("BINARY_SUBSCR", None)
+    if subscr_op is None:
         return False
 
-    _CTYPES_ENABLED = 1
-    return True
+    def probe_tracer(frame, why, arg):
+        if frame.f_code is not _stack_probe_target.__code__:
+            return None
+        frame.f_trace_opcodes = True
+        if why == 'opcode' and frame.f_code.co_code[ frame.f_lasti ] == subscr_op:
+            if layout.check_frame(reader, frame):
+                # the slots are compared as addresses, they are not turned into objects: if the layout is wrong, they hold garbage.
+                found.append( reader.read_addrs(frame, 2, 2) )
+        return probe_tracer
+
+    prev_tracer = sys.gettrace()
+    sys.settrace(probe_tracer)
+    try:
+        _stack_probe_target(container, key)
+    finally:
+        sys.settrace(prev_tracer)
 
+    return len(found) == 1 and found[0] == [ id(container), id(key) ]
 
-def _access_frame_stack(frame, from_stack = 2, num_entries = 2):
-    hdr = PyFrm.from_address(id(frame))
-    assert hdr.f_stacktop is not None
 
-    ret = []
+def _check_stack_access_sanity():
+    global _CTYPES_ENABLED
+    global _CTYPES_POINTER_SIZE
+    global _FRAME_LAYOUT
 
-    item = 0
-    top_of_stack = hdr.f_stacktop - (_CTYPES_POINTER_SIZE * from_stack)
+    if _CTYPES_ENABLED == -1:
+        return False
 
-    while item < num_entries:
-        ptr_to_int = ctypes.c_ulong.from_address( top_of_stack )
+    _CTYPES_POINTER_SIZE = ctypes.sizeof(ctypes.c_void_p)
 
-        val =  ctypes.cast( ptr_to_int.value, ctypes.py_object).value
+    layout = _select_frame_layout()
+    if layout is None:
+        print(f"Can't access stack directly (unsupported python version {sys.implementation.name} {sys.version_info[0]}.{sys.version_info[1]}); limited ability to trace variables", file=sys.stderr)
+        _CTYPES_ENABLED = -1
+        return False
 
-#        #value = _CTYPES_ID_TYPE.from_address(ptr_to_int.ptr).value
-#        value = ctypes.c_ulong.from_address(ptr_to_int.value).value
-#        print("item:", item, "value:", value)
+    # check the fields of the frame header first, before trying to read the stack.
+    if not layout.check_frame(_StackReader(layout), sys._getframe()) or not _probe_stack_access(layout):
+        print(f"Can't access stack directly (frame layout {layout.name} doesn't match); limited ability to trace variables", file=sys.stderr)
+        _CTYPES_ENABLED = -1
+        return False
 
-        ret.append(val)
-        item += 1
-        top_of_stack += _CTYPES_POINTER_SIZE
+    _FRAME_LAYOUT = layout
+    _CTYPES_ENABLED = 1
+    return True
 
-    return ret
+def _make_stack_reader():
+    if _CTYPES_ENABLED != 1:
+        return None
+    return _StackReader(_FRAME_LAYOUT)
 
 
 # lOAD_FAST gets the value from macro
 # #define GETLOCAL(i)     (frame->localsplus[i])
 
+###
+# Opcode handlers: these extract a TraceRecord for each traced instruction, and pass it on to ctx.emit
+# The value of a record is only looked up, if one of the consumers wants to see values.
+###
+
+# argval is the argument of the instruction as resolved by dis (the name, for instructions that refer to a variable or an attribute)
+
+# the handlers must not raise: the exception would go to the traced code. Events whose value can't be looked up are left out.
+_UNBOUND = object()
+
 def _show_load_fast(frame, instr, argval, ctx):
-    varname = frame.f_code.co_varnames[ argval ]
-    val = frame.f_locals[ varname ]
-    prefix = ctx.get_line_prefix(frame, 1)
-    sval = ctx.show_val(val)
-    print(f"{prefix} # load {varname} {sval}", file=ctx.params.out)
+    if not ctx.wants("load"):
+        return
+    varname = argval
+    val = frame.f_locals.get( varname, _UNBOUND ) if ctx.wants_values else None
+    if val is _UNBOUND:
+        return
+    ctx.emit(frame, "load", name=varname, value=val)
 
 def _show_store_fast(frame, asm_instr, argval, ctx):
-    varname = frame.f_code.co_varnames[ argval ]
-    val = frame.f_locals[ varname ]
-    prefix = ctx.get_line_prefix(frame, 1)
-    sval = ctx.show_val(val)
-    print(f"{prefix} # store {varname} {sval}", file=ctx.params.out)
+    if not ctx.wants("store"):
+        return
+    varname = argval
+    # python 3.12+: the store that restores the iteration variable of an inlined comprehension can leave it unbound.
+    val = frame.f_locals.get( varname, _UNBOUND ) if ctx.wants_values else None
+    if val is _UNBOUND:
+        return
+    ctx.emit(frame, "store", name=varname, value=val)
 
 
 def _get_type_of_val(val):
@@ -198,13 +377,11 @@ def _get_type_and_id(val):
 
 
 def _show_global_imp(frame, instr, argval, ctx, cmd_name):
-
-    try:
-        varname = frame.f_code.co_names[ argval ]
-    except IndexError:
-        print(f"Error: {cmd_name} can't resolve argval Instruction: {instr} argval: {argval}, frame: {frame}", file=sys.stderr)
+    if not ctx.wants(cmd_name):
         return
 
+    varname = argval
+
     if varname in frame.f_globals:
         val = frame.f_globals[ varname ]
     elif varname in frame.f_builtins:
@@ -214,105 +391,94 @@ def _show_global_imp(frame, instr, argval, ctx, cmd_name):
     elif varname in globals():
         val = globals()[ varname ]
     else:
-        print("{cmd_name}: can't find ", varname, "in any scope", file=sys.stderr)
+        print(f"{cmd_name}: can't find ", varname, "in any scope", file=sys.stderr)
         return
 
-    prefix = ctx.get_line_prefix(frame, 1)
-    sval = ctx.show_val(val)
-    type_name=_get_type_of_val(val)
-    print(f"{prefix} # {cmd_name} {varname} {sval} (type: {type_name})", file=ctx.params.out)
+    ctx.emit(frame, cmd_name, name=varname, value=val)
 
 
 def _show_load_global(frame, instr, argval, ctx):
     _show_global_imp(frame, instr, argval, ctx, 'load_global')
 
 def _show_store_global(frame, asm_instr, argval, ctx):
-    _show_global_imp(frame, instr, argval, ctx, 'store_global')
+    _show_global_imp(frame, asm_instr, argval, ctx, 'store_global')
+
+def _get_subscr_title(obj, sep):
+    if isinstance(obj, typing.Dict):
+        return f"dict{sep}on{sep}stack"
+    if isinstance(obj, typing.List):
+        return f"list{sep}on{sep}stack"
+    return str(type(obj)) + "-on-stack"
 
 def _binary_subscr(frame, asm_instr, argval, ctx):
-    if _CTYPES_ENABLED != 1:
+    if ctx.stack_reader is None or not ctx.wants("load_subscr"):
         return
 
     # implements TOS = TOS1[TOS]
-    vals = _access_frame_stack(frame, from_stack=2, num_entries=2)
+    vals = ctx.stack_reader.read(frame, 2, 2)
 
     obj = vals[0]
     key = vals[1]
-    deref_val = obj[ key ]
-    prefix = ctx.get_line_prefix(frame, 1)
-    sval = ctx.show_val(deref_val)
-
-    if isinstance(obj, typing.Dict):
-        title="dict_on_stack"
-    elif isinstance(obj, typing.List):
-        title="list_on_stack"
-    else:
-        title=str(type(obj)) + "-on-stack"
+    deref_val = None
+    if ctx.wants_values:
+        try:
+            deref_val = obj[ key ]
+        except Exception:
+            # the instruction raises the same error.
+            return
 
-    print(f"{prefix} # load {title}[{repr(key)}] {sval}", file=ctx.params.out)
+    ctx.emit(frame, "load_subscr", value=deref_val, obj=obj, key=key, title=_get_subscr_title(obj, "_"))
 
 
 def _store_subscr(frame, asm_instr, argval, ctx):
-    if _CTYPES_ENABLED != 1:
+    if ctx.stack_reader is None or not ctx.wants("store_subscr"):
         return
 
     # implements TOS1[TOS] = TOS2
-    vals = _access_frame_stack(frame, from_stack=3, num_entries=3)
+    vals = ctx.stack_reader.read(frame, 3, 3)
 
     deref_val = vals[0]
     obj = vals[1]
     key = vals[2]
 
-    if isinstance(obj, typing.Dict):
-        title="dict-on-stack"
-    elif isinstance(obj, typing.List):
-        title="list-on-stack"
-    else:
-        title=str(type(obj)) + "-on-stack"
-
-    prefix = ctx.get_line_prefix(frame, 1)
-    sval = ctx.show_val(deref_val)
-
-    print(f"{prefix} # store {title}[{repr(key)}]={sval}", file=ctx.params.out)
+    ctx.emit(frame, "store_subscr", value=deref_val, obj=obj, key=key, title=_get_subscr_title(obj, "-"))
 
 def _show_load_attr(frame, asm_instr, argval, ctx):
-    if _CTYPES_ENABLED != 1:
+    if ctx.stack_reader is None or not ctx.wants("load_attr"):
         return
 
-    # Replaces TOS with getattr(TOS, co_names[ argval ]).
-    vals = _access_frame_stack(frame, from_stack=1, num_entries=1)
+    # Replaces TOS with getattr(TOS, argval).
+    vals = ctx.stack_reader.read(frame, 1, 1)
 
     #print(f"load_attr: vals[0] {hex(id(vals[0]))}", file=ctx.params.out)
 
     obj = vals[0]
-    title=_get_type_and_id(obj)
-    name = frame.f_code.co_names[ argval ]
-    val=getattr(obj, name)
-
-    prefix = ctx.get_line_prefix(frame, 1)
-    sval = ctx.show_val(val)
+    name = argval
+    val = None
+    if ctx.wants_values:
+        try:
+            val = getattr(obj, name)
+        except Exception:
+            # the instruction raises the same error.
+            return
 
-    print(f"{prefix} # load_attr {title}.{name} {sval}", file=ctx.params.out)
+    ctx.emit(frame, "load_attr", name=name, value=val, obj=obj)
 
 
 def _show_store_attr(frame, asm_instr, argval, ctx):
-    if _CTYPES_ENABLED != 1:
+    if ctx.stack_reader is None or not ctx.wants("store_attr"):
         return
-    name = frame.f_code.co_names[ argval ]
-    prefix = ctx.get_line_prefix(frame, 1)
+    name = argval
 
-    #Implements TOS.name = TOS1, where argval is the index of name in co_names.
-    vals = _access_frame_stack(frame, from_stack=2, num_entries=2)
+    #Implements TOS.name = TOS1
+    vals = ctx.stack_reader.read(frame, 2, 2)
 
     val = vals[0]
     obj = vals[1]
 
     #print(f"store_attr: vals[0] {hex(id(vals[0]))} vals[1] {hex(id(vals[1]))}", file=ctx.params.out)
 
-    title = _get_type_and_id(obj)
-    sval = ctx.show_val(val)
-
-    print(f"{prefix} # store_attr {title}.{name}={sval}", file=ctx.params.out)
+    ctx.emit(frame, "store_attr", name=name, value=val, obj=obj)
 
 
 def _init_opcodes():
@@ -326,43 +492,496 @@ def _init_opcodes():
     _add_opcode( "LOAD_ATTR", _LOAD_OPCODES, _show_load_attr)
     _add_opcode( "STORE_ATTR", _LOAD_OPCODES, _show_store_attr)
 
-
+    _enable_opcode_events()
     _check_stack_access_sanity()
 
+# python 3.12: sys.settrace only turns on opcode events, if f_trace_opcodes has been set on some frame before
+# (the interpreter keeps a flag for that); it is set once, before the first trace starts.
+def _enable_opcode_events():
+    frame = sys._getframe()
+    frame.f_trace_opcodes = True
+    frame.f_trace_opcodes = False
+
+_INIT_LOCK = threading.Lock()
+_INIT_DONE = False
+
+# the opcode tables and the stack access check are set up before the first trace, not at import time.
+# (must not be called from a trace function: the stack access probe needs a trace hook of its own)
+def _ensure_init():
+    global _INIT_DONE
+
+    if _INIT_DONE:
+        return
+    with _INIT_LOCK:
+        if not _INIT_DONE:
+            _init_opcodes()
+            _INIT_DONE = True
+
+
+###
+# Trace events and consumers
+###
+
+# kinds of events, that are produced by opcode handlers (tracing of opcodes is only turned on, if a consumer wants one of these)
+OPCODE_EVENT_KINDS = frozenset(( "load", "store", "load_global", "store_global", "load_subscr", "store_subscr", "load_attr", "store_attr" ))
+
+# all kinds of events: 'call' is sent upon entering a function, followed by one 'arg' event per argument; 'line' is sent before a source line is executed.
+# generators and coroutines: 'call' and 'return' are sent for the first call and the final return, 'yield' and 'resume' when the frame is suspended/resumed.
+EVENT_KINDS = frozenset(( "call", "arg", "line", "return", "yield", "resume" )) | OPCODE_EVENT_KINDS
+
+# frames of these code objects are suspended and resumed.
+_GENERATOR_FLAGS = inspect.CO_GENERATOR | inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR
+_RESUME_OPCODE = dis.opmap.get("RESUME", None)
+_YIELD_OPCODES = frozenset( dis.opmap[ name ] for name in ("YIELD_VALUE", "YIELD_FROM") if name in dis.opmap )
+
+# code objects of comprehensions (these are inlined with python 3.12, except for generator expressions)
+_COMPREHENSION_NAMES = frozenset(( "<listcomp>", "<setcomp>", "<dictcomp>", "<genexpr>" ))
+
+# offsets of the instructions of the inlined comprehensions of a code object (python 3.12+): from the LOAD_FAST_AND_CLEAR that
+# saves the iteration variables, to the end of the loop, and the stores that restore the variables after it.
+def _get_inlined_comprehensions(code):
+    insts = list(dis.get_instructions(code))
+    folded = set()
+    pos = 0
+    while pos < len(insts):
+        if insts[pos].opname != "LOAD_FAST_AND_CLEAR":
+            pos += 1
+            continue
+        start = insts[pos].offset
+        saved = set()
+        while pos < len(insts) and insts[pos].opname == "LOAD_FAST_AND_CLEAR":
+            saved.add(insts[pos].argval)
+            pos += 1
+        loop = next(( inst for inst in insts[ pos : ] if inst.opname == "FOR_ITER" ), None)
+        if loop is None:
+            break
+        # nested comprehensions are part of the loop.
+        while pos < len(insts) and insts[pos].offset <= loop.argval:
+            folded.add(insts[pos].offset)
+            pos += 1
+        folded.add(start)
+        # the result is stored before the variables are restored.
+        while pos < len(insts) and insts[pos].opname in ("END_FOR", "POP_TOP", "SWAP", "STORE_FAST"):
+            if insts[pos].opname == "STORE_FAST" and insts[pos].argval in saved:
+                folded.add(insts[pos].offset)
+            pos += 1
+    return frozenset(folded)
+
+# 'call' event of a generator frame: is the frame resumed after a yield/await (or is it the first call)?
+def _is_resumed(frame):
+    lasti = frame.f_lasti
+    if lasti < 0:
+        return False
+    if _RESUME_OPCODE is None:
+        return True
+    # 3.11+: RESUME with argument 0 is at the start of the function, other arguments follow yield/await.
+    code = frame.f_code.co_code
+    return not (code[lasti] == _RESUME_OPCODE and (code[lasti+1] & 3) == 0)
+
+# 'return' event of a generator frame: is the frame suspended (or does it return for good)?
+def _is_suspended(frame):
+    lasti = frame.f_lasti
+    return lasti >= 0 and frame.f_code.co_code[lasti] in _YIELD_OPCODES
+
+# one trace event, as passed to TraceConsumer.on_event
+# value is the raw python object (None if no consumer wants values), obj is the object/container that is accessed by attribute and subscript events.
+@dataclasses.dataclass
+class TraceRecord:
+    kind: str
+    filename: str
+    bname: str
+    lineno: int
+    nesting: int
+    code: typing.Any
+    offset: int
+    name: typing.Optional[str] = None
+    value: typing.Any = None
+    obj: typing.Any = None
+    key: typing.Any = None
+    title: typing.Optional[str] = None
+
+    def location(self):
+        return f"{self.bname}:{self.lineno}({self.nesting})"
+
+def format_value(val, show_obj):
+    try:
+        if show_obj == 0:
+            return str(val)
+        elif show_obj == 1:
+            return repr(val)
+        return pprint.pformat(val)
+    except AttributeError:
+        # object is not yet initialised
+        return None
+
+# base class of trace consumers; each event is passed to on_event, on_end is called when the outermost traced function returns.
+# wants_values - set to False, if the consumer doesn't look at TraceRecord.value (saves the lookup of the value)
+# event_kinds  - set of event kinds the consumer wants to see, None for all events.
+class TraceConsumer:
+    wants_values = True
+    event_kinds = None
+
+    def on_event(self, rec : TraceRecord):
+        pass
+
+    def on_end(self):
+        pass
+
+# the default consumer: writes the text trace.
+class TextTraceConsumer(TraceConsumer):
+    def __init__(self, out = sys.stderr, *, show_obj : int = 1, trace_indent : bool = False):
+        self.out = out
+        self.show_obj = show_obj
+        self.trace_indent = trace_indent
+        self.prefix_spaces = 0
+
+    def get_line_prefix(self, rec, add_prefix):
+        ret = f"{rec.bname}:{rec.lineno}({rec.nesting})"
+        if self.trace_indent:
+            ret += ('.' * rec.nesting)
+        ret += (" " * self.prefix_spaces * add_prefix)
+
+        return ret
+
+    def on_event(self, rec : TraceRecord):
+        kind = rec.kind
+        if kind == "line":
+            self.on_line(rec)
+        elif kind == "call":
+            self.on_call(rec)
+        elif kind == "arg":
+            sval = format_value(rec.value, self.show_obj)
+            if sval is not None:
+                print(f"{self.get_line_prefix(rec, 1)} # {rec.name}={sval}", file=self.out)
+        elif kind == "return" or kind == "yield":
+            sval = format_value(rec.value, self.show_obj)
+            print(f"{self.get_line_prefix(rec, 1)} {kind}={sval}", file=self.out)
+        elif kind == "resume":
+            print(f"{self.get_line_prefix(rec, 1)} # resume {getattr(rec.code, 'co_qualname', rec.code.co_name)}", file=self.out)
+        else:
+            self.on_opcode_event(rec)
+
+    def on_end(self):
+        # the consumer can be passed to several traces (TraceClass, attach_trace), the next one starts unindented.
+        self.prefix_spaces = 0
+        self.out.flush()
+
+    def on_call(self, rec):
+        firstline = rec.code.co_firstlineno
+
+        linestarts = next(dis.findlinestarts(rec.code))[1]
+
+        while firstline < linestarts:
+            line = linecache.getline(rec.filename, firstline)
+            print(f"{self.get_line_prefix(rec, 0)} {line}", end="", file=self.out)
+            firstline += 1
+
+    def on_line(self, rec):
+        line = linecache.getline(rec.filename, rec.lineno)
+        print(f"{self.get_line_prefix(rec, 0)} {line}", end='', file=self.out)
+
+        # count prefix spaces.
+        line_len = len(line)
+        pos=0
+        spaces=0
+        while pos < line_len:
+            if line[pos] == ' ':
+                self.prefix_spaces = spaces + 1
+                spaces+=1
+            elif line[pos] == '\t':
+                self.prefix_spaces = spaces + 1
+                spaces += _TABS_TO_SPACES
+            else:
+                break
+            pos += 1
+
+    def on_opcode_event(self, rec):
+        kind = rec.kind
+        prefix = self.get_line_prefix(rec, 1)
+        sval = format_value(rec.value, self.show_obj)
+
+        if kind in ("load", "store"):
+            print(f"{prefix} # {kind} {rec.name} {sval}", file=self.out)
+        elif kind in ("load_global", "store_global"):
+            type_name=_get_type_of_val(rec.value)
+            print(f"{prefix} # {kind} {rec.name} {sval} (type: {type_name})", file=self.out)
+        elif kind == "load_subscr":
+            print(f"{prefix} # load {rec.title}[{repr(rec.key)}] {sval}", file=self.out)
+        elif kind == "store_subscr":
+            print(f"{prefix} # store {rec.title}[{repr(rec.key)}]={sval}", file=self.out)
+        elif kind == "load_attr":
+            print(f"{prefix} # load_attr {_get_type_and_id(rec.obj)}.{rec.name} {sval}", file=self.out)
+        elif kind == "store_attr":
+            print(f"{prefix} # store_attr {_get_type_and_id(rec.obj)}.{rec.name}={sval}", file=self.out)
+
+# writes the structured trace format (one json object per line), that can be loaded with pyasmtools.query.load_trace
+class JsonTraceConsumer(TraceConsumer):
+    def __init__(self, out, *, show_obj : int = 1):
+        self.out = out
+        self.show_obj = show_obj
+
+    def on_event(self, rec : TraceRecord):
+        if rec.kind == "call":
+            return
+        entry = { "kind" : rec.kind, "file" : rec.bname, "line" : rec.lineno, "nesting" : rec.nesting }
+        if rec.name is not None:
+            entry["name"] = rec.name
+        if rec.kind == "line":
+            entry["value"] = linecache.getline(rec.filename, rec.lineno).strip()
+        else:
+            entry["value"] = format_value(rec.value, self.show_obj)
+        if rec.obj is not None:
+            entry["obj_type"] = _get_type_of_val(rec.obj)
+            entry["obj_id"] = hex(id(rec.obj))
+        elif rec.title is not None:
+            entry["obj_type"] = rec.title
+        if rec.kind in ("load_subscr", "store_subscr"):
+            entry["key"] = repr(rec.key)
+        print(json.dumps(entry), file=self.out)
+
+# collects all events into a list, the collector can be iterated over after tracing.
+# Note that the records keep references to the traced values.
+class EventCollector(TraceConsumer):
+    def __init__(self, *, wants_values : bool = True, event_kinds = None):
+        self.wants_values = wants_values
+        self.event_kinds = event_kinds
+        self.events = []
+
+    def on_event(self, rec : TraceRecord):
+        self.events.append(rec)
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __len__(self):
+        return len(self.events)
+
+# maximum number of mutations kept in the timeline of a single object.
+_MAX_TIMELINE_ENTRIES = 32
+
+# entry of the object tracking table.
+class _TrackedObject:
+    __slots__ = ("type_name", "obj_id", "first_seen", "last_mutation", "num_mutations", "timeline", "is_dead")
+
+    def __init__(self, type_name, obj_id, first_seen):
+        self.type_name = type_name
+        self.obj_id = obj_id
+        self.first_seen = first_seen
+        self.last_mutation = None
+        self.num_mutations = 0
+        self.timeline = []
+        self.is_dead = False
+
+# keeps an id -> (type, first-seen, last-mutation) table for objects that are accessed by the traced code.
+# weakref callbacks notice when an object is freed, so that a new object with the same id gets a new entry.
+# (objects without weakref support, like dicts and lists, are assumed to be reused if the type of the object at the same id changes)
+class ObjectTracker(TraceConsumer):
+    event_kinds = frozenset(( "load_attr", "store_attr", "load_subscr", "store_subscr" ))
+
+    def __init__(self, out = sys.stderr, *, show_obj : int = 1):
+        self.out = out
+        self.show_obj = show_obj
+        self.objects = {}
+        self.finished = []
+        self.refs = {}
+
+    def _on_object_freed(self, obj_id):
+        entry = self.objects.pop(obj_id, None)
+        self.refs.pop(obj_id, None)
+        if entry is not None:
+            entry.is_dead = True
+            self.finished.append(entry)
+
+    def _get_entry(self, obj, location):
+        obj_id = id(obj)
+        type_name = _get_type_of_val(obj)
+        entry = self.objects.get(obj_id, None)
+
+        if entry is not None and entry.type_name == type_name:
+            return entry
+
+        if entry is not None:
+            # id has been reused by an object of a different type.
+            self._on_object_freed(obj_id)
+
+        entry = _TrackedObject(type_name, obj_id, location)
+        self.objects[obj_id] = entry
+        try:
+            self.refs[obj_id] = weakref.ref(obj, lambda _ref, obj_id=obj_id: self._on_object_freed(obj_id))
+        except TypeError:
+            pass
+        return entry
+
+    def on_event(self, rec : TraceRecord):
+        if rec.obj is None:
+            return
+        location = rec.location()
+        if rec.kind == "store_attr":
+            self.on_mutation(rec.obj, location, f"store_attr .{rec.name}={format_value(rec.value, self.show_obj)}")
+        elif rec.kind == "store_subscr":
+            self.on_mutation(rec.obj, location, f"store [{repr(rec.key)}]={format_value(rec.value, self.show_obj)}")
+        else:
+            self.on_access(rec.obj, location)
+
+    def on_access(self, obj, location):
+        self._get_entry(obj, location)
+
+    def on_mutation(self, obj, location, desc):
+        entry = self._get_entry(obj, location)
+        entry.last_mutation = location
+        entry.num_mutations += 1
+        if len(entry.timeline) < _MAX_TIMELINE_ENTRIES:
+            entry.timeline.append(f"{location} {desc}")
+
+    def on_end(self):
+        if self.objects or self.finished:
+            self.show_report(self.out)
+
+    def show_report(self, out):
+        entries = self.finished + list(self.objects.values())
+        entries.sort(key=lambda entry: entry.num_mutations, reverse=True)
+        total = sum(entry.num_mutations for entry in entries)
+
+        print(f"# object tracking: {len(entries)} objects, {total} mutations", file=out)
+        for entry in entries:
+            state = " (freed)" if entry.is_dead else ""
+            print(f"# {entry.type_name}_at_{hex(entry.obj_id)}{state} first-seen: {entry.first_seen} last-mutation: {entry.last_mutation} mutations: {entry.num_mutations}", file=out)
+            for timeline_entry in entry.timeline:
+                print(f"#     {timeline_entry}", file=out)
+            if entry.num_mutations > len(entry.timeline):
+                print(f"#     ... {entry.num_mutations - len(entry.timeline)} more mutations", file=out)
+
+
+# the consumers that write the trace: the consumers parameter, or the text trace
+def _make_output_consumers(params : TraceParam):
+    if params.consumers is not None:
+        return list(params.consumers)
+    if params.fold_loops:
+        from .loopfold import LoopFoldingConsumer
+        return [ LoopFoldingConsumer(params.out, keep=params.fold_loops, show_obj=params.show_obj, trace_indent=params.trace_indent) ]
+    return [ TextTraceConsumer(params.out, show_obj=params.show_obj, trace_indent=params.trace_indent) ]
+
+def _make_consumers(params : TraceParam):
+    # memory mode: no text trace, its formatting and writing would be charged to the traced lines.
+    consumers = _make_output_consumers(params) if params.memory_profile is None or params.consumers is not None else []
+    if params.track_objects:
+        consumers.append( ObjectTracker(params.out, show_obj=params.show_obj) )
+    if params.memory_profile is not None:
+        consumers.append( params.memory_profile )
+    if params.tracer_stats is not None:
+        # last one: the report is written after the other consumers are done.
+        consumers.append( params.tracer_stats )
+    return consumers
+
+
+# directories of the standard library and of installed packages (ignored with ignore_stdlib)
+def _get_stdlib_dirs():
+    dirs = set()
+    paths = sysconfig.get_paths()
+    for name in ("stdlib", "platstdlib", "purelib", "platlib"):
+        if name in paths:
+            dirs.add( os.path.join(os.path.abspath(paths[ name ]), "") )
+    try:
+        dirs.add( os.path.join(os.path.abspath(site.getusersitepackages()), "") )
+    except AttributeError:
+        pass
+    return tuple(dirs)
+
+_STDLIB_DIRS = None
+_TRACED_FILE_CACHE = {}
+
+# should functions of this file be traced? (the code of pyasmtools is never traced)
+def is_traced_file(filename, ignore_stdlib):
+    global _STDLIB_DIRS
+
+    key = (filename, ignore_stdlib)
+    ret = _TRACED_FILE_CACHE.get(key, None)
+    if ret is not None:
+        return ret
+
+    bname = os.path.basename(filename)
+    # co_filename is relative, if the module was imported by a relative entry of sys.path (like the current directory)
+    abs_filename = os.path.abspath(filename)
+
+    ret = True
+    if bname == "<string>" or os.path.dirname(abs_filename) == _PACKAGE_DIR:
+        ret = False
+    elif ignore_stdlib:
+        # the directory of the script is in sys.path too, therefore check for the install locations of python.
+        if _STDLIB_DIRS is None:
+            _STDLIB_DIRS = _get_stdlib_dirs()
+        ret = not filename.startswith("<frozen ") and not abs_filename.startswith(_STDLIB_DIRS)
+
+    _TRACED_FILE_CACHE[key] = ret
+    return ret
+
 
 class ThreadTraceCtx:
     def __init__(self, params : TraceParam):
         self.nesting = 0
+        self.active_calls = 0
         self.params = params
         self.in_trace = False
+        # code object -> arguments of its instructions (see get_instr_args)
         self.instr_cache = {}
+        # code object -> offsets of its inlined comprehensions (python 3.12+, with fold_comprehensions)
+        self.fold_inlined = params.fold_comprehensions and sys.version_info >= (3, 12)
+        self.inlined_cache = {}
         self.prev_instr = None
         self.prev_instr_arg = None
-        self.prefix_spaces = 0
+        self.bnames = {}
+        # coverage mode: the trace function of the coverage replaces this one, there is no trace output.
+        self.stack_reader = _make_stack_reader() if params.coverage is None else None
+        # opcode -> handler (replaced by timed versions, with tracer_stats)
+        self.load_opcodes = _LOAD_OPCODES
+        self.store_opcodes = _STORE_OPCODES
+        if params.tracer_stats is not None:
+            params = dataclasses.replace(params, out=params.tracer_stats.wrap_out(params.out))
+            self.params = params
+        self.set_consumers( _make_consumers(params) if params.coverage is None else [] )
+        if params.tracer_stats is not None:
+            params.tracer_stats.instrument(self)
 #       self.prev_line_entry = None
 
-    def show_val(self, val):
-        assert self.in_trace is True
-        try:
-            if self.params.show_obj == 0:
-                return str(val)
-            elif self.params.show_obj == 1:
-                return repr(val)
-            return pprint.pformat(val)
-        except AttributeError:
-            # object is not yet initialised
-            return None
+    def set_consumers(self, consumers):
+        self.consumers = consumers
+        self.wants_values = any(consumer.wants_values for consumer in consumers)
+
+        if any(consumer.event_kinds is None for consumer in consumers):
+            self.event_kinds = None
+        else:
+            self.event_kinds = frozenset().union(*[ consumer.event_kinds for consumer in consumers ])
+
+        # no need to trace opcodes, if nobody looks at them.
+        self.trace_opcodes = self.event_kinds is None or not self.event_kinds.isdisjoint(OPCODE_EVENT_KINDS)
+
+    def wants(self, kind):
+        return self.event_kinds is None or kind in self.event_kinds
+
+    # stop sending events for the rest of this trace (the consumers still get on_end, when the trace ends)
+    def mute(self):
+        self.event_kinds = frozenset()
+        self.trace_opcodes = False
+
+    def emit(self, frame, kind, *, name=None, value=None, obj=None, key=None, title=None):
+        code = frame.f_code
+        filename = code.co_filename
+        bname = self.bnames.get(filename, None)
+        if bname is None:
+            bname = os.path.basename(filename)
+            self.bnames[filename] = bname
+
+        rec = TraceRecord(kind, filename, bname, frame.f_lineno, self.nesting, code, frame.f_lasti, name=name, value=value, obj=obj, key=key, title=title)
+        for consumer in self.consumers:
+            if consumer.event_kinds is None or kind in consumer.event_kinds:
+                consumer.on_event(rec)
 
 
     def on_prepare(self, frame):
         filename = frame.f_code.co_filename
-        bname = os.path.basename(filename)
-        dirname = os.path.dirname(filename)
-
-        if self.params.ignore_stdlib and dirname in sys.path:
-            return False
-        if bname == "prettytrace.py" or bname == "<string>":
+        if not is_traced_file(filename, self.params.ignore_stdlib):
             return False
+        bname = os.path.basename(filename)
 
 #        if self.bname == "codecs.py":
 #        print(f"~~ {self.params.ignore_stdlib} :: {dirname} :: {sys.path} :: {dirname in sys.path}")
@@ -376,104 +995,103 @@ class ThreadTraceCtx:
 
         self.nesting += 1
         #print("on_push_frame nesting:", id(self), self.nesting, "type(frame):", type(frame), frame.f_code.co_filename, frame.f_code.co_name)
-        firstline = frame.f_code.co_firstlineno
 
-        linestarts = next(dis.findlinestarts(frame.f_code))[1]
+        if frame.f_code.co_flags & _GENERATOR_FLAGS and _is_resumed(frame):
+            # the header and the arguments have been shown for the first call of the generator.
+            if self.wants("resume"):
+                self.emit(frame, "resume")
+            return
 
-        #self.disasm_func( frame.f_code )
+        if self.wants("call"):
+            self.emit(frame, "call")
 
-        while firstline < linestarts:
-            line = linecache.getline(self.filename, firstline)
-            print(f"{self.get_line_prefix(frame, 0)} {line}", end="", file=self.params.out)
-            firstline += 1
-
-        # if __init__ method, then don't show first param, self is not yet initialised.
-#        is_init_method = False
-#        if frame.f_code.co_name == "__init__":
-#            is_init_method = True
-#
-        arg_info = inspect.getargvalues(frame)
-        #print("arg_info:", arg_info)
-        for arg in arg_info.args:
-            sval = self.show_val(arg_info.locals[arg])
-            if sval is not None:
-                print(f"{self.get_line_prefix(frame, 1)} # {arg}={sval}", file=self.params.out)
+        if self.wants("arg"):
+            arg_info = inspect.getargvalues(frame)
+            #print("arg_info:", arg_info)
+            for arg in arg_info.args:
+                self.emit(frame, "arg", name=arg, value=arg_info.locals[arg] if self.wants_values else None)
 
         #print(frame.f_code.co_filename, frame.f_code.co_name, "firstline:", firstline, "first-code-line:", linestarts[1])
 
     def on_prev_opcode(self, frame):
         if self.prev_instr is not None:
             #print("prev_instr:", self.prev_instr)
-            func = _STORE_OPCODES.get(self.prev_instr, None)
+            func = self.store_opcodes.get(self.prev_instr, None)
             if func is not None:
-                func(frame, self.prev_instr, self.prev_instr_arg, self) #self.get_line_prefix(frame, 1))
+                func(frame, self.prev_instr, self.prev_instr_arg, self)
                 self.prev_instr = None
 
 
     def on_opcode(self, frame):
         self.on_prev_opcode(frame)
 
+        code = frame.f_code
         byte_index = frame.f_lasti
-        instr = frame.f_code.co_code[byte_index]
+        if self.fold_inlined and byte_index in self.get_inlined_comprehensions(code):
+            self.prev_instr = None
+            return
+        instr = code.co_code[byte_index]
 
-        func = _LOAD_OPCODES.get(instr, None)
-        arg = frame.f_code.co_code[byte_index+1]
+        func = self.load_opcodes.get(instr, None)
+        arg = None
         if func is not None:
-            func(frame, instr, arg, self) #self.get_line_prefix(frame, 1))
+            arg = self.get_instr_args(code)[ byte_index ]
+            func(frame, instr, arg, self)
+        elif instr in self.store_opcodes:
+            arg = self.get_instr_args(code)[ byte_index ]
 
         self.prev_instr = instr
         self.prev_instr_arg = arg
 
-    def get_line_prefix(self, frame, add_prefix):
-        lineno = frame.f_lineno
-        ret = f"{self.bname}:{lineno}({self.nesting})"
-        if self.params.trace_indent:
-            ret += ('.' * self.nesting)
-        ret += (" " * self.prefix_spaces * add_prefix)
-
-        return ret
-
+    # offset -> argument of each instruction of a code object, as resolved by dis. The raw oparg can't be used: it may have EXTENDED_ARG
+    # prefixes, and with python 3.11+ LOAD_GLOBAL (3.12+ LOAD_ATTR too) keep a flag in the lowest bit.
+    def get_instr_args(self, code):
+        args = self.instr_cache.get(code, None)
+        if args is None:
+            args = { inst.offset : inst.argval for inst in dis.get_instructions(code) }
+            self.instr_cache[ code ] = args
+        return args
+
+    def get_inlined_comprehensions(self, code):
+        folded = self.inlined_cache.get(code, None)
+        if folded is None:
+            folded = _get_inlined_comprehensions(code)
+            self.inlined_cache[ code ] = folded
+        return folded
+
+    # the global trace function for this trace
+    def get_tracer(self):
+        if self.params.coverage is not None:
+            return self.params.coverage.get_tracer(self.params.ignore_stdlib)
+        return _func_tracer
+
+    def on_end(self):
+        if self.params.coverage is not None:
+            self.params.coverage.on_end()
+            return
+        for consumer in self.consumers:
+            consumer.on_end()
 
     def on_line(self, frame):
         # after completion of the previous line - show stores for that line.
-#        if self.prev_line_entry is not None:
-#            self.show_stores(frame)
-
         self.on_prev_opcode(frame)
-        lineno = frame.f_lineno
-        line = linecache.getline(self.filename, lineno)
-        print(f"{self.get_line_prefix(frame, 0)} {line}", end='', file=self.params.out)
-
-        # count prefix spaces.
-        line_len = len(line)
-        pos=0
-        spaces=0
-        while pos < line_len:
-            if line[pos] == ' ':
-                self.prefix_spaces = spaces + 1
-                spaces+=1
-            elif line[pos] == '\t':
-                self.prefix_spaces = spaces + 1
-                spaces += _TABS_TO_SPACES
-            else:
-                break
-            pos += 1
-
-#        self.prev_line_entry = self.instr_cache[ self.filename ][ frame.f_code.co_name ][ lineno ]
-#        self.show_loads(frame)
+        if self.fold_inlined and frame.f_lasti in self.get_inlined_comprehensions(frame.f_code):
+            # the next iteration of an inlined comprehension.
+            return
+        if self.wants("line"):
+            self.emit(frame, "line")
 
 
     def on_pop_frame(self, frame, arg):
         #print("on_pop_frame type(frame):", type(frame), frame.f_code.co_filename, frame.f_code.co_name)
-        sval = self.show_val(arg)
-        print(f"{self.get_line_prefix(frame, 1)} return={sval}", file=self.params.out)
+        kind = "return"
+        if frame.f_code.co_flags & _GENERATOR_FLAGS and _is_suspended(frame):
+            kind = "yield"
+        if self.wants(kind):
+            self.emit(frame, kind, value=arg)
         self.nesting -= 1
 
 
-    # disassemble a  function, for each line establih a LineEntry - it holds two sets. 1) the set of load 2) set of store type instructions.
-    # Fill the instr_cache with entries self.instr_cache[ module ][ functon_name ][ line_number ] = LineEntry()
-
-
 def _line_tracer(frame, why, arg):
     ctx = getattr(local_data_,"trace_ctx")
     if ctx.in_trace:
@@ -498,8 +1116,13 @@ def _func_tracer(frame, why, arg):
         return
     if not ctx.on_prepare(frame):
         return
+    if ctx.params.fold_comprehensions and frame.f_code.co_name in _COMPREHENSION_NAMES:
+        # the comprehension is shown as part of the line that contains it.
+        return
 
-    frame.f_trace_opcodes = True
+    # python 3.13: opcode events are only turned on for a frame that has a trace function already.
+    frame.f_trace = _line_tracer
+    frame.f_trace_opcodes = ctx.trace_opcodes
     ctx.in_trace=True
     if why == 'call':
         ctx.on_push_frame(frame)
@@ -509,89 +1132,153 @@ def _func_tracer(frame, why, arg):
     ctx.in_trace=False
 
 
+# global switch for TraceMe/TraceClass/trace_by_name: while off, the decorated functions are called directly (nothing is traced or captured).
+# The initial value is taken from the environment variable PYASMTOOLS_TRACE (0, off, false or no turn it off).
+_TRACING_ENABLED = os.environ.get("PYASMTOOLS_TRACE", "1").strip().lower() not in ("0", "off", "false", "no")
+
+def enable_tracing(enabled : bool = True):
+    """turn tracing by TraceMe/TraceClass/trace_by_name on or off at runtime; calls that are traced right now are traced until they return"""
+    global _TRACING_ENABLED
+    _TRACING_ENABLED = bool(enabled)
+
+def is_tracing_enabled():
+    return _TRACING_ENABLED
+
+# if set, the text trace of all traces started in this process is written to this stream, instead of the out parameter
+# (used to give each child process of a process pool its own trace file, see procpool.py)
+_PROCESS_OUT = None
+
+def set_process_trace_out(out):
+    global _PROCESS_OUT
+    _PROCESS_OUT = out
+
+# the trace goes to _PROCESS_OUT: the out parameter, and the out stream of the consumers and reports that have one
+def _with_process_out(trace_param):
+    for obj in list(trace_param.consumers or ()) + [ trace_param.coverage, trace_param.memory_profile, trace_param.tracer_stats ]:
+        if getattr(obj, "out", None) is not None:
+            obj.out = _PROCESS_OUT
+    return dataclasses.replace(trace_param, out=_PROCESS_OUT)
+
+# trace function of a thread while it has no active trace; set while functions are attached for tracing (see attach.py)
+_IDLE_TRACER = None
+
+def set_idle_tracer(tracer):
+    global _IDLE_TRACER
+    _IDLE_TRACER = tracer
+
 def _init_trace(trace_param : TraceParam):
 
-    if not hasattr(local_data_, "trace_ctx") or getattr( local_data_, "trace_ctx") is None:
-        setattr(local_data_, "trace_ctx", ThreadTraceCtx(trace_param))
-        return True
-    return False
+    thread_ctx = getattr(local_data_, "trace_ctx", None)
+    if thread_ctx is None:
+        _ensure_init()
+        if _PROCESS_OUT is not None:
+            trace_param = _with_process_out(trace_param)
+        thread_ctx = ThreadTraceCtx(trace_param)
+        setattr(local_data_, "trace_ctx", thread_ctx)
+        sys.settrace( thread_ctx.get_tracer() )
+
+    # count calls of traced functions, the trace ends when the outermost one returns.
+    thread_ctx.active_calls += 1
 
 def _check_eof_trace():
-    thread_ctx = getattr(local_data_, "trace_ctx")
-    if thread_ctx is not None and thread_ctx.nesting == 0:
+    thread_ctx = getattr(local_data_, "trace_ctx", None)
+    if thread_ctx is None:
+        return
+    thread_ctx.active_calls -= 1
+    if thread_ctx.active_calls == 0:
+        sys.settrace( _IDLE_TRACER )
         setattr(local_data_,"trace_ctx", None)
-        sys.settrace( None )
+        thread_ctx.on_end()
 
 
 
 
 class TraceMe:
+    """traces the calls of the decorated function; the keyword arguments are the fields of TraceParam"""
 
-    def __init__(self, func, *, trace_indent : bool = False, trace_loc : bool = True, show_obj : int = 1, ignore_stdlib : bool = True, out = sys.stderr):
+    def __init__(self, func, **trace_args):
         functools.update_wrapper(self, func)
         self.func = func
-        self.trace_indent = trace_indent
-        self.trace_loc = trace_loc
-        self.show_obj = show_obj
-        self.ignore_stdlib = ignore_stdlib
-        self.out = out
+        self.trace_param = _trace_param_from_args(trace_args)
+        self.capture = self.trace_param.capture
 
 
     def __call__(self, *args, **kwargs):
 
+        if not _TRACING_ENABLED:
+            return self.func(*args, **kwargs)
+
+        if self.capture is not None:
+            # capture mode: the arguments are recorded, nothing is traced.
+            return self.capture.call(self.func, args, kwargs)
+
         # first invocation sets up tracing hook
-        if _init_trace( TraceParam(trace_indent=self.trace_indent, trace_loc=self.trace_loc, show_obj=self.show_obj, ignore_stdlib=self.ignore_stdlib, out=self.out) ):
-            sys.settrace( _func_tracer )
+        _init_trace( self.trace_param )
 
         func_fwd = self.func
-        ret_val = func_fwd(*args, **kwargs)
-
-        # clean up trace hook if finished tracing
-        _check_eof_trace()
+        try:
+            ret_val = func_fwd(*args, **kwargs)
+        finally:
+            # clean up trace hook if finished tracing
+            _check_eof_trace()
 
         return ret_val
 
-# init at load time.
-_init_opcodes()
-
+# turns off reading of values from the stack (BINARY_SUBSCR, STORE_SUBSCR, LOAD_ATTR, STORE_ATTR are not traced);
+# if called before the first trace, the check of the frame layout is skipped as well.
 def disable_stack_access():
     global _CTYPES_ENABLED
 
     _CTYPES_ENABLED = -1
 
+# returns a function, that traces the call of val_func (unlike TraceMe, the wrapper is a function, so that it works as a method)
+def _make_trace_wrapper(val_func, trace_param):
+
+    if trace_param.capture is not None:
+        return _make_capture_wrapper(val_func, trace_param.capture)
+
+    def wrapper_fun(*args, **kwargs):
+
+        if not _TRACING_ENABLED:
+            return val_func(*args, **kwargs)
+
+        _init_trace( trace_param )
+
+        try:
+            ret_val = val_func(*args, **kwargs)
+        finally:
+            # clean up trace hook if finished tracing
+            _check_eof_trace()
+
+        return ret_val
+
+    functools.update_wrapper(wrapper_fun, val_func)
+    return wrapper_fun
+
+# returns a function, that records the arguments of the calls of val_func (capture mode)
+def _make_capture_wrapper(val_func, capture):
+
+    def wrapper_fun(*args, **kwargs):
+        if not _TRACING_ENABLED:
+            return val_func(*args, **kwargs)
+        return capture.call(val_func, args, kwargs)
+
+    functools.update_wrapper(wrapper_fun, val_func)
+    return wrapper_fun
+
 # metaclass, adds tracers to all methods of a class
 class TraceClass(type):
-    def __new__(meta_class, name, bases, cls_dict, *, trace_indent : bool = False, trace_loc : bool = True, show_obj : int = 1, ignore_stdlib : bool = True, out = sys.stderr):
+    def __new__(meta_class, name, bases, cls_dict, **trace_args):
 
         #
         # see trick here: https://stackoverflow.com/questions/11349183/how-to-wrap-every-method-of-a-class ]
         # need to modify the cls_dict object in order to wrap each member function!
         #
-        trace_param = TraceParam(trace_indent=trace_indent, trace_loc=trace_loc, show_obj=show_obj, ignore_stdlib=ignore_stdlib, out=out)
+        trace_param = _trace_param_from_args(trace_args)
         new_class_dict = {}
         for entry,val_func in cls_dict.items():
             if inspect.isfunction(val_func):
-                # hack - avoids looking at the same value of val_func !!! see https://stackoverflow.com/questions/8946868/is-there-a-pythonic-way-to-close-over-a-loop-variable
-                # the variable that the closure should remember is passed as argument, this makes a separate copy of the value in the called function frame?
-                # (what a language...)
-                def wrapper_factory(val_func):
-
-                    def wrapper_fun(*args, **kwargs):
-
-                        if _init_trace( trace_param ):
-                            sys.settrace( _func_tracer )
-
-                        ret_val = val_func(*args, **kwargs)
-
-                        # clean up trace hook if finished tracing
-                        _check_eof_trace()
-
-                        return ret_val
-                    return wrapper_fun
-
-                val_func_new = wrapper_factory(val_func)
-                functools.update_wrapper(val_func_new, val_func)
-                val_func = val_func_new
+                val_func = _make_trace_wrapper(val_func, trace_param)
 
             new_class_dict[entry] = val_func
 
@@ -607,3 +1294,54 @@ class TraceClass(type):
 #
 #        return instance
 
+
+
+# resolves a name of the form package.module:Class.method (or package.module.function), returns tuple (owner, attribute name, value)
+def _resolve_name(spec):
+    if ":" in spec:
+        module_name, attr_path = spec.split(":", 1)
+        owner = importlib.import_module(module_name)
+    else:
+        # longest importable prefix is the module.
+        parts = spec.split(".")
+        owner = None
+        for pos in range(len(parts)-1, 0, -1):
+            try:
+                owner = importlib.import_module(".".join(parts[:pos]))
+            except ImportError:
+                continue
+            attr_path = ".".join(parts[pos:])
+            break
+        if owner is None:
+            raise ImportError(f"can't find module for {spec}")
+
+    attrs = attr_path.split(".")
+    for attr in attrs[:-1]:
+        owner = getattr(owner, attr)
+
+    name = attrs[-1]
+    if inspect.isclass(owner) and name in owner.__dict__:
+        # don't trigger the descriptor, static and class methods need to stay what they are.
+        return owner, name, owner.__dict__[ name ]
+    return owner, name, getattr(owner, name)
+
+def trace_by_name(spec, **trace_args):
+    """replace the function/method named by spec (package.module:Class.method) with a traced version, at runtime. Returns the original value.
+    The keyword arguments are the fields of TraceParam."""
+    trace_param = _trace_param_from_args(trace_args)
+    owner, name, val = _resolve_name(spec)
+
+    if isinstance(val, (staticmethod, classmethod)):
+        new_val = type(val)( _make_trace_wrapper(val.__func__, trace_param) )
+    elif inspect.isfunction(val) or inspect.ismethod(val):
+        new_val = _make_trace_wrapper(val, trace_param)
+    else:
+        raise TypeError(f"{spec} is not a function or method")
+
+    setattr(owner, name, new_val)
+    return val
+
+def untrace_by_name(spec, original):
+    """undo trace_by_name, original is the value returned by trace_by_name"""
+    owner, name, _ = _resolve_name(spec)
+    setattr(owner, name, original)
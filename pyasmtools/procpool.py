@@ -0,0 +1,109 @@
+"""tracing of child processes (multiprocessing, concurrent.futures process pools): each child writes its own trace file, tagged with its pid"""
+
+import os
+import re
+import sys
+import dataclasses
+import typing
+import multiprocessing.util
+from . import prettytrace
+from .sinks import RotatingFileSink, read_segments
+
+__all__ = [ "ChildTraceConfig", "init_child_tracing", "enable_child_tracing", "pool_initializer", "TracedCall", "list_child_traces", "merge_child_traces" ]
+
+# configuration passed on to child processes (must be picklable, for the spawn start method)
+@dataclasses.dataclass
+class ChildTraceConfig:
+    # trace files are written to <out_dir>/<prefix>.<pid>.<segment>.gz
+    out_dir: str
+    prefix: str = "trace"
+    compression: typing.Optional[str] = "gzip"
+    max_bytes: int = 64 * 1024 * 1024
+    max_segments: typing.Optional[int] = 16
+    # functions to trace in the child, names of the form package.module:Class.method
+    functions: typing.List[str] = dataclasses.field(default_factory=list)
+    # keyword arguments for the tracer (fields of TraceParam; consumers, coverage and the like must be picklable for spawn).
+    # Consumers with an out attribute write to the trace file of the process.
+    trace_args: typing.Dict[str, typing.Any] = dataclasses.field(default_factory=dict)
+
+    def trace_file_prefix(self, pid):
+        return os.path.join(self.out_dir, f"{self.prefix}.{pid}")
+
+# state of tracing in this process: pid the sink belongs to and the sink.
+_CHILD_PID = None
+_CHILD_SINK = None
+_FORK_CONFIG = None
+
+
+def init_child_tracing(config : ChildTraceConfig):
+    """set up tracing in the current process: traces go to a file of its own, the functions listed in config are traced"""
+    global _CHILD_PID
+    global _CHILD_SINK
+
+    pid = os.getpid()
+    if _CHILD_PID == pid:
+        return
+
+    # a forked child inherits the sink of the parent, the file belongs to the parent.
+    _CHILD_PID = pid
+    _CHILD_SINK = RotatingFileSink(config.trace_file_prefix(pid), compression=config.compression, max_bytes=config.max_bytes, max_segments=config.max_segments)
+    prettytrace.set_process_trace_out(_CHILD_SINK)
+
+    # pool workers leave with os._exit, atexit handlers are not called; multiprocessing runs its finalizers though.
+    multiprocessing.util.Finalize(None, _CHILD_SINK.close, exitpriority=10)
+
+    for spec in config.functions:
+        prettytrace.trace_by_name(spec, **config.trace_args)
+
+
+def _after_fork_in_child():
+    if _FORK_CONFIG is not None:
+        init_child_tracing(_FORK_CONFIG)
+
+def enable_child_tracing(config : ChildTraceConfig):
+    """trace all child processes that are forked from now on (for the fork start method); pass pool_initializer(config) to pools that use spawn"""
+    global _FORK_CONFIG
+
+    if _FORK_CONFIG is None and hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_after_fork_in_child)
+    _FORK_CONFIG = config
+
+def pool_initializer(config : ChildTraceConfig):
+    """returns keyword arguments for ProcessPoolExecutor/multiprocessing.Pool, that set up tracing in each worker process:
+
+    ProcessPoolExecutor(**pool_initializer(config)) or multiprocessing.Pool(**pool_initializer(config))
+    """
+    return { "initializer" : init_child_tracing, "initargs" : (config,) }
+
+
+class TracedCall:
+    """picklable wrapper for a task of a process pool; traces the call of func in the worker: executor.submit(TracedCall(func, config), args...)"""
+
+    def __init__(self, func, config : ChildTraceConfig):
+        self.func = func
+        self.config = config
+
+    def __call__(self, *args, **kwargs):
+        init_child_tracing(self.config)
+        # the trace goes to the file of the process (set_process_trace_out), whatever out says.
+        trace_param = prettytrace._trace_param_from_args(self.config.trace_args)
+        return prettytrace._make_trace_wrapper(self.func, trace_param)(*args, **kwargs)
+
+
+def list_child_traces(out_dir, prefix="trace"):
+    """returns the pids of all processes that wrote a trace to out_dir"""
+    pattern = re.compile(r"^" + re.escape(prefix) + r"\.(\d+)\.\d+\.(gz|zst|txt)$")
+    pids = set()
+    for entry in os.listdir(out_dir):
+        match = pattern.match(entry)
+        if match is not None:
+            pids.add(int(match.group(1)))
+    return sorted(pids)
+
+def merge_child_traces(out_dir, out = sys.stdout, prefix="trace"):
+    """writes the traces of all processes in out_dir to out, one after the other, each one starts with a line: # pid <pid>.
+    The traces are concatenated, not interleaved by time: the text trace has no timestamps."""
+    for pid in list_child_traces(out_dir, prefix):
+        print(f"# pid {pid}", file=out)
+        for line in read_segments(os.path.join(out_dir, f"{prefix}.{pid}")):
+            out.write(line)
@@ -0,0 +1,288 @@
+"""load a recorded trace into an indexed in-memory store, and query it by location, variable name, object id and nesting level"""
+
+import re
+import json
+import pickle
+import dataclasses
+import typing
+
+__all__ = [ "TraceEvent", "TraceCall", "TraceStore", "load_trace" ]
+
+# prefix written by TextTraceConsumer.get_line_prefix: <file>:<line>(<nesting>) followed by optional indentation dots.
+_PREFIX_RE = re.compile(r"^(?P<file>[^:\s]+):(?P<line>\d+)\((?P<nesting>\d+)\)\.*(?P<rest>.*)$")
+
+_LOAD_GLOBAL_RE = re.compile(r"^(?P<name>\S+) (?P<value>.*) \(type: (?P<type>[^)]*)\)$")
+_ATTR_RE = re.compile(r"^(?P<type>.*)_at_(?P<id>0x[0-9a-f]+)\.(?P<name>\w+)(?P<sep>[ =])(?P<value>.*)$")
+_VAR_RE = re.compile(r"^(?P<name>\w+) (?P<value>.*)$")
+
+# one entry in the trace.
+@dataclasses.dataclass
+class TraceEvent:
+    seq: int
+    kind: str
+    file: str
+    line: int
+    nesting: int
+    name: typing.Optional[str] = None
+    value: typing.Optional[str] = None
+    obj_id: typing.Optional[str] = None
+    obj_type: typing.Optional[str] = None
+    key: typing.Optional[str] = None
+    call: int = -1
+
+    def location(self):
+        return f"{self.file}:{self.line}"
+
+# one function call, from the first event of the frame up to the return event.
+@dataclasses.dataclass
+class TraceCall:
+    call_id: int
+    file: str
+    line: int
+    nesting: int
+    first_event: int
+    last_event: int = -1
+    args: typing.Dict[str, str] = dataclasses.field(default_factory=dict)
+    return_value: typing.Optional[str] = None
+
+
+def _parse_detail(rest):
+    # parses the text after '# ' of a trace line, returns tuple (kind, name, value, obj_type, obj_id, key)
+    cmd, _, tail = rest.partition(' ')
+
+    if cmd == "resume":
+        return "resume", tail, None, None, None, None
+
+    if cmd == "load_global":
+        match = _LOAD_GLOBAL_RE.match(tail)
+        if match is not None:
+            return "load_global", match.group("name"), match.group("value"), match.group("type"), None, None
+        return "load_global", tail, None, None, None, None
+
+    if cmd in ("load_attr", "store_attr"):
+        match = _ATTR_RE.match(tail)
+        if match is not None:
+            return cmd, match.group("name"), match.group("value"), match.group("type"), match.group("id"), None
+        return cmd, None, tail, None, None, None
+
+    if cmd in ("load", "store"):
+        match = _VAR_RE.match(tail)
+        if match is not None:
+            return cmd, match.group("name"), match.group("value"), None, None, None
+
+        # subscript: <title>[<key>] <value> for loads, <title>[<key>]=<value> for stores.
+        title, _, key_and_value = tail.partition('[')
+        if cmd == "store":
+            key, _, value = key_and_value.partition(']=')
+        else:
+            key, _, value = key_and_value.rpartition('] ')
+        return cmd + "_subscr", None, value, title, None, key
+
+    # function argument: <name>=<value>
+    name, sep, value = rest.partition('=')
+    if sep and re.match(r"^\w+$", name):
+        return "arg", name, value, None, None, None
+
+    return None
+
+
+def parse_text_line(text_line):
+    """parse one line of text trace output; returns a tuple (file, line, nesting, kind, name, value, obj_type, obj_id, key) or None"""
+    match = _PREFIX_RE.match(text_line.rstrip('\n'))
+    if match is None:
+        return None
+
+    file_name = match.group("file")
+    line = int(match.group("line"))
+    nesting = int(match.group("nesting"))
+    rest = match.group("rest").strip()
+
+    if rest.startswith("# "):
+        detail = _parse_detail(rest[2:])
+        if detail is None:
+            return None
+        kind, name, value, obj_type, obj_id, key = detail
+    elif rest.startswith("return=") or rest.startswith("yield="):
+        kind, _, value = rest.partition("=")
+        name, obj_type, obj_id, key = None, None, None, None
+    else:
+        kind, name, value, obj_type, obj_id, key = "line", None, rest, None, None, None
+
+    return file_name, line, nesting, kind, name, value, obj_type, obj_id, key
+
+
+def parse_json_line(text_line):
+    """parse one line of the structured (json lines) trace format; returns the same tuple as parse_text_line"""
+    try:
+        rec = json.loads(text_line)
+    except ValueError:
+        return None
+    if not isinstance(rec, dict) or "kind" not in rec:
+        return None
+    return rec["file"], int(rec["line"]), int(rec["nesting"]), rec["kind"], rec.get("name"), rec.get("value"), rec.get("obj_type"), rec.get("obj_id"), rec.get("key")
+
+
+class TraceStore:
+    """in-memory store of a recorded trace, with indexes by file:line, variable name, object id and nesting level"""
+
+    def __init__(self):
+        self.events = []
+        self.calls = []
+        self.location_index = {}
+        self.name_index = {}
+        self.object_index = {}
+        self.nesting_index = {}
+        self.skipped_lines = 0
+
+        # state used while adding events.
+        self._open_calls = []
+        self._last_load = None
+
+    def add_lines(self, lines):
+        """add trace lines to the store, the format (text or json lines) is detected by looking at each line"""
+        for text_line in lines:
+            if not text_line.strip():
+                continue
+            if text_line.lstrip().startswith("{"):
+                parsed = parse_json_line(text_line)
+            else:
+                parsed = parse_text_line(text_line)
+
+            if parsed is None:
+                # output of the traced program, or error messages.
+                self.skipped_lines += 1
+                continue
+            self.add_event(*parsed)
+
+    def add_event(self, file_name, line, nesting, kind, name=None, value=None, obj_type=None, obj_id=None, key=None):
+        seq = len(self.events)
+
+        # the first event with a deeper nesting level opens a new call
+        while len(self._open_calls) < nesting:
+            call = TraceCall(call_id=len(self.calls), file=file_name, line=line, nesting=len(self._open_calls)+1, first_event=seq)
+            self.calls.append(call)
+            self._open_calls.append(call)
+        while len(self._open_calls) > nesting:
+            self._close_call(seq-1)
+
+        call = self._open_calls[-1] if self._open_calls else None
+        event = TraceEvent(seq=seq, kind=kind, file=file_name, line=line, nesting=nesting, name=name, value=value, obj_id=obj_id, obj_type=obj_type, key=key, call=call.call_id if call is not None else -1)
+        self.events.append(event)
+
+        self.location_index.setdefault((file_name, line), []).append(seq)
+        self.nesting_index.setdefault(nesting, []).append(seq)
+        if obj_id is not None:
+            self.object_index.setdefault(obj_id, []).append(seq)
+
+        if name is not None:
+            self.name_index.setdefault(name, []).append(seq)
+
+            # attribute access: the object is usually the variable that has been loaded right before (self.title = ... does load_fast self, store_attr title)
+            if kind in ("load_attr", "store_attr") and self._last_load is not None:
+                last = self.events[ self._last_load ]
+                if last.nesting == nesting and last.call == event.call and last.line == line:
+                    self.name_index.setdefault(f"{last.name}.{name}", []).append(seq)
+
+        if kind == "load":
+            self._last_load = seq
+        elif kind == "line":
+            self._last_load = None
+
+        if call is not None:
+            if kind == "arg":
+                call.args[name] = value
+            elif kind == "return":
+                call.return_value = value
+                self._close_call(seq)
+            elif kind == "yield":
+                # the generator is suspended, the next resume starts another call entry.
+                self._close_call(seq)
+
+        return event
+
+    def _close_call(self, last_seq):
+        call = self._open_calls.pop()
+        call.last_event = last_seq
+
+    def finish(self):
+        """close all calls that are still open (trace ended before the traced function returned)"""
+        while self._open_calls:
+            self._close_call(len(self.events)-1)
+        return self
+
+    def _select(self, seqs, kinds=None):
+        if kinds is None:
+            return [ self.events[ seq ] for seq in seqs ]
+        return [ self.events[ seq ] for seq in seqs if self.events[ seq ].kind in kinds ]
+
+    def at_location(self, file_name, line, kinds=None):
+        """all events at the given file and line number"""
+        return self._select(self.location_index.get((file_name, line), []), kinds)
+
+    def by_name(self, name, kinds=None):
+        """all events that access the variable; attributes can be specified as obj_var.attribute_name, for example self.title"""
+        return self._select(self.name_index.get(name, []), kinds)
+
+    def stores_to(self, name):
+        """all values stored to variable/attribute name, for example 'res' or 'self.title'"""
+        return self.by_name(name, ("store", "store_attr", "store_subscr"))
+
+    def loads_of(self, name):
+        """all values loaded from variable/attribute name"""
+        return self.by_name(name, ("load", "load_global", "load_attr", "load_subscr", "arg"))
+
+    def object_history(self, obj_id, kinds=None):
+        """all events that access the object with the given id (hex string as shown in the trace, for example 0x7f94d5c5c910)"""
+        if isinstance(obj_id, int):
+            obj_id = hex(obj_id)
+        return self._select(self.object_index.get(obj_id, []), kinds)
+
+    def in_nesting(self, min_nesting, max_nesting=None, kinds=None):
+        """all events with min_nesting <= nesting <= max_nesting, in trace order"""
+        if max_nesting is None:
+            max_nesting = min_nesting
+        seqs = []
+        for nesting in range(min_nesting, max_nesting+1):
+            seqs.extend( self.nesting_index.get(nesting, []) )
+        seqs.sort()
+        return self._select(seqs, kinds)
+
+    def calls_where(self, arg_name, value=None, predicate=None):
+        """all calls where argument arg_name had the given value (as string), or where predicate(value) is true"""
+        ret = []
+        for call in self.calls:
+            if arg_name not in call.args:
+                continue
+            arg_value = call.args[ arg_name ]
+            if predicate is not None:
+                if predicate(arg_value):
+                    ret.append(call)
+            elif value is None or arg_value == str(value):
+                ret.append(call)
+        return ret
+
+    def call_events(self, call):
+        """all events that belong to the call, including nested calls"""
+        last = call.last_event if call.last_event >= 0 else len(self.events)-1
+        return self.events[ call.first_event : last+1 ]
+
+    def save(self, file_name):
+        """save the store with all indexes, load it again with TraceStore.load_index; this avoids parsing the trace again"""
+        with open(file_name, "wb") as file:
+            pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load_index(file_name):
+        with open(file_name, "rb") as file:
+            return pickle.load(file)
+
+
+def load_trace(file_name_or_lines):
+    """load a trace from a file name, a file object or a sequence of lines. Returns a TraceStore"""
+    store = TraceStore()
+    if isinstance(file_name_or_lines, str):
+        with open(file_name_or_lines, "r", encoding="utf-8", errors="replace") as file:
+            store.add_lines(file)
+    else:
+        store.add_lines(file_name_or_lines)
+    return store.finish()
@@ -0,0 +1,158 @@
+"""trace output sinks: a file that is compressed on the fly and rotated by size or line count, and a reader that streams over all segments"""
+
+import os
+import re
+import io
+import sys
+import gzip
+import threading
+
+try:
+    import zstandard
+    _ZSTD_ENABLED = True
+except ImportError:
+    _ZSTD_ENABLED = False
+
+__all__ = [ "RotatingFileSink", "read_segments", "list_segments" ]
+
+_SEGMENT_EXT = { "gzip" : ".gz", "zstd" : ".zst", None : ".txt" }
+_SEGMENT_RE = re.compile(r"^\.(\d+)(\.gz|\.zst|\.txt)$")
+
+
+def _open_segment_for_write(file_name, compression):
+    if compression == "gzip":
+        return gzip.open(file_name, "wt", encoding="utf-8")
+    if compression == "zstd":
+        raw = open(file_name, "wb")
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(raw), encoding="utf-8")
+    return open(file_name, "w", encoding="utf-8")
+
+def _open_segment_for_read(file_name):
+    if file_name.endswith(".gz"):
+        return gzip.open(file_name, "rt", encoding="utf-8", errors="replace")
+    if file_name.endswith(".zst"):
+        if not _ZSTD_ENABLED:
+            raise ImportError(f"zstandard module required to read {file_name}")
+        raw = open(file_name, "rb")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(raw), encoding="utf-8", errors="replace")
+    return open(file_name, "r", encoding="utf-8", errors="replace")
+
+
+def list_segments(path_prefix):
+    """returns the file names of all segments written by RotatingFileSink(path_prefix), ordered from oldest to newest"""
+    dir_name = os.path.dirname(path_prefix) or "."
+    base_name = os.path.basename(path_prefix)
+    segments = []
+    if not os.path.isdir(dir_name):
+        return segments
+    for entry in os.listdir(dir_name):
+        if not entry.startswith(base_name):
+            continue
+        match = _SEGMENT_RE.match(entry[len(base_name):])
+        if match is not None:
+            segments.append( (int(match.group(1)), os.path.join(dir_name, entry)) )
+    segments.sort()
+    return [ file_name for _, file_name in segments ]
+
+
+def read_segments(path_prefix):
+    """generator, returns the lines of all segments written by RotatingFileSink(path_prefix), decompressing them one at a time"""
+    for file_name in list_segments(path_prefix):
+        with _open_segment_for_read(file_name) as file:
+            try:
+                for line in file:
+                    yield line
+            except EOFError:
+                # the segment is still written to (or the writer didn't close it), all flushed lines have been returned.
+                pass
+
+
+class RotatingFileSink:
+    """file like object, that can be passed as out parameter of TraceMe/TraceClass.
+
+    path_prefix  - segments are named <path_prefix>.<segment number>.gz (.zst for zstd, .txt if uncompressed)
+    compression  - "gzip", "zstd" (requires the zstandard module, falls back to gzip if it is not installed) or None
+    max_bytes    - start a new segment, after this number of (uncompressed) bytes have been written to the current segment
+    max_lines    - start a new segment, after this number of lines (one line per trace event) have been written
+    max_segments - remove the oldest segments, so that at most this number of segments is kept (None - keep all segments)
+    """
+
+    def __init__(self, path_prefix, *, compression = "gzip", max_bytes : int = 64 * 1024 * 1024, max_lines : int = None, max_segments : int = 16):
+        if compression == "zstd" and not _ZSTD_ENABLED:
+            print("zstandard module not installed; using gzip compression for trace files", file=sys.stderr)
+            compression = "gzip"
+        if compression not in _SEGMENT_EXT:
+            raise ValueError(f"unsupported compression: {compression}")
+
+        self.path_prefix = path_prefix
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        self.file = None
+        self.bytes_written = 0
+        self.lines_written = 0
+        self.closed = False
+
+        # don't overwrite segments of a previous run.
+        existing = list_segments(path_prefix)
+        if existing:
+            self.segment_num = int(_SEGMENT_RE.match(existing[-1][len(path_prefix):]).group(1)) + 1
+        else:
+            self.segment_num = 0
+
+        self._open_segment()
+
+    def _segment_name(self, segment_num):
+        return f"{self.path_prefix}.{segment_num:06d}{_SEGMENT_EXT[self.compression]}"
+
+    def _open_segment(self):
+        dir_name = os.path.dirname(self.path_prefix)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        self.file = _open_segment_for_write(self._segment_name(self.segment_num), self.compression)
+        self.bytes_written = 0
+        self.lines_written = 0
+
+        if self.max_segments is not None:
+            segments = list_segments(self.path_prefix)
+            for file_name in segments[ : max(0, len(segments) - self.max_segments) ]:
+                os.remove(file_name)
+
+    def _rotate(self):
+        self.file.close()
+        self.segment_num += 1
+        self._open_segment()
+
+    def write(self, text):
+        with self.lock:
+            if self.closed:
+                raise ValueError("write to closed RotatingFileSink")
+            self.file.write(text)
+            # the segments are utf-8 encoded
+            self.bytes_written += len(text) if text.isascii() else len(text.encode("utf-8", errors="replace"))
+            self.lines_written += text.count("\n")
+
+            # rotate on line boundaries only, so that segments can be read independently.
+            if text.endswith("\n"):
+                if (self.max_bytes is not None and self.bytes_written >= self.max_bytes) or (self.max_lines is not None and self.lines_written >= self.max_lines):
+                    self._rotate()
+        return len(text)
+
+    def flush(self):
+        with self.lock:
+            if not self.closed:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.file.close()
+                self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
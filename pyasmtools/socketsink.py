@@ -0,0 +1,292 @@
+"""send the trace to a collector process over a unix domain socket (python -m pyasmtools.collector), instead of writing it in the
+traced process. The collector formats, compresses and stores the traces of several processes.
+
+    SocketTraceConsumer - trace consumer, sends the events as binary records; the collector writes the text trace
+    SocketSink          - file like object for the out parameter, sends the text written to it
+
+The records are sent in batches. If the collector can't be reached, batches are kept in memory (up to max_buffer bytes, then they
+go to fallback_file, or the oldest ones are dropped), and sent once the collector is back.
+"""
+
+import os
+import sys
+import dis
+import time
+import struct
+import socket
+import threading
+import collections
+
+from .prettytrace import TraceConsumer, TraceRecord, EVENT_KINDS, format_value, _get_type_of_val, _get_type_and_id
+
+__all__ = [ "SocketTraceConsumer", "SocketSink", "DEFAULT_SOCKET_PATH" ]
+
+DEFAULT_SOCKET_PATH = "/tmp/pyasmtools-collector.sock"
+
+# index of an event kind in the records
+KINDS = tuple(sorted(EVENT_KINDS))
+_KIND_INDEX = { kind : pos for pos, kind in enumerate(KINDS) }
+
+# a batch is sent as: 4 byte length, followed by the records. Each record starts with its type byte.
+REC_HELLO = 0       # pid (u32), name (str)
+REC_CODE = 1        # code id (u32), file name (str), qualified name (str), first line (u32), first line of the body (u32)
+REC_EVENT = 2       # kind (u8), code id (u32), line (u32), nesting (u16), name (str), value (str), detail (str)
+REC_TEXT = 3        # text (str)
+REC_END = 4         # end of a trace
+
+BATCH_HEADER = struct.Struct("<I")
+HELLO_HEADER = struct.Struct("<BI")
+CODE_HEADER = struct.Struct("<BI")
+CODE_LINES = struct.Struct("<II")
+EVENT_HEADER = struct.Struct("<BBIIH")
+STR_LEN = struct.Struct("<I")
+# length of a str that is None
+NONE_LEN = 0xFFFFFFFF
+
+
+def _pack_str(parts, text):
+    if text is None:
+        parts.append(STR_LEN.pack(NONE_LEN))
+    else:
+        data = text.encode("utf-8", errors="replace")
+        parts.append(STR_LEN.pack(len(data)))
+        parts.append(data)
+
+
+# connection to the collector, shared by the sink and the consumer: batches records, buffers them while the collector is not reachable.
+class _CollectorConnection:
+    def __init__(self, socket_path, batch_bytes, max_buffer, fallback_file, retry_interval, name):
+        self.socket_path = socket_path
+        self.batch_bytes = batch_bytes
+        self.max_buffer = max_buffer
+        self.fallback_file = fallback_file
+        self.retry_interval = retry_interval
+        self.name = name if name is not None else " ".join(sys.argv)
+        self.lock = threading.Lock()
+        self.sock = None
+        self.pid = None
+        self.next_retry = 0.0
+        self.batch = []
+        self.batch_len = 0
+        # batches that couldn't be sent
+        self.pending = collections.deque()
+        self.pending_len = 0
+        self.fallback = None
+        self.num_dropped = 0
+        # records sent at the start of each connection: code id -> record of the code table
+        self.code_records = []
+
+    def _connect(self):
+        if time.monotonic() < self.next_retry:
+            return False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+            hello = [ HELLO_HEADER.pack(REC_HELLO, os.getpid()) ]
+            _pack_str(hello, self.name)
+            self._send_batch(sock, b"".join(hello + self.code_records))
+        except OSError:
+            sock.close()
+            self.next_retry = time.monotonic() + self.retry_interval
+            return False
+        self.sock = sock
+        return True
+
+    @staticmethod
+    def _send_batch(sock, data):
+        sock.sendall(BATCH_HEADER.pack(len(data)) + data)
+
+    def _disconnect(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self.sock = None
+        self.next_retry = time.monotonic() + self.retry_interval
+
+    def _keep(self, data):
+        self.pending.append(data)
+        self.pending_len += len(data)
+        while self.pending_len > self.max_buffer:
+            oldest = self.pending.popleft()
+            self.pending_len -= len(oldest)
+            if self.fallback_file is not None:
+                self._write_fallback(oldest)
+            else:
+                self.num_dropped += 1
+
+    def _write_fallback(self, data):
+        if self.fallback is None:
+            # the file can be read by the collector (--import); it starts like a connection.
+            self.fallback = open(f"{self.fallback_file}.{os.getpid()}", "ab")
+            hello = [ HELLO_HEADER.pack(REC_HELLO, os.getpid()) ]
+            _pack_str(hello, self.name)
+            data = b"".join(hello + self.code_records) + data
+        self.fallback.write(BATCH_HEADER.pack(len(data)) + data)
+
+    def _check_fork(self):
+        if self.pid != os.getpid():
+            # forked child: the connection, the buffered records and the fallback file belong to the parent.
+            self.sock = None
+            self.pid = os.getpid()
+            self.batch = []
+            self.batch_len = 0
+            self.pending.clear()
+            self.pending_len = 0
+            self.fallback = None
+            self.num_dropped = 0
+
+    def _send(self, data):
+        if self.sock is None and not self._connect():
+            self._keep(data)
+            return
+        try:
+            while self.pending:
+                self._send_batch(self.sock, self.pending[0])
+                self.pending_len -= len(self.pending.popleft())
+            self._send_batch(self.sock, data)
+        except OSError:
+            # the collector went away; the batch that failed is sent again (the collector drops incomplete batches).
+            self._disconnect()
+            self._keep(data)
+
+    def add(self, record, flush = False):
+        """add a record (list of byte strings) to the current batch"""
+        with self.lock:
+            self._check_fork()
+            self.batch.extend(record)
+            self.batch_len += sum(len(part) for part in record)
+            if flush or self.batch_len >= self.batch_bytes:
+                self._flush_locked()
+
+    def add_code(self, record):
+        with self.lock:
+            self._check_fork()
+            data = b"".join(record)
+            self.code_records.append(data)
+            self.batch.append(data)
+            self.batch_len += len(data)
+
+    def _flush_locked(self):
+        if self.batch:
+            data = b"".join(self.batch)
+            self.batch = []
+            self.batch_len = 0
+            self._send(data)
+
+    def flush(self):
+        with self.lock:
+            self._check_fork()
+            self._flush_locked()
+
+    def close(self):
+        with self.lock:
+            self._check_fork()
+            self._flush_locked()
+            if self.pending and self.fallback_file is not None:
+                while self.pending:
+                    self._write_fallback(self.pending.popleft())
+                self.pending_len = 0
+            elif self.pending:
+                self.num_dropped += len(self.pending)
+            if self.num_dropped != 0:
+                print(f"pyasmtools: collector at {self.socket_path} not reachable, {self.num_dropped} batches of the trace are lost", file=sys.stderr)
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+            if self.fallback is not None:
+                self.fallback.close()
+                self.fallback = None
+
+
+class SocketTraceConsumer(TraceConsumer):
+    """trace consumer that sends the events to the collector (python -m pyasmtools.collector), which writes the text trace.
+    Values are formatted here (the objects are in this process), the rest of the formatting is done by the collector.
+
+    socket_path    - path of the unix domain socket of the collector
+    show_obj       - how to format values (same as for TraceMe)
+    batch_bytes    - records are sent in batches of about this size (and when a trace ends)
+    max_buffer     - bytes of batches that are kept, while the collector is not reachable
+    fallback_file  - batches that don't fit into max_buffer are written to <fallback_file>.<pid> (read it with collector --import);
+                     None: they are dropped
+    retry_interval - seconds between attempts to connect to the collector
+    name           - name of the process, shown by the collector (default: the command line)
+
+    Call close() at the end, to send the last batch. A batch that is sent while the collector exits can get lost.
+    """
+
+    def __init__(self, socket_path : str = DEFAULT_SOCKET_PATH, *, show_obj : int = 1, batch_bytes : int = 64 * 1024, max_buffer : int = 64 * 1024 * 1024,
+                 fallback_file : str = None, retry_interval : float = 1.0, name : str = None):
+        self.show_obj = show_obj
+        self.conn = _CollectorConnection(socket_path, batch_bytes, max_buffer, fallback_file, retry_interval, name)
+        # code object -> code id
+        self.code_ids = {}
+        self.lock = threading.Lock()
+
+    def _get_code_id(self, code):
+        code_id = self.code_ids.get(code, None)
+        if code_id is None:
+            with self.lock:
+                code_id = self.code_ids.get(code, None)
+                if code_id is None:
+                    code_id = len(self.code_ids)
+                    record = [ CODE_HEADER.pack(REC_CODE, code_id) ]
+                    _pack_str(record, code.co_filename)
+                    _pack_str(record, getattr(code, "co_qualname", code.co_name))
+                    body_line = next(dis.findlinestarts(code), (0, code.co_firstlineno))[1]
+                    record.append(CODE_LINES.pack(code.co_firstlineno, body_line if body_line is not None else code.co_firstlineno))
+                    self.conn.add_code(record)
+                    self.code_ids[ code ] = code_id
+        return code_id
+
+    def on_event(self, rec : TraceRecord):
+        kind = rec.kind
+        value = None
+        detail = None
+        if kind != "line" and kind != "call" and kind != "resume":
+            value = format_value(rec.value, self.show_obj)
+            if kind == "load_global" or kind == "store_global":
+                detail = _get_type_of_val(rec.value)
+            elif kind == "load_attr" or kind == "store_attr":
+                detail = _get_type_and_id(rec.obj)
+            elif kind == "load_subscr" or kind == "store_subscr":
+                detail = f"{rec.title}[{repr(rec.key)}]"
+
+        record = [ EVENT_HEADER.pack(REC_EVENT, _KIND_INDEX[ kind ], self._get_code_id(rec.code), rec.lineno, rec.nesting) ]
+        _pack_str(record, rec.name)
+        _pack_str(record, value)
+        _pack_str(record, detail)
+        self.conn.add(record)
+
+    def on_end(self):
+        self.conn.add([ bytes((REC_END,)) ], flush=True)
+
+    def close(self):
+        self.conn.close()
+
+
+class SocketSink:
+    """file like object, that can be passed as out parameter of TraceMe/TraceClass: the text is sent to the collector
+    (python -m pyasmtools.collector), which compresses and stores it. The arguments are the same as for SocketTraceConsumer."""
+
+    def __init__(self, socket_path : str = DEFAULT_SOCKET_PATH, *, batch_bytes : int = 64 * 1024, max_buffer : int = 64 * 1024 * 1024,
+                 fallback_file : str = None, retry_interval : float = 1.0, name : str = None):
+        self.conn = _CollectorConnection(socket_path, batch_bytes, max_buffer, fallback_file, retry_interval, name)
+
+    def write(self, text):
+        record = [ bytes((REC_TEXT,)) ]
+        _pack_str(record, text)
+        self.conn.add(record)
+        return len(text)
+
+    def flush(self):
+        self.conn.flush()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,292 @@
+"""compare two recorded traces (text or json lines, plain or compressed) and find the first point where they differ: a different
+sequence of events (control flow) or a different stored value. The traces are read as streams, only a window of events is held in memory,
+so that very large traces can be compared."""
+
+import re
+import sys
+import os
+import collections
+import dataclasses
+import typing
+
+from .query import TraceEvent, parse_text_line, parse_json_line
+from .sinks import list_segments, read_segments, _open_segment_for_read
+
+__all__ = [ "Divergence", "TraceDiff", "diff_traces" ]
+
+# events with a value that is compared (for the other events only the position in the trace is compared)
+_VALUE_KINDS = frozenset(( "arg", "store", "store_global", "store_attr", "store_subscr", "return", "yield" ))
+
+# object addresses are different in each run
+_ADDRESS_RE = re.compile(r"0x[0-9a-fA-F]+")
+
+# values in the report are cut after this number of characters
+_MAX_VALUE_LEN = 200
+
+# number of events that must be the same, after a difference in control flow, for the traces to be in sync again
+_SYNC_LEN = 3
+
+
+@dataclasses.dataclass
+class Divergence:
+    # "control_flow" - the traces run different code, "value" - the same event stores/returns a different value
+    kind: str
+    # number of the first differing event in each trace (counting the recognised trace lines only)
+    seq_a: int
+    seq_b: int
+    # the differing events of each trace (up to max_events of them); for control flow: up to the point where the traces are in sync again.
+    events_a: typing.List[TraceEvent]
+    events_b: typing.List[TraceEvent]
+    # total number of differing events of each trace
+    num_a: int = 0
+    num_b: int = 0
+    # events of trace a before the divergence (the first divergence only)
+    context: typing.List[TraceEvent] = dataclasses.field(default_factory=list)
+
+    def location(self):
+        event = self.events_a[0] if self.events_a else self.events_b[0]
+        return event.location()
+
+
+@dataclasses.dataclass
+class TraceDiff:
+    """result of diff_traces"""
+    num_events_a: int = 0
+    num_events_b: int = 0
+    # number of events that are the same in both traces
+    num_matched: int = 0
+    first: typing.Optional[Divergence] = None
+    num_control_flow: int = 0
+    num_value: int = 0
+    # number of times the traces didn't get in sync again, within the window
+    num_lost_sync: int = 0
+    # the first max_reported divergences after the first one
+    later: typing.List[Divergence] = dataclasses.field(default_factory=list)
+    # (divergence kind, file:line) -> number of divergences
+    by_location: typing.Dict[typing.Tuple[str, str], int] = dataclasses.field(default_factory=dict)
+
+    def is_same(self):
+        return self.first is None
+
+    def show_report(self, out = sys.stdout, max_locations : int = 20):
+        if self.first is None:
+            print(f"# traces are the same: {self.num_matched} events", file=out)
+            return
+
+        first = self.first
+        print(f"# first divergence: {first.kind} at event {first.seq_a} of a, event {first.seq_b} of b, after {first.seq_a} matching events", file=out)
+        for event in first.context:
+            print(f"  {_format_event(event)}", file=out)
+        _show_divergence(first, out)
+
+        num_later = self.num_control_flow + self.num_value - 1
+        print(f"# divergences: {num_later + 1} ({self.num_control_flow} control flow, {self.num_value} value), not in sync again within the window: {self.num_lost_sync}", file=out)
+        print(f"# events: a: {self.num_events_a} b: {self.num_events_b} matched: {self.num_matched}", file=out)
+        for div in self.later:
+            print(f"# divergence: {div.kind} at event {div.seq_a} of a, event {div.seq_b} of b", file=out)
+            _show_divergence(div, out)
+
+        if num_later > len(self.later):
+            locations = sorted(self.by_location.items(), key=lambda entry: entry[1], reverse=True)
+            print(f"# divergences by location: top {min(max_locations, len(locations))} of {len(locations)}", file=out)
+            for (kind, location), count in locations[ : max_locations ]:
+                print(f"#     {location} {kind}: {count}", file=out)
+
+
+def _format_event(event):
+    ret = f"{event.file}:{event.line}({event.nesting}) {event.kind}"
+    if event.name is not None:
+        ret += f" {event.name}"
+    if event.key is not None:
+        ret += f"[{event.key}]"
+    if event.value is not None:
+        value = event.value if len(event.value) <= _MAX_VALUE_LEN else event.value[ : _MAX_VALUE_LEN ] + "..."
+        ret += f" {value}"
+    return ret
+
+def _show_divergence(div, out):
+    for event in div.events_a:
+        print(f"- {_format_event(event)}", file=out)
+    if div.num_a > len(div.events_a):
+        print(f"- ... {div.num_a - len(div.events_a)} more events", file=out)
+    for event in div.events_b:
+        print(f"+ {_format_event(event)}", file=out)
+    if div.num_b > len(div.events_b):
+        print(f"+ ... {div.num_b - len(div.events_b)} more events", file=out)
+
+
+# returns the lines of a trace: file name (plain, .gz, .zst), prefix of the segments written by RotatingFileSink, file object or sequence of lines
+def _open_lines(source):
+    if not isinstance(source, str):
+        yield from source
+        return
+    if not os.path.exists(source) and list_segments(source):
+        yield from read_segments(source)
+        return
+    with _open_segment_for_read(source) as file:
+        yield from file
+
+def _read_events(source):
+    seq = 0
+    for text_line in _open_lines(source):
+        if not text_line.strip():
+            continue
+        if text_line.lstrip().startswith("{"):
+            parsed = parse_json_line(text_line)
+        else:
+            parsed = parse_text_line(text_line)
+        if parsed is None:
+            # output of the traced program, or error messages.
+            continue
+        file_name, line, nesting, kind, name, value, obj_type, obj_id, key = parsed
+        yield TraceEvent(seq=seq, kind=kind, file=file_name, line=line, nesting=nesting, name=name, value=value, obj_id=obj_id, obj_type=obj_type, key=key)
+        seq += 1
+
+
+# events of one trace, that have been read ahead
+class _Stream:
+    def __init__(self, source):
+        self.events = _read_events(source)
+        self.pending = collections.deque()
+        self.eof = False
+        self.num_events = 0
+
+    def fill(self, count):
+        while len(self.pending) < count and not self.eof:
+            event = next(self.events, None)
+            if event is None:
+                self.eof = True
+            else:
+                self.pending.append(event)
+                self.num_events += 1
+        return len(self.pending)
+
+    def next_seq(self):
+        return self.pending[0].seq if self.pending else self.num_events
+
+    def pop(self, count):
+        return [ self.pending.popleft() for _ in range(count) ]
+
+
+def _event_key(event):
+    return (event.file, event.line, event.nesting, event.kind)
+
+
+# returns (i, j) such that the events from a[i] and b[j] on are the same (for _SYNC_LEN events), with the smallest i + j; None if not found.
+def _find_sync(events_a, events_b, eof_a, eof_b):
+    keys_a = [ _event_key(event) for event in events_a ]
+    keys_b = [ _event_key(event) for event in events_b ]
+    positions_b = {}
+    for pos, key in enumerate(keys_b):
+        positions_b.setdefault(key, []).append(pos)
+
+    def in_sync(i, j):
+        for offset in range(_SYNC_LEN):
+            if i + offset >= len(keys_a) or j + offset >= len(keys_b):
+                # the end of a trace counts as in sync, a window that is too short doesn't.
+                return (i + offset >= len(keys_a) and eof_a) or (j + offset >= len(keys_b) and eof_b)
+            if keys_a[ i + offset ] != keys_b[ j + offset ]:
+                return False
+        return True
+
+    best = None
+    for i, key in enumerate(keys_a):
+        if best is not None and i >= best[0] + best[1]:
+            break
+        for j in positions_b.get(key, ()):
+            if best is not None and i + j >= best[0] + best[1]:
+                break
+            if in_sync(i, j):
+                best = (i, j)
+                break
+    return best
+
+
+def _normalise(value, ignore_addresses):
+    if value is None or not ignore_addresses:
+        return value
+    return _ADDRESS_RE.sub("0x?", value)
+
+
+def diff_traces(trace_a, trace_b, *, window : int = 1000, context : int = 10, max_events : int = 20, max_reported : int = 10, ignore_addresses : bool = True):
+    """compare two traces; returns a TraceDiff, its show_report method prints the result.
+
+    trace_a, trace_b - file name (plain, .gz, .zst), prefix of the segments written by RotatingFileSink, file object or sequence of lines
+    window           - number of events of each trace that are searched, to get in sync again after a difference in control flow
+    context          - number of events before the first divergence, that are kept
+    max_events       - number of differing events that are kept for each divergence
+    max_reported     - number of divergences after the first one, that are kept (all of them are counted by location)
+    ignore_addresses - values that differ in the object addresses only (0x...) are the same
+
+    At most window events of each trace are held in memory.
+    """
+    stream_a = _Stream(trace_a)
+    stream_b = _Stream(trace_b)
+    result = TraceDiff()
+    recent = collections.deque(maxlen=context)
+
+    def add_divergence(kind, events_a, events_b, num_a, num_b):
+        div = Divergence(kind, events_a[0].seq if events_a else stream_a.next_seq(), events_b[0].seq if events_b else stream_b.next_seq(),
+                         events_a[ : max_events ], events_b[ : max_events ], num_a, num_b)
+        if kind == "value":
+            result.num_value += 1
+        else:
+            result.num_control_flow += 1
+        if result.first is None:
+            div.context = list(recent)
+            result.first = div
+        elif len(result.later) < max_reported:
+            result.later.append(div)
+        location_key = (kind, div.location())
+        result.by_location[ location_key ] = result.by_location.get(location_key, 0) + 1
+
+    while True:
+        len_a = stream_a.fill(1)
+        len_b = stream_b.fill(1)
+        if len_a == 0 and len_b == 0:
+            break
+
+        if len_a != 0 and len_b != 0:
+            event_a = stream_a.pending[0]
+            event_b = stream_b.pending[0]
+            if _event_key(event_a) == _event_key(event_b):
+                stream_a.pending.popleft()
+                stream_b.pending.popleft()
+                if event_a.kind in _VALUE_KINDS and (event_a.name != event_b.name or event_a.key != event_b.key or _normalise(event_a.value, ignore_addresses) != _normalise(event_b.value, ignore_addresses)):
+                    add_divergence("value", [ event_a ], [ event_b ], 1, 1)
+                else:
+                    result.num_matched += 1
+                recent.append(event_a)
+                continue
+
+        if len_a == 0 or len_b == 0:
+            # one trace ended, the rest of the other one is one divergence.
+            stream = stream_a if len_a != 0 else stream_b
+            events = []
+            num_events = 0
+            while stream.fill(1) != 0:
+                event = stream.pending.popleft()
+                if len(events) < max_events:
+                    events.append(event)
+                num_events += 1
+            if len_a != 0:
+                add_divergence("control_flow", events, [], num_events, 0)
+            else:
+                add_divergence("control_flow", [], events, 0, num_events)
+            break
+
+        # control flow differs: search the window for the point where the traces are in sync again.
+        len_a = stream_a.fill(window)
+        len_b = stream_b.fill(window)
+        sync = _find_sync(stream_a.pending, stream_b.pending, stream_a.eof, stream_b.eof)
+        if sync is None:
+            result.num_lost_sync += 1
+            sync = (len_a, len_b)
+        events_a = stream_a.pop(sync[0])
+        events_b = stream_b.pop(sync[1])
+        add_divergence("control_flow", events_a, events_b, len(events_a), len(events_b))
+        recent.clear()
+
+    result.num_events_a = stream_a.num_events
+    result.num_events_b = stream_b.num_events
+    return result
@@ -0,0 +1,172 @@
+"""self-instrumentation of the tracer: counts the calls and the time spent in each part of the tracer (trace functions, opcode handlers,
+value formatting, consumers, output), to find out where the overhead of a trace comes from"""
+
+import sys
+import time
+import threading
+import opcode
+from . import prettytrace
+
+__all__ = [ "TracerStats" ]
+
+# format_value of prettytrace is replaced by a timed version, while traces with TracerStats run (number of such traces, original function)
+_PATCH_LOCK = threading.Lock()
+_PATCH_COUNT = 0
+_ORIG_FORMAT_VALUE = None
+
+
+# entry of a component: number of calls, total nanoseconds, bytes written
+class _Component:
+    __slots__ = ("calls", "total_ns", "bytes")
+
+    def __init__(self):
+        self.calls = 0
+        self.total_ns = 0
+        self.bytes = 0
+
+
+# the counters of a TracerStats are updated under its lock: several threads can trace at the same time.
+def _timed(func, component, lock):
+    perf_counter_ns = time.perf_counter_ns
+
+    def timed_func(*args):
+        start = perf_counter_ns()
+        try:
+            return func(*args)
+        finally:
+            elapsed = perf_counter_ns() - start
+            with lock:
+                component.calls += 1
+                component.total_ns += elapsed
+    return timed_func
+
+
+# output stream of the trace: counts the time and the bytes of each write
+class _TimedOutput:
+    def __init__(self, out, component, lock):
+        self.out = out
+        self.component = component
+        self.lock = lock
+
+    def write(self, text):
+        start = time.perf_counter_ns()
+        ret = self.out.write(text)
+        elapsed = time.perf_counter_ns() - start
+        num_bytes = len(text) if text.isascii() else len(text.encode("utf-8", errors="replace"))
+        component = self.component
+        with self.lock:
+            component.calls += 1
+            component.total_ns += elapsed
+            component.bytes += num_bytes
+        return ret
+
+    def __getattr__(self, name):
+        return getattr(self.out, name)
+
+
+# consumer wrapper, that counts the time spent in on_event
+class _TimedConsumer(prettytrace.TraceConsumer):
+    def __init__(self, consumer, component, lock):
+        self.consumer = consumer
+        self.wants_values = consumer.wants_values
+        self.event_kinds = consumer.event_kinds
+        self.on_event = _timed(consumer.on_event, component, lock)
+
+    def on_end(self):
+        self.consumer.on_end()
+
+
+class TracerStats(prettytrace.TraceConsumer):
+    """pass as tracer_stats parameter of TraceMe/TraceClass: measures the tracer itself, the report is written when the outermost
+    traced function returns (or call show_report).
+
+    out - the report is written here (None - no report)
+
+    Components: the global and the local trace function (_func_tracer, _line_tracer), on_opcode, each opcode handler, format_value
+    (formatting of values by the text, json and object tracking consumers of prettytrace), on_event of each consumer, and the writes to the
+    out stream of the trace (with the number of bytes). The times are inclusive: _line_tracer contains on_opcode, which contains the opcode handlers,
+    which contain the consumers, and so on. Each measurement costs two clock reads, so the traced run gets slower.
+    Only the out stream of the built-in consumers is measured, explicitly passed consumers write where they want.
+    Can be shared by traces in several threads: the counters are updated under a lock (which adds to the measured overhead).
+    """
+
+    wants_values = False
+    # gets no events, on_end writes the report.
+    event_kinds = frozenset()
+
+    def __init__(self, *, out = sys.stderr):
+        self.out = out
+        # component name -> _Component
+        self.components = {}
+        self.num_traces = 0
+        self.lock = threading.Lock()
+
+    def get_component(self, name):
+        with self.lock:
+            component = self.components.get(name, None)
+            if component is None:
+                component = _Component()
+                self.components[ name ] = component
+        return component
+
+    def _timed(self, func, name):
+        return _timed(func, self.get_component(name), self.lock)
+
+    def wrap_out(self, out):
+        return _TimedOutput(out, self.get_component("output"), self.lock)
+
+    def instrument(self, ctx):
+        """called by ThreadTraceCtx: replaces the parts of the trace context with timed versions"""
+        global _PATCH_COUNT
+        global _ORIG_FORMAT_VALUE
+
+        with self.lock:
+            self.num_traces += 1
+        ctx.on_opcode = self._timed(ctx.on_opcode, "on_opcode")
+        ctx.load_opcodes = { instr : self._timed(func, f"opcode {opcode.opname[instr]}") for instr, func in ctx.load_opcodes.items() }
+        ctx.store_opcodes = { instr : self._timed(func, f"opcode {opcode.opname[instr]}") for instr, func in ctx.store_opcodes.items() }
+        consumers = [ consumer if consumer is self else _TimedConsumer(consumer, self.get_component(f"consumer {type(consumer).__name__}"), self.lock) for consumer in ctx.consumers ]
+        ctx.set_consumers(consumers)
+
+        func_tracer = self._timed(prettytrace._func_tracer, "_func_tracer")
+        line_tracer_func = self._timed(prettytrace._line_tracer, "_line_tracer")
+
+        # the trace functions return the local trace function, it is replaced by the timed one.
+        def stats_line_tracer(frame, why, arg):
+            ret = line_tracer_func(frame, why, arg)
+            return stats_line_tracer if ret is prettytrace._line_tracer else ret
+
+        def stats_func_tracer(frame, why, arg):
+            ret = func_tracer(frame, why, arg)
+            return stats_line_tracer if ret is prettytrace._line_tracer else ret
+
+        if ctx.params.coverage is None:
+            ctx.get_tracer = lambda: stats_func_tracer
+
+        with _PATCH_LOCK:
+            if _PATCH_COUNT == 0:
+                _ORIG_FORMAT_VALUE = prettytrace.format_value
+                prettytrace.format_value = self._timed(_ORIG_FORMAT_VALUE, "format_value")
+            _PATCH_COUNT += 1
+
+    def on_end(self):
+        global _PATCH_COUNT
+
+        with _PATCH_LOCK:
+            _PATCH_COUNT -= 1
+            if _PATCH_COUNT == 0:
+                prettytrace.format_value = _ORIG_FORMAT_VALUE
+        if self.out is not None:
+            self.show_report(self.out)
+
+    def get_ranking(self):
+        """returns (component name, _Component) entries, ordered by total time"""
+        return sorted(self.components.items(), key=lambda entry: entry[1].total_ns, reverse=True)
+
+    def show_report(self, out = sys.stderr):
+        ranking = [ entry for entry in self.get_ranking() if entry[1].calls != 0 ]
+        print(f"# tracer stats: {len(ranking)} components (times include nested components)", file=out)
+        print(f"# {'component':<32} {'calls':>10} {'total ms':>12} {'ns/call':>10} {'bytes':>12}", file=out)
+        for name, component in ranking:
+            per_call = component.total_ns // component.calls
+            print(f"# {name:<32} {component.calls:>10} {component.total_ns / 1e6:>12.3f} {per_call:>10} {component.bytes:>12}", file=out)
@@ -0,0 +1,127 @@
+"""type profile: the types seen at each load/store site (local variable loads, attribute access, subscripts), to find the sites
+where the types vary (polymorphic/megamorphic sites can't be specialised by the interpreter)"""
+
+import sys
+import linecache
+from .prettytrace import TraceConsumer, TraceRecord
+
+__all__ = [ "TypeProfiler" ]
+
+
+def _type_name(val_type):
+    if isinstance(val_type, tuple):
+        # subscript: type of the container and of the key
+        return f"{_type_name(val_type[0])}[{_type_name(val_type[1])}]"
+    if val_type.__module__ == "builtins":
+        return val_type.__qualname__
+    return f"{val_type.__module__}.{val_type.__qualname__}"
+
+
+# types seen at one instruction
+class _Site:
+    __slots__ = ("filename", "bname", "lineno", "offset", "kind", "name", "types", "num_other", "count")
+
+    def __init__(self, rec):
+        self.filename = rec.filename
+        self.bname = rec.bname
+        self.lineno = rec.lineno
+        self.offset = rec.offset
+        self.kind = rec.kind
+        self.name = rec.name
+        # type -> number of times seen
+        self.types = {}
+        # number of times a type was seen, that didn't fit into types
+        self.num_other = 0
+        self.count = 0
+
+    def num_types(self):
+        return len(self.types) + (1 if self.num_other != 0 else 0)
+
+    def describe(self):
+        types = sorted(self.types.items(), key=lambda entry: entry[1], reverse=True)
+        ret = ", ".join(f"{_type_name(val_type)}: {count}" for val_type, count in types)
+        if self.num_other != 0:
+            ret += f", other types: {self.num_other}"
+        return ret
+
+
+class TypeProfiler(TraceConsumer):
+    """records the types seen at each site (code object, instruction offset), instead of printing the values; pass it in the consumers parameter
+    of TraceMe/TraceClass (consumers=[ TypeProfiler() ]).
+
+    LOAD_FAST - type of the value, LOAD_ATTR/STORE_ATTR - type of the object, BINARY_SUBSCR - type of the container and of the key.
+
+    megamorphic - a site with more than this number of types is megamorphic, with 2 up to this number it is polymorphic.
+                  Up to megamorphic + 1 types are kept per site.
+    out         - the report is written here, when the outermost traced function returns (None - no report, call show_report)
+    """
+
+    wants_values = True
+    event_kinds = frozenset(( "load", "load_attr", "store_attr", "load_subscr" ))
+
+    def __init__(self, *, megamorphic : int = 4, out = sys.stderr):
+        self.megamorphic = megamorphic
+        self.out = out
+        # (code object, offset) -> _Site
+        self.sites = {}
+
+    def on_event(self, rec : TraceRecord):
+        key = (rec.code, rec.offset)
+        site = self.sites.get(key, None)
+        if site is None:
+            site = _Site(rec)
+            self.sites[ key ] = site
+
+        kind = rec.kind
+        if kind == "load":
+            val_type = type(rec.value)
+        elif kind == "load_subscr":
+            val_type = (type(rec.obj), type(rec.key))
+        else:
+            val_type = type(rec.obj)
+
+        site.count += 1
+        types = site.types
+        count = types.get(val_type, None)
+        if count is not None:
+            types[ val_type ] = count + 1
+        elif len(types) <= self.megamorphic:
+            types[ val_type ] = 1
+        else:
+            site.num_other += 1
+
+    def on_end(self):
+        if self.out is not None:
+            self.show_report(self.out)
+
+    def classify(self, site):
+        """returns "monomorphic", "polymorphic" or "megamorphic" """
+        num_types = site.num_types()
+        if num_types > self.megamorphic:
+            return "megamorphic"
+        if num_types > 1:
+            return "polymorphic"
+        return "monomorphic"
+
+    def get_sites(self, kinds = ( "polymorphic", "megamorphic" )):
+        """returns the _Site entries that are classified as one of kinds, ordered by file and line"""
+        sites = [ site for site in self.sites.values() if self.classify(site) in kinds ]
+        sites.sort(key=lambda site: (site.filename, site.lineno, site.offset))
+        return sites
+
+    def show_report(self, out = sys.stderr, show_monomorphic : bool = False):
+        kinds = ( "monomorphic", "polymorphic", "megamorphic" ) if show_monomorphic else ( "polymorphic", "megamorphic" )
+        num_poly = len(self.get_sites(( "polymorphic", )))
+        num_mega = len(self.get_sites(( "megamorphic", )))
+        print(f"# type profile: {len(self.sites)} sites, {num_poly} polymorphic, {num_mega} megamorphic", file=out)
+
+        prev_line = None
+        for site in self.get_sites(kinds):
+            if (site.filename, site.lineno) != prev_line:
+                prev_line = (site.filename, site.lineno)
+                line = linecache.getline(site.filename, site.lineno).rstrip()
+                print(f"{site.bname}:{site.lineno} {line}", file=out)
+
+            name = "" if site.name is None else f" {site.name}"
+            num_types = f"more than {len(site.types)}" if site.num_other != 0 else str(len(site.types))
+            print(f"{site.bname}:{site.lineno} # offset: {site.offset} {site.kind}{name} {self.classify(site)} ({num_types} types) {site.describe()}", file=out)
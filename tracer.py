@@ -121,6 +121,14 @@ Both the TraceMe function decorator class and the TraceClass metaclass accept th
 - show_obj : int = 1           :: level of detail for values displayed (0 - str(val), 1 - repr(val), 2 - pprint.pformat(val))
 - ignore_stdlib : bool = True  :: do not trace functions/objects in standard library
 - out = sys.stderr             :: destination stream of trace output
+- track_objects : bool = False :: keep a table of accessed objects (by id), show a mutation timeline per object when tracing ends
+- consumers = None             :: list of TraceConsumer objects that receive the trace events (TextTraceConsumer, JsonTraceConsumer, EventCollector, ...); None writes the text trace to out
+- coverage = None              :: LineCoverage object: only record which lines are executed (one bitmap per code object, no trace output); show the result with coverage.show_report()
+- memory_profile = None        :: MemoryProfiler object: attribute tracemalloc deltas to the previous source line, report the lines that allocate most when tracing ends
+- fold_comprehensions : bool = False :: don't trace list/set/dict comprehensions and generator expressions as calls of their own, they are part of the line that contains them
+- fold_loops : int = 0 :: if not 0: show only the first and the last fold_loops iterations of each loop, the other iterations are summarised (number of iterations, range of the stored values)
+- capture : ArgCapture = None :: capture mode: if set, the calls are not traced, a sample of the calls is recorded with the pickled arguments (see capture.py); replay them with: python -m pyasmtools replay
+- tracer_stats : TracerStats = None :: measure the tracer itself: calls, time and bytes written of the trace functions, opcode handlers, value formatting, consumers and output; reported when tracing ends
 
 """)
 